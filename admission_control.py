@@ -0,0 +1,164 @@
+"""
+Admission control for OpenAI Assistant runs
+Bounds concurrent runs and request/token rates, rejecting work quickly when the bot is overloaded
+"""
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+from config import Config
+from metrics import Counter, Gauge, Histogram
+
+ADMISSION_IN_FLIGHT = Gauge("bot_admission_in_flight", "Assistant runs currently admitted")
+ADMISSION_QUEUE_DEPTH = Gauge("bot_admission_queue_depth", "Assistant runs waiting for admission")
+ADMISSION_WAIT_SECONDS = Histogram("bot_admission_wait_seconds", "Time admitted runs waited in the admission queue")
+ADMISSION_REJECTED = Counter("bot_admission_rejected_total", "Assistant runs rejected by admission control", ["reason"])
+
+
+class AdmissionRejected(Exception):
+    """Raised when a run cannot be admitted because the bot is overloaded"""
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at a per-minute rate"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self._updated: Optional[float] = None
+
+    def _refill(self, now: float) -> None:
+        if self._updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def time_until(self, amount: float, now: float) -> float:
+        """Get seconds until `amount` tokens are available"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float, now: float) -> None:
+        """Take `amount` tokens from the bucket"""
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+
+
+def estimate_tokens(text: str, response_tokens: int) -> int:
+    """
+    Roughly estimate tokens used by one assistant turn
+
+    Args:
+        text: The user's message
+        response_tokens: Expected size of the assistant's reply
+
+    Returns:
+        Estimated token count (about four characters per token)
+    """
+    return len(text) // 4 + response_tokens
+
+
+class AdmissionController:
+    """Admits assistant runs subject to an in-flight limit, rate limits and a bounded wait queue"""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self._semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_RUNS)
+        self._rate_lock = asyncio.Lock()
+        self._request_bucket = TokenBucket(config.RATE_LIMIT_RPM) if config.RATE_LIMIT_RPM > 0 else None
+        self._token_bucket = TokenBucket(config.RATE_LIMIT_TPM) if config.RATE_LIMIT_TPM > 0 else None
+
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+        ADMISSION_IN_FLIGHT.set_function(lambda: self.in_flight)
+        ADMISSION_QUEUE_DEPTH.set_function(lambda: self.queue_depth)
+
+    @asynccontextmanager
+    async def admit(self, estimated_tokens: int = 0) -> AsyncIterator[None]:
+        """
+        Wait for permission to start an assistant run
+
+        Args:
+            estimated_tokens: Estimated tokens the run will use
+
+        Raises:
+            AdmissionRejected: If the wait queue is full or the wait times out
+        """
+        # Runs beyond the in-flight limit may wait, up to the maximum queue depth
+        if self.in_flight + self.queue_depth >= self.config.MAX_CONCURRENT_RUNS + self.config.MAX_QUEUE_DEPTH:
+            self.rejected += 1
+            ADMISSION_REJECTED.inc(reason="queue_full")
+            self.logger.warning(f"Rejecting run: queue full ({self.queue_depth} waiting)")
+            raise AdmissionRejected("Queue is full")
+
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        self.queue_depth += 1
+        try:
+            await asyncio.wait_for(self._acquire(estimated_tokens), timeout=self.config.QUEUE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            ADMISSION_REJECTED.inc(reason="timeout")
+            self.logger.warning(f"Rejecting run: waited more than {self.config.QUEUE_TIMEOUT_SECONDS}s")
+            raise AdmissionRejected("Timed out waiting for capacity")
+        finally:
+            self.queue_depth -= 1
+
+        wait_time = loop.time() - start_time
+        ADMISSION_WAIT_SECONDS.observe(wait_time)
+        self.admitted += 1
+        self._total_wait += wait_time
+        self._max_wait = max(self._max_wait, wait_time)
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    async def _acquire(self, estimated_tokens: int) -> None:
+        """Take an in-flight slot, then wait until the rate limits allow the run"""
+        await self._semaphore.acquire()
+        try:
+            async with self._rate_lock:
+                loop = asyncio.get_running_loop()
+                while True:
+                    now = loop.time()
+                    delay = 0.0
+                    if self._request_bucket:
+                        delay = max(delay, self._request_bucket.time_until(1, now))
+                    if self._token_bucket:
+                        delay = max(delay, self._token_bucket.time_until(estimated_tokens, now))
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+
+                if self._request_bucket:
+                    self._request_bucket.consume(1, now)
+                if self._token_bucket:
+                    self._token_bucket.consume(estimated_tokens, now)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def get_metrics(self) -> Dict[str, float]:
+        """Get admission queue statistics"""
+        return {
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self._total_wait / self.admitted * 1000, 1) if self.admitted else 0.0,
+            "max_wait_ms": round(self._max_wait * 1000, 1)
+        }
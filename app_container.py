@@ -0,0 +1,156 @@
+"""
+Application container
+Builds every service once and shares it between the polling and webhook entry points
+"""
+
+import logging
+import os
+from typing import Optional, Union
+from telegram import Update
+from telegram.ext import Application, MessageHandler, CommandHandler, TypeHandler, filters
+from admission_control import AdmissionController
+from async_database_service import AsyncDatabaseService
+from bot_handler import BotHandler
+from command_handler import CommandHandler as BotCommandHandler
+from config import Config
+from database_service import DatabaseService
+from logging_service import LoggingService
+from metrics import MetricsServer
+from openai_service import OpenAIService, create_async_client
+from retention import RetentionJob
+from shared_state import DatabaseStateStore, InstanceCoordinator, MemoryStateStore
+from stats_service import StatsService
+from thread_manager import ThreadManager
+from tracing import TRACER, create_exporter
+from user_activity import UserActivityTracker
+
+
+class AppContainer:
+    """Owns the bot's shared services and their startup/shutdown lifecycle"""
+
+    def __init__(self, config: Config, metrics_port: Optional[int] = None):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        # /metrics on its own port, for entry points without an HTTP server (polling mode)
+        self.metrics_server = MetricsServer(metrics_port) if metrics_port else None
+        TRACER.configure(config, create_exporter(config))
+
+        # One HTTP connection pool and one database engine for the whole process
+        self.openai_client = create_async_client(config)
+        self.db_service = self._create_database_service()
+
+        self.openai_service = OpenAIService(config, client=self.openai_client)
+        self.thread_manager = ThreadManager(config, client=self.openai_client, db_service=self.db_service)
+        self.logging_service = LoggingService(config, db_service=self.db_service)
+        self.admission = AdmissionController(config)
+        self.retention = RetentionJob(config, db_service=self.db_service, logging_service=self.logging_service)
+        self.user_activity = UserActivityTracker(config, self.db_service) if self.db_service is not None else None
+        self.stats = StatsService(config, db_service=self.db_service, thread_manager=self.thread_manager,
+                                  user_activity=self.user_activity)
+        self.coordinator = self._create_coordinator()
+
+        self.bot_handler = BotHandler(
+            config,
+            openai_service=self.openai_service,
+            logging_service=self.logging_service,
+            thread_manager=self.thread_manager,
+            admission=self.admission,
+            user_activity=self.user_activity,
+            stats=self.stats,
+            coordinator=self.coordinator
+        )
+        self.command_handler = BotCommandHandler(config, self.thread_manager, self.admission, self.stats)
+
+    def _create_database_service(self) -> Optional[Union[DatabaseService, AsyncDatabaseService]]:
+        """Connect to the database, or return None to use file storage"""
+        if self.config.DB_ASYNC and os.getenv('DATABASE_URL'):
+            try:
+                # Tables are created and the connection is checked in startup()
+                return AsyncDatabaseService()
+            except (ImportError, ValueError) as e:
+                self.logger.warning(f"Async database driver not available, using synchronous driver: {e}")
+        try:
+            return DatabaseService()
+        except Exception as e:
+            self.logger.warning(f"Database not available, using file backend: {e}")
+            return None
+
+    def _create_coordinator(self) -> Optional[InstanceCoordinator]:
+        """Coordinate with other instances through the database when running several of them"""
+        if not self.config.MULTI_INSTANCE:
+            return None
+        if self.db_service is None:
+            self.logger.warning("MULTI_INSTANCE needs DATABASE_URL to share state; coordinating this instance only")
+            return InstanceCoordinator(self.config, MemoryStateStore())
+        return InstanceCoordinator(self.config, DatabaseStateStore(self.db_service))
+
+    def build_application(self) -> Application:
+        """Create the Telegram application with all handlers and lifecycle hooks registered"""
+        if not self.config.TELEGRAM_TOKEN:
+            raise ValueError("TELEGRAM_TOKEN is required")
+
+        application = (
+            Application.builder()
+            .token(self.config.TELEGRAM_TOKEN)
+            .concurrent_updates(self.config.CONCURRENT_UPDATES)
+            .post_init(self.startup)
+            .post_shutdown(self.shutdown)
+            .build()
+        )
+
+        # Skip updates another instance (or an earlier delivery) already handled, before any other handler
+        if self.coordinator:
+            application.add_handler(TypeHandler(Update, self.coordinator.filter_update), group=-1)
+
+        # Add command handlers
+        application.add_handler(CommandHandler("reset", self.command_handler.handle_reset))
+        application.add_handler(CommandHandler("stats", self.command_handler.handle_stats))
+
+        # Add message handler for text messages (excluding commands)
+        application.add_handler(MessageHandler(
+            filters.TEXT & ~filters.COMMAND,
+            self.bot_handler.handle_message
+        ))
+
+        # Add error handler
+        application.add_error_handler(self.bot_handler.handle_error)
+        return application
+
+    async def startup(self, application: Application) -> None:
+        """Run once the application is initialized, before updates are processed"""
+        if isinstance(self.db_service, AsyncDatabaseService):
+            await self.db_service.initialize()
+        await self.logging_service.start()
+        await self.thread_manager.start()
+        if self.user_activity:
+            await self.user_activity.start()
+        await self.stats.start()
+        await self.retention.start()
+        if self.coordinator:
+            await self.coordinator.start()
+            self.logger.info(f"Running as instance {self.coordinator.instance_id}")
+        if self.metrics_server:
+            await self.metrics_server.start()
+        await TRACER.start()
+        self.logger.info("Application services started")
+
+    async def shutdown(self, application: Application) -> None:
+        """Flush pending work and release shared connections when the application stops"""
+        if self.metrics_server:
+            await self.metrics_server.close()
+        if self.coordinator:
+            await self.coordinator.close()
+        await self.retention.close()
+        await self.stats.close()
+        await self.logging_service.stop()
+        if self.user_activity:
+            await self.user_activity.close()
+        await self.thread_manager.close()
+        # After the log writer has stopped, so its last flush is exported too
+        await TRACER.close()
+        await self.openai_client.close()
+        if isinstance(self.db_service, AsyncDatabaseService):
+            await self.db_service.close()
+        elif self.db_service is not None:
+            self.db_service.close()
+        self.logger.info("Application services stopped")
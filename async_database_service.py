@@ -0,0 +1,220 @@
+"""
+Async database service for the Telegram bot
+Runs DatabaseService's queries on SQLAlchemy's asyncio extension, so they never block the event loop
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+from database_service import DatabaseService
+from migrations import migrate
+from models import UPDATE_CONNECTION_IDLE_SECONDS, DatabaseManager, _current_session, pool_options
+
+# Async drivers used for each database backend
+ASYNC_DRIVERS = {
+    "postgresql": "asyncpg",
+    "postgres": "asyncpg",
+    "sqlite": "aiosqlite",
+}
+
+
+class AsyncUpdateConnection:
+    """Pooled connection shared by the session scopes of one Telegram update, like models.UpdateConnection"""
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+        self._connection: Optional[AsyncConnection] = None
+        self._calls = 0
+        self._idle_timer: Optional[asyncio.TimerHandle] = None
+        self._release_task: Optional[asyncio.Task] = None
+
+    async def acquire(self) -> AsyncConnection:
+        if self._connection is None:
+            self._connection = await self.engine.connect()
+        return self._connection
+
+    async def release(self) -> None:
+        """Return the connection to the pool; the next scope checks out another"""
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            await connection.close()
+
+    def begin_call(self) -> None:
+        """Note a service call starting, keeping the connection checked out"""
+        self._calls += 1
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def end_call(self) -> None:
+        """Note a service call finishing; the connection is released unless another call follows soon"""
+        self._calls -= 1
+        if self._calls == 0:
+            self._idle_timer = asyncio.get_running_loop().call_later(UPDATE_CONNECTION_IDLE_SECONDS, self._on_idle)
+
+    def _on_idle(self) -> None:
+        self._idle_timer = None
+        if self._connection is not None:
+            self._release_task = asyncio.create_task(self.release())
+
+
+# Connection of the update handled in the current task, see AsyncDatabaseService.update_scope()
+_current_update: ContextVar[Optional[AsyncUpdateConnection]] = ContextVar("current_async_update", default=None)
+
+
+def to_async_url(database_url: str) -> Tuple[str, Dict]:
+    """
+    Convert a DATABASE_URL to its async driver equivalent
+
+    Args:
+        database_url: URL such as postgresql://... or sqlite:///bot.db
+
+    Returns:
+        Tuple of async URL and extra connect arguments
+
+    Raises:
+        ValueError: If there is no async driver for the database backend
+    """
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for database backend '{backend}'")
+
+    url = url.set(drivername=f"{'postgresql' if backend == 'postgres' else backend}+{ASYNC_DRIVERS[backend]}")
+    connect_args = {}
+    # asyncpg takes the libpq sslmode as its "ssl" argument
+    if "sslmode" in url.query:
+        connect_args["ssl"] = url.query["sslmode"]
+        url = url.difference_update_query(["sslmode"])
+    return url.render_as_string(hide_password=False), connect_args
+
+
+class AsyncDatabaseService:
+    """
+    Runs DatabaseService's queries on an asyncio driver (asyncpg, aiosqlite)
+
+    Queries are written once, as DatabaseService methods. call() opens an
+    AsyncSession and runs the method inside AsyncSession.run_sync(), where the
+    method's session scope joins that session, so its statements go through the
+    async driver without blocking the event loop or a worker thread.
+    """
+
+    def __init__(self, database_url: Optional[str] = None):
+        self.logger = logging.getLogger(__name__)
+        database_url = database_url or os.getenv('DATABASE_URL')
+        if not database_url:
+            raise ValueError("DATABASE_URL environment variable not set")
+
+        async_url, connect_args = to_async_url(database_url)
+        # Fails with ImportError when the async driver is not installed
+        self.engine = create_async_engine(async_url, connect_args=connect_args, **pool_options(database_url))
+        self.SessionLocal = async_sessionmaker(self.engine, expire_on_commit=False, autoflush=False)
+
+        # Pool metrics and query latency are recorded on the sync side of the engine
+        self.db_manager = DatabaseManager(engine=self.engine.sync_engine)
+        self.queries = DatabaseService(self.db_manager)
+
+    async def initialize(self) -> None:
+        """Create tables, apply schema migrations and verify the connection"""
+        try:
+            async with self.engine.begin() as conn:
+                await conn.run_sync(migrate)
+            self.logger.info("Async database connection established")
+        except Exception as e:
+            self.logger.error(f"Failed to connect to database: {e}")
+            raise
+
+    async def close(self) -> None:
+        """Dispose of the connection pool"""
+        await self.engine.dispose()
+
+    @asynccontextmanager
+    async def session_scope(self) -> AsyncIterator[AsyncSession]:
+        """
+        Provide a transactional session
+
+        Acquires a pooled connection up front (inside update_scope(), the update's
+        connection), commits on success, rolls back on error and closes the session.
+        """
+        update = _current_update.get()
+        session = self.SessionLocal()
+        try:
+            start_time = time.perf_counter()
+            try:
+                if update is not None:
+                    # Inside an update scope, sessions share the update's connection
+                    session.sync_session.bind = (await update.acquire()).sync_connection
+                await session.connection()
+            except PoolTimeoutError:
+                self.db_manager.record_timeout()
+                raise
+            self.db_manager.record_checkout_wait(time.perf_counter() - start_time)
+
+            yield session
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            if update is not None:
+                # The connection may be broken; later scopes of the update check out another
+                await update.release()
+            raise
+        finally:
+            await session.close()
+
+    async def call(self, method: str, *args) -> Any:
+        """
+        Run a DatabaseService method in one async session
+
+        Args:
+            method: Name of the method, e.g. "get_user_thread"
+            *args: Its arguments
+
+        Returns:
+            What the method returns
+        """
+        connection = _current_update.get()
+        if connection is not None:
+            connection.begin_call()
+        try:
+            async with self.session_scope() as session:
+                return await session.run_sync(self._run_query, method, args)
+        finally:
+            if connection is not None:
+                connection.end_call()
+
+    def _run_query(self, session: Session, method: str, args: Tuple) -> Any:
+        # The method's session_scope() reuses the session it finds here instead of opening one
+        token = _current_session.set(session)
+        try:
+            return getattr(self.queries, method)(*args)
+        finally:
+            _current_session.reset(token)
+
+    @asynccontextmanager
+    async def update_scope(self) -> AsyncIterator[None]:
+        """
+        Share one pooled connection between the service calls made while handling an update
+
+        The connection is checked out by the first call and returned to the pool once
+        no call has used it for UPDATE_CONNECTION_IDLE_SECONDS, so it isn't held while
+        the update waits on OpenAI, and at the latest when the block exits.
+        """
+        connection = AsyncUpdateConnection(self.engine)
+        token = _current_update.set(connection)
+        try:
+            yield
+        finally:
+            _current_update.reset(token)
+            await connection.release()
+
+    def get_pool_stats(self) -> Dict[str, float]:
+        """Get connection pool statistics"""
+        return self.db_manager.get_pool_stats()
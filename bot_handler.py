@@ -3,24 +3,131 @@ Telegram bot message handler
 Manages incoming messages and coordinates with OpenAI service
 """
 
+import asyncio
 import logging
-from telegram import Update
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from telegram import Bot, Message, Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ContextTypes
+from admission_control import AdmissionController, AdmissionRejected, estimate_tokens
 from openai_service import OpenAIService
 from logging_service import LoggingService
+from metrics import Counter, Histogram
+from shared_state import InstanceCoordinator, UserLockTimeout
+from stats_service import StatsService
 from thread_manager import ThreadManager
+from tracing import TRACER, traced
+from user_activity import UserActivityTracker
 from config import Config
 
+# Telegram rejects messages longer than this many characters
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+REPLY_LATENCY_SECONDS = Histogram("bot_reply_latency_seconds", "Time from receiving a message to the complete reply",
+                                  buckets=(0.5, 1, 2, 3, 5, 8, 12, 20, 30, 45, 60, 120, 300))
+TURNS = Counter("bot_turns_total", "Assistant turns by outcome", ["outcome"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Errors raised by update handlers")
+TELEGRAM_REQUEST_SECONDS = Histogram("bot_telegram_request_seconds", "Telegram Bot API call latency", ["method"])
+TELEGRAM_FLOOD_WAITS = Counter("bot_telegram_flood_waits_total", "Telegram flood control responses")
+
+
+@contextmanager
+def telegram_call(method: str) -> Iterator[None]:
+    """Time a Telegram Bot API call and record it in the current trace"""
+    with TELEGRAM_REQUEST_SECONDS.time(method=method), TRACER.span(f"telegram.{method}"):
+        yield
+
+
+class StreamingReply:
+    """Renders a streamed assistant response into Telegram messages, editing them as text arrives"""
+    
+    def __init__(self, bot: Bot, chat_id: int, edit_interval: float):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.edit_interval = edit_interval
+        self.logger = logging.getLogger(__name__)
+        self._text = ""
+        self._offset = 0  # start of the text shown in the current message
+        self._message: Optional[Message] = None
+        self._shown = ""
+        self._next_edit_at = 0.0
+    
+    @property
+    def text(self) -> str:
+        """Full response text received so far"""
+        return self._text
+    
+    async def append(self, delta: str) -> None:
+        """Add a response fragment, updating Telegram at most once per edit interval"""
+        self._text += delta
+        
+        # Finalize full messages and continue the response in a new one
+        while len(self._text) - self._offset > TELEGRAM_MESSAGE_LIMIT:
+            await self._show(self._text[self._offset:self._offset + TELEGRAM_MESSAGE_LIMIT], final=True)
+            self._offset += TELEGRAM_MESSAGE_LIMIT
+            self._message, self._shown = None, ""
+        
+        # The first fragment is sent immediately, later ones are throttled
+        if self._message is None or asyncio.get_running_loop().time() >= self._next_edit_at:
+            await self._show(self._text[self._offset:], final=False)
+    
+    async def finish(self) -> None:
+        """Make sure the complete response is visible"""
+        await self._show(self._text[self._offset:], final=True)
+    
+    async def _show(self, text: str, final: bool) -> None:
+        """Send or edit the current message so that it displays text"""
+        if not text.strip() or text == self._shown:
+            return
+        
+        try:
+            if self._message is None:
+                with telegram_call("send_message"):
+                    self._message = await self.bot.send_message(chat_id=self.chat_id, text=text)
+            else:
+                with telegram_call("edit_message_text"):
+                    await self._message.edit_text(text)
+            self._shown = text
+            self._next_edit_at = asyncio.get_running_loop().time() + self.edit_interval
+            
+        except RetryAfter as e:
+            TELEGRAM_FLOOD_WAITS.inc()
+            self.logger.warning(f"Telegram flood control, retrying in {e.retry_after}s")
+            self._next_edit_at = asyncio.get_running_loop().time() + e.retry_after
+            if final:
+                await asyncio.sleep(e.retry_after)
+                await self._show(text, final)
+                
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+            self._shown = text
+
+
 class BotHandler:
     """Handles Telegram bot messages and interactions"""
     
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, openai_service: OpenAIService, logging_service: LoggingService,
+                 thread_manager: ThreadManager, admission: AdmissionController,
+                 user_activity: Optional[UserActivityTracker] = None, stats: Optional[StatsService] = None,
+                 coordinator: Optional[InstanceCoordinator] = None):
         self.config = config
-        self.openai_service = OpenAIService(config)
-        self.logging_service = LoggingService(config)
-        self.thread_manager = ThreadManager(config)
+        self.openai_service = openai_service
+        self.logging_service = logging_service
+        self.thread_manager = thread_manager
+        self.admission = admission
+        self.user_activity = user_activity
+        self.stats = stats
+        self.coordinator = coordinator
         self.logger = logging.getLogger(__name__)
+        
+        # Per-user work queues: messages waiting for a turn and users with a turn in progress
+        self._pending_messages: Dict[int, List[Tuple[int, str, float]]] = {}
+        self._active_users: Set[int] = set()
+        self.coalesced_messages = 0
     
+    @traced("handle_message", root=True)
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Handle incoming text messages from users
@@ -38,6 +145,10 @@ class BotHandler:
         user_name = update.message.from_user.full_name if update.message.from_user else "Unknown"
         
         self.logger.info(f"Received message from user {user_id} ({user_name}) in chat {chat_id}: {user_message[:100]}...")
+        span = TRACER.current_span()
+        span.set_attribute("update_id", update.update_id)
+        span.set_attribute("user_id", user_id)
+        span.set_attribute("chat_id", chat_id)
         
         # Check whitelist authorization
         if self.config.ALLOWED_USERS and user_id not in self.config.ALLOWED_USERS:
@@ -48,25 +159,141 @@ class BotHandler:
             self.logger.warning(f"Unauthorized access attempt from user {user_id} ({user_name})")
             return
         
+        if self.user_activity and update.message.from_user:
+            sender = update.message.from_user
+            self.user_activity.record(user_id, sender.username, sender.first_name, sender.last_name)
+        
+        # Only one run may be active on a user's thread; later messages wait for the next turn
+        received_at = asyncio.get_running_loop().time()
+        self._pending_messages.setdefault(user_id, []).append((chat_id, user_message, received_at))
+        if user_id in self._active_users:
+            # The message is answered within the trace of the update whose turn is running
+            span.set_attribute("queued", True)
+            self.logger.debug(f"Queued message from user {user_id} until the current run finishes")
+            return
+        
+        self._active_users.add(user_id)
+        try:
+            # Messages arriving while the lock is being released are handled in another round
+            while self._pending_messages.get(user_id):
+                # With several instances, only the one holding the user's lock runs turns for them
+                async with self.coordinator.user_lock(user_id) if self.coordinator else nullcontext():
+                    async with self._update_scope():
+                        while self._pending_messages.get(user_id):
+                            chat_id, user_message, received_at = self._next_turn(user_id)
+                            await self._process_turn(context, chat_id, user_id, user_name, user_message,
+                                                     received_at)
+        except UserLockTimeout as e:
+            self.logger.warning(f"Dropping messages from user {user_id}: {str(e)}")
+            TURNS.inc(outcome="busy")
+            self._pending_messages.pop(user_id, None)
+            try:
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text="⏳ The bot is busy right now. Please try again in a moment."
+                )
+            except Exception as send_error:
+                self.logger.error(f"Failed to send busy message: {send_error}")
+        finally:
+            self._active_users.discard(user_id)
+    
+    def _update_scope(self):
+        """Share one database connection between the turns' database calls"""
+        db_service = self.thread_manager.db_service
+        return db_service.update_scope() if db_service is not None else nullcontext()
+    
+    def _next_turn(self, user_id: int) -> Tuple[int, str, float]:
+        """
+        Take the user's queued messages for the next turn
+        
+        Consecutive messages from the same chat are coalesced into a single turn.
+        
+        Args:
+            user_id: Telegram user ID
+            
+        Returns:
+            Tuple of chat ID, combined message text and the time the first message was received
+        """
+        pending = self._pending_messages[user_id]
+        chat_id = pending[0][0]
+        
+        count = 1
+        while count < len(pending) and pending[count][0] == chat_id:
+            count += 1
+        
+        messages = [text for _, text, _ in pending[:count]]
+        received_at = pending[0][2]
+        del pending[:count]
+        if not pending:
+            del self._pending_messages[user_id]
+        
+        if count > 1:
+            self.coalesced_messages += count - 1
+            self.logger.info(f"Coalesced {count} messages from user {user_id} into one turn")
+        return chat_id, "\n\n".join(messages), received_at
+    
+    @traced("process_turn")
+    async def _process_turn(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int,
+                            user_name: str, user_message: str, received_at: float) -> None:
+        """
+        Run one assistant turn for a user and reply in the chat
+        
+        Args:
+            context: Telegram bot context
+            chat_id: Chat to reply in
+            user_id: Telegram user ID
+            user_name: User's full name
+            user_message: The (possibly coalesced) user message
+            received_at: Event loop time the first of the messages was received
+        """
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
         try:
             # Send typing indicator to show bot is processing
-            await context.bot.send_chat_action(chat_id=chat_id, action="typing")
+            with telegram_call("send_chat_action"):
+                await context.bot.send_chat_action(chat_id=chat_id, action="typing")
             
             # Get or create thread for this user to maintain context
-            thread_id = self.thread_manager.get_or_create_thread(user_id)
+            thread_id = await self.thread_manager.get_or_create_thread(user_id)
             
-            # Get response from OpenAI Assistant with persistent context
-            response = await self.openai_service.get_assistant_response(user_message, thread_id)
+            # Wait for capacity so traffic spikes don't fan out unbounded runs to OpenAI
+            async with self.admission.admit(estimate_tokens(user_message, self.config.ESTIMATED_RESPONSE_TOKENS)):
+                if self.config.ENABLE_STREAMING:
+                    # Stream the response into a message that is edited as text arrives
+                    response = await self._stream_response(context, chat_id, user_message, thread_id)
+                else:
+                    # Get response from OpenAI Assistant with persistent context
+                    response = await self.openai_service.get_assistant_response(user_message, thread_id)
+                    
+                    # Send response back to user
+                    with telegram_call("send_message"):
+                        await context.bot.send_message(chat_id=chat_id, text=response)
             
-            # Send response back to user
-            await context.bot.send_message(chat_id=chat_id, text=response)
+            REPLY_LATENCY_SECONDS.observe(loop.time() - received_at)
+            TURNS.inc(outcome="replied")
             
             # Log the conversation
-            self.logging_service.log_conversation(user_id, user_name, user_message, response)
+            response_time = int((loop.time() - start_time) * 1000)
+            self.logging_service.log_conversation(user_id, user_name, user_message, response,
+                                                  thread_id=thread_id, response_time=response_time)
+            if self.stats:
+                self.stats.record_conversation(response_time)
             
             self.logger.info(f"Successfully sent response to user {user_id} in chat {chat_id}")
             
+        except AdmissionRejected as e:
+            TURNS.inc(outcome="rejected")
+            self.logger.warning(f"Rejected message from user {user_id}: {str(e)}")
+            try:
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text="⏳ The bot is busy right now. Please try again in a moment."
+                )
+            except Exception as send_error:
+                self.logger.error(f"Failed to send busy message: {send_error}")
+                
         except Exception as e:
+            TURNS.inc(outcome="failed")
             error_message = f"❌ Błąd: {str(e)}"
             try:
                 await context.bot.send_message(chat_id=chat_id, text=error_message)
@@ -75,6 +302,32 @@ class BotHandler:
             
             self.logger.error(f"Error handling message from user {user_id}: {str(e)}", exc_info=True)
     
+    async def _stream_response(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int,
+                               user_message: str, thread_id: str) -> str:
+        """
+        Stream the assistant response to the chat with progressive message edits
+        
+        Args:
+            context: Telegram bot context
+            chat_id: Chat to reply in
+            user_message: The user's message
+            thread_id: Thread ID for context persistence
+            
+        Returns:
+            The complete response text
+        """
+        reply = StreamingReply(context.bot, chat_id, self.config.STREAM_EDIT_INTERVAL)
+        
+        with TRACER.span("stream_assistant_response"):
+            async for delta in self.openai_service.stream_assistant_response(user_message, thread_id):
+                await reply.append(delta)
+        
+        if not reply.text.strip():
+            raise Exception("No valid response content found")
+        
+        await reply.finish()
+        return reply.text
+    
     async def handle_error(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Handle errors in the bot
@@ -83,6 +336,7 @@ class BotHandler:
             update: The update that caused the error
             context: Telegram bot context
         """
+        HANDLER_ERRORS.inc()
         self.logger.error(f"Update {update} caused error: {context.error}")
         
         # If we have a chat_id, send error message to user
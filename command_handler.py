@@ -4,8 +4,11 @@ Handles special commands like /reset, /stats, etc.
 """
 
 import logging
+from typing import Optional
 from telegram import Update
 from telegram.ext import ContextTypes
+from admission_control import AdmissionController
+from stats_service import StatsService
 from thread_manager import ThreadManager
 from config import Config
 
@@ -13,9 +16,12 @@ from config import Config
 class CommandHandler:
     """Handles bot administrative commands"""
     
-    def __init__(self, config: Config, thread_manager: ThreadManager):
+    def __init__(self, config: Config, thread_manager: ThreadManager,
+                 admission: Optional[AdmissionController] = None, stats: Optional[StatsService] = None):
         self.config = config
         self.thread_manager = thread_manager
+        self.admission = admission
+        self.stats = stats
         self.logger = logging.getLogger(__name__)
     
     async def handle_reset(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -35,7 +41,7 @@ class CommandHandler:
             return
         
         # Clear user's thread
-        cleared = self.thread_manager.clear_user_thread(user_id)
+        cleared = await self.thread_manager.clear_user_thread(user_id)
         
         if cleared:
             await context.bot.send_message(
@@ -65,17 +71,44 @@ class CommandHandler:
             )
             return
         
-        # Get thread statistics
-        stats = self.thread_manager.get_thread_stats()
+        # Get thread statistics (cached counters, no database queries)
+        snapshot = self.stats.get_snapshot() if self.stats else None
+        if snapshot:
+            stats = {"active_users": snapshot["active_users"], "total_threads": snapshot["active_threads"]}
+        else:
+            stats = await self.thread_manager.get_thread_stats()
         
         stats_message = (
             f"📊 Bot Statistics:\n"
             f"• Active conversations: {stats['active_users']}\n"
-            f"• Total threads: {stats['total_threads']}\n"
+            f"• Total threads: {stats['total_threads']} (idle: {max(0, stats['total_threads'] - stats['active_users'])})\n"
             f"• CSV logging: {'✅' if self.config.ENABLE_CSV_LOGGING else '❌'}\n"
             f"• Sheets logging: {'✅' if self.config.ENABLE_SHEETS_LOGGING else '❌'}\n"
             f"• Whitelist: {'✅' if self.config.ALLOWED_USERS else '❌ (All users allowed)'}"
         )
         
+        if snapshot:
+            stats_message += (
+                f"\n• Conversations logged: {snapshot['total_conversations']} (users: {snapshot['total_users']})\n"
+                f"• Messages: {snapshot['messages_last_minute']}/min, {snapshot['messages_last_hour']}/hour\n"
+                f"• Response time: p50 {snapshot['latency_p50_ms']} ms, p95 {snapshot['latency_p95_ms']} ms, "
+                f"p99 {snapshot['latency_p99_ms']} ms"
+            )
+        
+        if self.admission:
+            metrics = self.admission.get_metrics()
+            stats_message += (
+                f"\n• Runs in flight: {metrics['in_flight']} (queued: {metrics['queue_depth']})\n"
+                f"• Queue wait: avg {metrics['avg_wait_ms']} ms, max {metrics['max_wait_ms']} ms\n"
+                f"• Rejected (busy): {metrics['rejected']}"
+            )
+        
+        if self.thread_manager.db_service is not None:
+            pool = self.thread_manager.db_service.get_pool_stats()
+            stats_message += (
+                f"\n• DB connections in use: {pool.get('checkedout', 'n/a')}\n"
+                f"• DB pool waits: {pool['waits']} (timeouts: {pool['timeouts']}, avg checkout {pool['avg_checkout_ms']} ms)"
+            )
+        
         await context.bot.send_message(chat_id=chat_id, text=stats_message)
         self.logger.info(f"Showed stats to user {user_id}")
\ No newline at end of file
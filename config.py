@@ -21,14 +21,143 @@ class Config:
         self.MAX_RETRIES: int = int(os.getenv("MAX_RETRIES", "3"))
         self.TIMEOUT_SECONDS: int = int(os.getenv("TIMEOUT_SECONDS", "60"))
         
+        # OpenAI HTTP connection pool configuration
+        self.OPENAI_MAX_CONNECTIONS: int = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+        self.OPENAI_MAX_KEEPALIVE: int = int(os.getenv("OPENAI_MAX_KEEPALIVE", "20"))
+        self.OPENAI_KEEPALIVE_EXPIRY: float = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "30"))
+        self.OPENAI_CONNECT_TIMEOUT: float = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+        self.OPENAI_REQUEST_TIMEOUT: float = float(os.getenv("OPENAI_REQUEST_TIMEOUT", "30"))
+        
+        # Number of Telegram updates processed concurrently
+        self.CONCURRENT_UPDATES: int = int(os.getenv("CONCURRENT_UPDATES", "64"))
+        
+        # Streaming replies: progressively edit one Telegram message as text arrives
+        self.ENABLE_STREAMING: bool = os.getenv("ENABLE_STREAMING", "true").lower() == "true"
+        self.STREAM_EDIT_INTERVAL: float = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+        
+        # Adaptive run status polling (used when streaming is disabled)
+        self.RUN_POLL_MIN_INTERVAL: float = float(os.getenv("RUN_POLL_MIN_INTERVAL", "0.25"))
+        self.RUN_POLL_MAX_INTERVAL: float = float(os.getenv("RUN_POLL_MAX_INTERVAL", "2.0"))
+        self.RUN_POLL_BACKOFF: float = float(os.getenv("RUN_POLL_BACKOFF", "1.5"))
+        self.RUN_POLL_JITTER: float = float(os.getenv("RUN_POLL_JITTER", "0.2"))
+        self.RUN_POLL_EARLY_FRACTION: float = float(os.getenv("RUN_POLL_EARLY_FRACTION", "0.8"))
+        self.RUN_MESSAGES_LIMIT: int = int(os.getenv("RUN_MESSAGES_LIMIT", "10"))
+        
+        # Use the asyncio database driver (asyncpg / aiosqlite) when it is installed
+        self.DB_ASYNC: bool = os.getenv("DB_ASYNC", "true").lower() == "true"
+        
+        # In-memory cache of user -> thread_id in front of the database
+        self.THREAD_CACHE_SIZE: int = int(os.getenv("THREAD_CACHE_SIZE", "10000"))
+        self.THREAD_CACHE_TTL: float = float(os.getenv("THREAD_CACHE_TTL", "3600"))
+        
+        # /stats counters: reconciled with storage periodically, snapshots cached briefly
+        self.STATS_RECONCILE_INTERVAL: float = float(os.getenv("STATS_RECONCILE_INTERVAL", "300"))
+        self.STATS_CACHE_TTL: float = float(os.getenv("STATS_CACHE_TTL", "5"))
+        self.STATS_LATENCY_SAMPLES: int = int(os.getenv("STATS_LATENCY_SAMPLES", "1000"))
+        
+        # Seconds between bulk writes of users' last_seen to the database
+        self.USER_TOUCH_INTERVAL: float = float(os.getenv("USER_TOUCH_INTERVAL", "30"))
+        
+        # Thread lifecycle: start a new thread after THREAD_IDLE_TTL seconds of inactivity (0 never expires)
+        self.THREAD_IDLE_TTL: float = float(os.getenv("THREAD_IDLE_TTL", "0"))
+        self.THREAD_ACTIVE_WINDOW: float = float(os.getenv("THREAD_ACTIVE_WINDOW", "3600"))
+        self.THREAD_SWEEP_INTERVAL: float = float(os.getenv("THREAD_SWEEP_INTERVAL", "300"))
+        
+        # Several instances behind a load balancer (webhook mode): skip redelivered updates and
+        # let one instance at a time handle each user, coordinating through the database
+        self.MULTI_INSTANCE: bool = os.getenv("MULTI_INSTANCE", "false").lower() == "true"
+        self.INSTANCE_ID: str = os.getenv("INSTANCE_ID", "")
+        self.UPDATE_DEDUP_TTL: float = float(os.getenv("UPDATE_DEDUP_TTL", "86400"))
+        self.USER_LOCK_TTL: float = float(os.getenv("USER_LOCK_TTL", "120"))
+        self.USER_LOCK_WAIT: float = float(os.getenv("USER_LOCK_WAIT", "300"))
+        
+        # Polling mode: the instance holding the leader lock ("file", "database" for a PostgreSQL
+        # advisory lock, or "auto") polls Telegram; with MULTI_INSTANCE and a database it fans
+        # updates out to all instances through the update queue
+        self.LEADER_ELECTION: bool = os.getenv("LEADER_ELECTION", "true").lower() == "true"
+        self.LEADER_LOCK: str = os.getenv("LEADER_LOCK", "auto")
+        self.LEADER_LOCK_FILE: str = os.getenv("LEADER_LOCK_FILE", "bot_polling.lock")
+        self.LEADER_RETRY_INTERVAL: float = float(os.getenv("LEADER_RETRY_INTERVAL", "5"))
+        self.LEADER_CHECK_INTERVAL: float = float(os.getenv("LEADER_CHECK_INTERVAL", "10"))
+        self.UPDATE_QUEUE_BATCH: int = int(os.getenv("UPDATE_QUEUE_BATCH", "50"))
+        self.UPDATE_QUEUE_POLL_INTERVAL: float = float(os.getenv("UPDATE_QUEUE_POLL_INTERVAL", "0.5"))
+        self.UPDATE_QUEUE_VISIBILITY_TIMEOUT: float = float(os.getenv("UPDATE_QUEUE_VISIBILITY_TIMEOUT", "600"))
+        
+        # Webhook ingress: updates are acknowledged once queued ("memory" or the shared "database"
+        # queue) and handled by WEBHOOK_WORKERS workers; requests must carry WEBHOOK_SECRET if set
+        self.WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")
+        self.WEBHOOK_QUEUE: str = os.getenv("WEBHOOK_QUEUE", "memory")
+        self.WEBHOOK_QUEUE_SIZE: int = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+        self.WEBHOOK_WORKERS: int = int(os.getenv("WEBHOOK_WORKERS", "64"))
+        self.UPDATE_SHUTDOWN_TIMEOUT: float = float(os.getenv("UPDATE_SHUTDOWN_TIMEOUT", "30"))
+        
+        # Prometheus metrics at /metrics: on the webhook port, or on METRICS_PORT in polling mode (0 disables)
+        self.ENABLE_METRICS: bool = os.getenv("ENABLE_METRICS", "true").lower() == "true"
+        self.METRICS_PORT: int = int(os.getenv("METRICS_PORT", "9090"))
+        
+        # Tracing: a span tree is recorded for TRACE_SAMPLE_RATE of updates (plus, when set, every update
+        # slower than TRACE_SLOW_THRESHOLD seconds) and exported to TRACE_EXPORTER ("file", "otlp" or "none")
+        self.TRACE_SAMPLE_RATE: float = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+        self.TRACE_SLOW_THRESHOLD: float = float(os.getenv("TRACE_SLOW_THRESHOLD", "0"))
+        self.TRACE_EXPORTER: str = os.getenv("TRACE_EXPORTER", "file")
+        self.TRACE_FILE: str = os.getenv("TRACE_FILE", "traces.jsonl")
+        self.TRACE_OTLP_ENDPOINT: str = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+        self.TRACE_EXPORT_INTERVAL: float = float(os.getenv("TRACE_EXPORT_INTERVAL", "5"))
+        
+        # user_threads.json persistence: debounced snapshots plus an append-only journal
+        self.THREADS_SAVE_DELAY: float = float(os.getenv("THREADS_SAVE_DELAY", "5"))
+        self.THREADS_JOURNAL: bool = os.getenv("THREADS_JOURNAL", "true").lower() == "true"
+        self.THREADS_JOURNAL_FSYNC: bool = os.getenv("THREADS_JOURNAL_FSYNC", "false").lower() == "true"
+        
+        # Admission control for assistant runs (0 disables a rate limit)
+        self.MAX_CONCURRENT_RUNS: int = int(os.getenv("MAX_CONCURRENT_RUNS", "32"))
+        self.MAX_QUEUE_DEPTH: int = int(os.getenv("MAX_QUEUE_DEPTH", "100"))
+        self.QUEUE_TIMEOUT_SECONDS: float = float(os.getenv("QUEUE_TIMEOUT_SECONDS", "30"))
+        self.RATE_LIMIT_RPM: int = int(os.getenv("RATE_LIMIT_RPM", "0"))
+        self.RATE_LIMIT_TPM: int = int(os.getenv("RATE_LIMIT_TPM", "0"))
+        self.ESTIMATED_RESPONSE_TOKENS: int = int(os.getenv("ESTIMATED_RESPONSE_TOKENS", "500"))
+        
         # New features configuration
         self.SHEET_NAME: str = os.getenv("SHEET_NAME", "SupportLogs")
         self.ALLOWED_USERS: list = self._parse_allowed_users(os.getenv("ALLOWED_USERS", ""))
         self.ENABLE_CSV_LOGGING: bool = os.getenv("ENABLE_CSV_LOGGING", "true").lower() == "true"
         self.ENABLE_SHEETS_LOGGING: bool = os.getenv("ENABLE_SHEETS_LOGGING", "true").lower() == "true"
+        self.ENABLE_DB_LOGGING: bool = os.getenv("ENABLE_DB_LOGGING", "true").lower() == "true"
         self.CREDENTIALS_FILE: str = os.getenv("CREDENTIALS_FILE", "credentials.json")
         self.GOOGLE_SERVICE_ACCOUNT_JSON: str = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON", "")
         
+        # CSV log rotation and archiving
+        self.CSV_LOG_FILE: str = os.getenv("CSV_LOG_FILE", "conversation_log.csv")
+        self.CSV_ARCHIVE_DIR: str = os.getenv("CSV_ARCHIVE_DIR", "log_archive")
+        self.CSV_MAX_BYTES: int = int(os.getenv("CSV_MAX_BYTES", str(50 * 1024 * 1024)))
+        self.CSV_ROTATE_PERIOD: str = os.getenv("CSV_ROTATE_PERIOD", "day")
+        self.CSV_COMPRESSION: str = os.getenv("CSV_COMPRESSION", "auto")
+        self.CSV_BUFFER_BYTES: int = int(os.getenv("CSV_BUFFER_BYTES", "65536"))
+        
+        # Background conversation logging
+        self.LOG_BATCH_SIZE: int = int(os.getenv("LOG_BATCH_SIZE", "50"))
+        self.LOG_FLUSH_INTERVAL: float = float(os.getenv("LOG_FLUSH_INTERVAL", "2.0"))
+        self.LOG_QUEUE_MAX_SIZE: int = int(os.getenv("LOG_QUEUE_MAX_SIZE", "10000"))
+        self.LOG_MAX_RETRIES: int = int(os.getenv("LOG_MAX_RETRIES", "3"))
+        self.LOG_SHUTDOWN_TIMEOUT: float = float(os.getenv("LOG_SHUTDOWN_TIMEOUT", "10"))
+        
+        # Retention: conversations older than RETENTION_DAYS move from the database to
+        # daily archive files, which are kept for ARCHIVE_RETENTION_DAYS (0 keeps forever)
+        self.RETENTION_DAYS: int = int(os.getenv("RETENTION_DAYS", "0"))
+        self.ARCHIVE_RETENTION_DAYS: int = int(os.getenv("ARCHIVE_RETENTION_DAYS", "0"))
+        self.RETENTION_ARCHIVE_DIR: str = os.getenv("RETENTION_ARCHIVE_DIR", "conversation_archive")
+        self.RETENTION_BATCH_SIZE: int = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+        self.RETENTION_BATCH_PAUSE: float = float(os.getenv("RETENTION_BATCH_PAUSE", "0.1"))
+        self.RETENTION_INTERVAL: float = float(os.getenv("RETENTION_INTERVAL", "3600"))
+        
+        # Google Sheets bulk writes; unsent rows are kept in a local spool file
+        self.SHEETS_SPOOL_FILE: str = os.getenv("SHEETS_SPOOL_FILE", "sheets_spool.jsonl")
+        self.SHEETS_MIN_BATCH: int = int(os.getenv("SHEETS_MIN_BATCH", "10"))
+        self.SHEETS_MAX_BATCH: int = int(os.getenv("SHEETS_MAX_BATCH", "500"))
+        self.SHEETS_MAX_DELAY: float = float(os.getenv("SHEETS_MAX_DELAY", "10"))
+        self.SHEETS_MAX_BACKOFF: float = float(os.getenv("SHEETS_MAX_BACKOFF", "120"))
+        self.SHEETS_SPOOL_MAX_ROWS: int = int(os.getenv("SHEETS_SPOOL_MAX_ROWS", "100000"))
+        
         # Deployment configuration
         self.ENVIRONMENT: str = os.getenv("ENVIRONMENT", "development")
         self.PORT: int = int(os.getenv("PORT", "8080"))
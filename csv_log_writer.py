@@ -0,0 +1,255 @@
+"""
+Rotating CSV writer for conversation logs
+Keeps the active log file open, rotates it by size and time period and
+compresses rotated segments, recording their time ranges in an index
+"""
+
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import threading
+from typing import IO, Dict, Iterator, List, Optional
+from config import Config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CSV_HEADER = ["Timestamp", "User ID", "User Name", "Question", "Answer"]
+
+# Length of the timestamp prefix ("%Y-%m-%d %H:%M:%S") identifying a rotation period
+ROTATE_PERIOD_PREFIX = {"day": 10, "hour": 13}
+
+
+class RotatingCsvWriter:
+    """Buffered CSV writer with size/period based rotation and compressed archives"""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.log_file = config.CSV_LOG_FILE
+        self.archive_dir = config.CSV_ARCHIVE_DIR
+        self.index_file = os.path.join(self.archive_dir, "index.json")
+        self.compression = self._resolve_compression(config.CSV_COMPRESSION)
+        self._period_prefix = ROTATE_PERIOD_PREFIX.get(config.CSV_ROTATE_PERIOD, ROTATE_PERIOD_PREFIX["day"])
+        self._lock = threading.Lock()
+
+        self._file: Optional[IO[str]] = None
+        self._writer = None
+        self._first_timestamp: Optional[str] = None
+        self._last_timestamp: Optional[str] = None
+        self._rows = 0
+
+    def _resolve_compression(self, compression: str) -> str:
+        """Pick the archive compression, falling back to gzip when zstd is unavailable"""
+        if compression in ("zstd", "auto"):
+            if zstandard is not None:
+                return "zstd"
+            if compression == "zstd":
+                self.logger.warning("zstandard is not installed, compressing CSV archives with gzip")
+            return "gzip"
+        return compression if compression in ("gzip", "none") else "gzip"
+
+    def _open(self) -> None:
+        """Open the active log file, writing the header if it is new"""
+        is_new = not os.path.exists(self.log_file) or os.path.getsize(self.log_file) == 0
+        if not is_new:
+            self._scan_active_file()
+
+        self._file = open(self.log_file, mode="a", encoding="utf-8", newline='',
+                          buffering=self.config.CSV_BUFFER_BYTES)
+        self._writer = csv.writer(self._file)
+        if is_new:
+            self._writer.writerow(CSV_HEADER)
+            self._file.flush()
+            self.logger.info("Created CSV log file with headers")
+
+    def _scan_active_file(self) -> None:
+        """Recover the time range and row count of an existing active file"""
+        with open(self.log_file, mode="r", encoding="utf-8", newline='') as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            for row in reader:
+                if not row:
+                    continue
+                if self._first_timestamp is None:
+                    self._first_timestamp = row[0]
+                self._last_timestamp = row[0]
+                self._rows += 1
+
+    def write(self, rows: List[list]) -> None:
+        """
+        Append rows to the active log file, rotating it when needed
+
+        Args:
+            rows: Rows starting with a "%Y-%m-%d %H:%M:%S" timestamp
+        """
+        with self._lock:
+            if self._file is None:
+                self._open()
+
+            for row in rows:
+                if self._needs_rotation(row[0]):
+                    self._rotate()
+                self._writer.writerow(row)
+                if self._first_timestamp is None:
+                    self._first_timestamp = row[0]
+                self._last_timestamp = row[0]
+                self._rows += 1
+
+            self._file.flush()
+
+    def _needs_rotation(self, timestamp: str) -> bool:
+        """Check whether the active file is full or belongs to an earlier period"""
+        if self._first_timestamp is None:
+            return False
+        if self._first_timestamp[:self._period_prefix] != timestamp[:self._period_prefix]:
+            return True
+        return self._file.tell() >= self.config.CSV_MAX_BYTES
+
+    def _rotate(self) -> None:
+        """Close the active file, archive it and start a new one"""
+        self._file.close()
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        start = self._first_timestamp.replace(" ", "T").replace(":", "")
+        end = self._last_timestamp.replace(" ", "T").replace(":", "")
+        segment_path = os.path.join(self.archive_dir, f"conversation_log_{start}_{end}.csv")
+        suffix = 1
+        while any(os.path.exists(segment_path + ext) for ext in ("", ".gz", ".zst")):
+            segment_path = os.path.join(self.archive_dir, f"conversation_log_{start}_{end}_{suffix}.csv")
+            suffix += 1
+        os.replace(self.log_file, segment_path)
+
+        archive_path = self._compress(segment_path)
+        self._add_to_index({
+            "file": os.path.basename(archive_path),
+            "start": self._first_timestamp,
+            "end": self._last_timestamp,
+            "rows": self._rows,
+            "compression": self.compression
+        })
+        self.logger.info(f"Rotated CSV log to {archive_path} ({self._rows} rows)")
+
+        self._first_timestamp = None
+        self._last_timestamp = None
+        self._rows = 0
+        self._open()
+
+    def _compress(self, path: str) -> str:
+        """Compress a rotated segment, returning the archive path"""
+        if self.compression == "none":
+            return path
+
+        if self.compression == "zstd":
+            archive_path = f"{path}.zst"
+            with open(path, "rb") as src, open(archive_path, "wb") as dst:
+                zstandard.ZstdCompressor(level=10).copy_stream(src, dst)
+        else:
+            archive_path = f"{path}.gz"
+            with open(path, "rb") as src, gzip.open(archive_path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+        os.remove(path)
+        return archive_path
+
+    def load_index(self) -> List[Dict]:
+        """Get the archived segments with their time ranges"""
+        if not os.path.exists(self.index_file):
+            return []
+        with open(self.index_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _add_to_index(self, segment: Dict) -> None:
+        """Atomically append a segment to the archive index"""
+        index = self.load_index()
+        index.append(segment)
+        self._write_index(index)
+
+    def _write_index(self, index: List[Dict]) -> None:
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_file, self.index_file)
+
+    def prune_archives(self, before: str) -> int:
+        """
+        Delete archived segments whose newest row is older than a timestamp
+
+        Args:
+            before: Timestamp or prefix, e.g. "2025-01-31"
+
+        Returns:
+            Number of segments deleted
+        """
+        with self._lock:
+            index = self.load_index()
+            expired = [segment for segment in index if segment["end"][:len(before)] < before]
+            if not expired:
+                return 0
+            # Update the index first so it never lists a missing file
+            self._write_index([segment for segment in index if segment not in expired])
+            for segment in expired:
+                path = os.path.join(self.archive_dir, segment["file"])
+                if os.path.exists(path):
+                    os.remove(path)
+        self.logger.info(f"Deleted {len(expired)} CSV log segments older than {before}")
+        return len(expired)
+
+    def read_rows(self, start: str, end: str) -> Iterator[List[str]]:
+        """
+        Read logged rows in a time range, opening only the segments that overlap it
+
+        Args:
+            start: Inclusive start timestamp or prefix, e.g. "2025-01-31"
+            end: Inclusive end timestamp or prefix, e.g. "2025-01-31"
+
+        Yields:
+            CSV rows (without header) whose timestamp lies in the range
+        """
+        # Compare prefixes so that a date matches every timestamp on that day
+        def in_range(timestamp: str) -> bool:
+            return start <= timestamp[:len(start)] and timestamp[:len(end)] <= end
+
+        paths = [
+            os.path.join(self.archive_dir, segment["file"])
+            for segment in self.load_index()
+            if segment["start"][:len(end)] <= end and start <= segment["end"][:len(start)]
+        ]
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+        if os.path.exists(self.log_file):
+            paths.append(self.log_file)
+
+        for path in paths:
+            with self._open_segment(path) as file:
+                reader = csv.reader(file)
+                next(reader, None)
+                for row in reader:
+                    if row and in_range(row[0]):
+                        yield row
+
+    def _open_segment(self, path: str) -> IO[str]:
+        """Open a plain or compressed segment for reading"""
+        if path.endswith(".gz"):
+            return gzip.open(path, "rt", encoding="utf-8", newline='')
+        if path.endswith(".zst"):
+            if zstandard is None:
+                raise RuntimeError(f"zstandard is required to read {path}")
+            return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True),
+                                    encoding="utf-8", newline='')
+        return open(path, "r", encoding="utf-8", newline='')
+
+    def close(self) -> None:
+        """Flush and close the active log file"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._writer = None
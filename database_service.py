@@ -3,182 +3,587 @@ Database service for the Telegram bot
 Handles all database operations including conversation logging and thread management
 """
 
+import asyncio
 import logging
-from datetime import datetime
-from typing import Optional, List, Dict
-from models import DatabaseManager, User, ConversationLog, UserThread
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Optional, List, Dict
+from sqlalchemy import delete, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from migrations import create_upcoming_partitions, migrate
+from models import (DatabaseManager, User, ConversationLog, UserThread, ProcessedUpdate, UserLock, QueuedUpdate,
+                    UpdateConnection, _current_update, insert_ignore_statement, upsert_statement)
+
+# Columns refreshed when a known user is upserted
+USER_UPDATE_COLUMNS = ["username", "first_name", "last_name", "last_seen"]
+
+def conversation_row(conv: ConversationLog) -> Dict:
+    """Get all column values of a logged conversation"""
+    return {column.name: getattr(conv, column.name) for column in ConversationLog.__table__.columns}
+
+def conversation_summary(conv: ConversationLog) -> Dict:
+    """Summarize a logged conversation for display"""
+    return {
+        'user_id': conv.user_id,
+        'user_name': conv.user_name,
+        'question': conv.question[:100] + '...' if len(conv.question) > 100 else conv.question,
+        'timestamp': conv.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        'thread_id': conv.thread_id
+    }
 
 class DatabaseService:
     """Service for handling all database operations"""
     
-    def __init__(self):
+    def __init__(self, db_manager: Optional[DatabaseManager] = None):
+        """
+        Args:
+            db_manager: Sessions to run the queries in; AsyncDatabaseService passes one for its
+                async engine and migrates it itself. By default DATABASE_URL is connected and migrated.
+        """
         self.logger = logging.getLogger(__name__)
+        if db_manager is not None:
+            self.db_manager = db_manager
+            return
         try:
             self.db_manager = DatabaseManager()
+            with self.db_manager.engine.begin() as connection:
+                migrate(connection)
             self.logger.info("Database connection established")
         except Exception as e:
             self.logger.error(f"Failed to connect to database: {e}")
             raise
     
+    def close(self) -> None:
+        """Dispose of the connection pool"""
+        self.db_manager.engine.dispose()
+    
+    async def call(self, method: str, *args) -> Any:
+        """
+        Run a service method in a worker thread, so the event loop isn't blocked
+        
+        Args:
+            method: Name of the method, e.g. "get_user_thread"
+            *args: Its arguments
+            
+        Returns:
+            What the method returns
+        """
+        connection = _current_update.get()
+        if connection is None:
+            return await asyncio.to_thread(getattr(self, method), *args)
+        connection.begin_call()
+        try:
+            return await asyncio.to_thread(getattr(self, method), *args)
+        finally:
+            connection.end_call()
+    
+    def session_scope(self):
+        """
+        Share one session across several service calls, e.g. for one Telegram update
+        
+        Usage:
+            with db_service.session_scope():
+                db_service.get_user_thread(user_id)
+                db_service.log_conversation(...)
+        """
+        return self.db_manager.session_scope()
+    
+    @asynccontextmanager
+    async def update_scope(self) -> AsyncIterator[None]:
+        """
+        Share one pooled connection between the service calls made while handling an update
+        
+        Calls run in worker threads from the block inherit the scope. The connection is
+        checked out by the first call and returned to the pool once no call has used it
+        for UPDATE_CONNECTION_IDLE_SECONDS, so it isn't held while the update waits on
+        OpenAI, and at the latest when the block exits.
+        """
+        connection = UpdateConnection(self.db_manager.engine)
+        token = _current_update.set(connection)
+        try:
+            yield
+        finally:
+            _current_update.reset(token)
+            await asyncio.to_thread(connection.release)
+    
+    def get_pool_stats(self) -> Dict[str, float]:
+        """Get connection pool statistics"""
+        return self.db_manager.get_pool_stats()
+    
     def create_or_update_user(self, telegram_id: int, username: str = None, 
                              first_name: str = None, last_name: str = None) -> None:
         """Create or update user in database"""
-        session = self.db_manager.get_session()
         try:
-            user = session.query(User).filter(User.telegram_id == telegram_id).first()
-            
-            if user:
-                # Update existing user
-                user.username = username
-                user.first_name = first_name
-                user.last_name = last_name
-                user.last_seen = datetime.utcnow()
-            else:
-                # Create new user
-                user = User(
-                    telegram_id=telegram_id,
-                    username=username,
-                    first_name=first_name,
-                    last_name=last_name,
-                    is_authorized=True
-                )
-                session.add(user)
+            with self.db_manager.session_scope() as session:
+                statement = upsert_statement(self.db_manager.engine.dialect.name, User, [{
+                    'telegram_id': telegram_id,
+                    'username': username,
+                    'first_name': first_name,
+                    'last_name': last_name,
+                    'is_authorized': True,
+                    'last_seen': datetime.utcnow()
+                }], ['telegram_id'], USER_UPDATE_COLUMNS)
+                
+                if statement is not None:
+                    # Single round-trip that cannot race with a concurrent insert for the same user
+                    session.execute(statement)
+                else:
+                    user = session.query(User).filter(User.telegram_id == telegram_id).first()
+                    
+                    if user:
+                        # Update existing user
+                        user.username = username
+                        user.first_name = first_name
+                        user.last_name = last_name
+                        user.last_seen = datetime.utcnow()
+                    else:
+                        # Create new user
+                        user = User(
+                            telegram_id=telegram_id,
+                            username=username,
+                            first_name=first_name,
+                            last_name=last_name,
+                            is_authorized=True
+                        )
+                        session.add(user)
             
-            session.commit()
             self.logger.debug(f"User {telegram_id} created/updated in database")
             
         except Exception as e:
-            session.rollback()
             self.logger.error(f"Failed to create/update user {telegram_id}: {e}")
-        finally:
-            self.db_manager.close_session(session)
+    
+    def upsert_users(self, users: List[Dict]) -> int:
+        """
+        Create or update many users with one statement
+        
+        Args:
+            users: User column values (telegram_id, username, first_name, last_name, last_seen),
+                at most one entry per telegram_id
+                
+        Returns:
+            Number of users that didn't exist before
+            
+        Raises:
+            Exception: If the write fails
+        """
+        if not users:
+            return 0
+        rows = [dict(user, is_authorized=True) for user in users]
+        telegram_ids = [user['telegram_id'] for user in users]
+        with self.db_manager.session_scope() as session:
+            existing = session.execute(
+                select(func.count()).select_from(User).where(User.telegram_id.in_(telegram_ids))
+            ).scalar()
+            statement = upsert_statement(self.db_manager.engine.dialect.name, User, rows,
+                                         ['telegram_id'], USER_UPDATE_COLUMNS)
+            if statement is None:
+                # No native upsert; fall back to one read-modify-write per user in this transaction
+                for user in users:
+                    self.create_or_update_user(user['telegram_id'], user.get('username'),
+                                               user.get('first_name'), user.get('last_name'))
+                return len(users) - existing
+            session.execute(statement)
+        return len(users) - existing
+    
+    def touch_users(self, telegram_ids: List[int], seen_at: datetime) -> None:
+        """
+        Set last_seen for many users with one UPDATE
+        
+        Args:
+            telegram_ids: Users seen since the last touch
+            seen_at: Time to record as last seen
+            
+        Raises:
+            Exception: If the write fails
+        """
+        if not telegram_ids:
+            return
+        with self.db_manager.session_scope() as session:
+            session.execute(update(User).where(User.telegram_id.in_(telegram_ids)).values(last_seen=seen_at))
     
     def log_conversation(self, user_id: int, user_name: str, question: str, 
                         answer: str, thread_id: str = None, response_time: int = None) -> None:
         """Log conversation to database"""
-        session = self.db_manager.get_session()
         try:
-            conversation = ConversationLog(
-                user_id=user_id,
-                user_name=user_name,
-                question=question,
-                answer=answer,
-                thread_id=thread_id,
-                response_time=response_time
-            )
-            session.add(conversation)
-            session.commit()
+            with self.db_manager.session_scope() as session:
+                conversation = ConversationLog(
+                    user_id=user_id,
+                    user_name=user_name,
+                    question=question,
+                    answer=answer,
+                    thread_id=thread_id,
+                    response_time=response_time
+                )
+                session.add(conversation)
             self.logger.debug(f"Conversation logged for user {user_id}")
             
         except Exception as e:
-            session.rollback()
             self.logger.error(f"Failed to log conversation for user {user_id}: {e}")
-        finally:
-            self.db_manager.close_session(session)
+    
+    def log_conversations(self, rows: List[Dict]) -> None:
+        """
+        Bulk insert conversations in one transaction
+        
+        Args:
+            rows: ConversationLog column values, one dict per conversation
+            
+        Raises:
+            Exception: If the insert fails, so the caller can retry the batch
+        """
+        if not rows:
+            return
+        with self.db_manager.session_scope() as session:
+            # A single executemany; drivers send it as multi-row INSERT batches
+            session.execute(insert(ConversationLog), rows)
+        self.logger.debug(f"Logged {len(rows)} conversations to database")
     
     def get_user_thread(self, user_id: int) -> Optional[str]:
         """Get thread ID for user"""
-        session = self.db_manager.get_session()
         try:
-            user_thread = session.query(UserThread).filter(UserThread.user_id == user_id).first()
-            return user_thread.thread_id if user_thread else None
-            
+            with self.db_manager.session_scope() as session:
+                user_thread = session.query(UserThread).filter(UserThread.user_id == user_id).first()
+                return user_thread.thread_id if user_thread else None
+                
         except Exception as e:
             self.logger.error(f"Failed to get thread for user {user_id}: {e}")
             return None
-        finally:
-            self.db_manager.close_session(session)
     
     def create_user_thread(self, user_id: int, thread_id: str) -> None:
         """Create or update user thread"""
-        session = self.db_manager.get_session()
         try:
-            user_thread = session.query(UserThread).filter(UserThread.user_id == user_id).first()
-            
-            if user_thread:
-                # Update existing thread
-                user_thread.thread_id = thread_id
-                user_thread.updated_at = datetime.utcnow()
-            else:
-                # Create new thread
-                user_thread = UserThread(
-                    user_id=user_id,
-                    thread_id=thread_id
-                )
-                session.add(user_thread)
+            with self.db_manager.session_scope() as session:
+                now = datetime.utcnow()
+                statement = upsert_statement(self.db_manager.engine.dialect.name, UserThread, [{
+                    'user_id': user_id,
+                    'thread_id': thread_id,
+                    'updated_at': now,
+                    'last_used_at': now
+                }], ['user_id'], ['thread_id', 'updated_at', 'last_used_at'])
+                
+                if statement is not None:
+                    session.execute(statement)
+                else:
+                    user_thread = session.query(UserThread).filter(UserThread.user_id == user_id).first()
+                    
+                    if user_thread:
+                        # Update existing thread
+                        user_thread.thread_id = thread_id
+                        user_thread.updated_at = now
+                        user_thread.last_used_at = now
+                    else:
+                        # Create new thread
+                        user_thread = UserThread(
+                            user_id=user_id,
+                            thread_id=thread_id
+                        )
+                        session.add(user_thread)
             
-            session.commit()
             self.logger.debug(f"Thread {thread_id} created/updated for user {user_id}")
             
         except Exception as e:
-            session.rollback()
             self.logger.error(f"Failed to create/update thread for user {user_id}: {e}")
-        finally:
-            self.db_manager.close_session(session)
     
     def clear_user_thread(self, user_id: int) -> bool:
         """Clear thread for user"""
-        session = self.db_manager.get_session()
         try:
-            user_thread = session.query(UserThread).filter(UserThread.user_id == user_id).first()
-            
-            if user_thread:
-                session.delete(user_thread)
-                session.commit()
-                self.logger.debug(f"Thread cleared for user {user_id}")
-                return True
-            else:
-                return False
+            with self.db_manager.session_scope() as session:
+                user_thread = session.query(UserThread).filter(UserThread.user_id == user_id).first()
                 
+                if user_thread:
+                    session.delete(user_thread)
+                    self.logger.debug(f"Thread cleared for user {user_id}")
+                    return True
+                else:
+                    return False
+                    
         except Exception as e:
-            session.rollback()
             self.logger.error(f"Failed to clear thread for user {user_id}: {e}")
             return False
-        finally:
-            self.db_manager.close_session(session)
     
     def get_conversation_stats(self) -> Dict[str, int]:
         """Get conversation statistics"""
-        session = self.db_manager.get_session()
         try:
-            total_conversations = session.query(ConversationLog).count()
-            total_users = session.query(User).count()
-            active_threads = session.query(UserThread).count()
-            
-            return {
-                'total_conversations': total_conversations,
-                'total_users': total_users,
-                'active_threads': active_threads
-            }
-            
+            with self.db_manager.session_scope() as session:
+                total_conversations = session.query(ConversationLog).count()
+                total_users = session.query(User).count()
+                active_threads = session.query(UserThread).count()
+                
+                return {
+                    'total_conversations': total_conversations,
+                    'total_users': total_users,
+                    'active_threads': active_threads
+                }
+                
         except Exception as e:
             self.logger.error(f"Failed to get conversation stats: {e}")
             return {'total_conversations': 0, 'total_users': 0, 'active_threads': 0}
-        finally:
-            self.db_manager.close_session(session)
     
     def get_recent_conversations(self, limit: int = 10) -> List[Dict]:
         """Get recent conversations"""
-        session = self.db_manager.get_session()
         try:
+            with self.db_manager.session_scope() as session:
+                conversations = session.query(ConversationLog)\
+                    .order_by(ConversationLog.timestamp.desc())\
+                    .limit(limit)\
+                    .all()
+                
+                return [conversation_summary(conv) for conv in conversations]
+                
+        except Exception as e:
+            self.logger.error(f"Failed to get recent conversations: {e}")
+            return []
+    
+    def get_user_conversations(self, user_id: int, limit: int = 20) -> List[Dict]:
+        """Get a user's most recent conversations"""
+        try:
+            with self.db_manager.session_scope() as session:
+                conversations = session.query(ConversationLog)\
+                    .filter(ConversationLog.user_id == user_id)\
+                    .order_by(ConversationLog.timestamp.desc())\
+                    .limit(limit)\
+                    .all()
+                
+                return [conversation_summary(conv) for conv in conversations]
+                
+        except Exception as e:
+            self.logger.error(f"Failed to get conversations for user {user_id}: {e}")
+            return []
+    
+    def get_conversations_before(self, cutoff: datetime, limit: int) -> List[Dict]:
+        """
+        Get the oldest conversations logged before a time
+        
+        Args:
+            cutoff: Only conversations with an earlier timestamp are returned
+            limit: Maximum number of conversations
+            
+        Returns:
+            All column values of each conversation, oldest first
+            
+        Raises:
+            Exception: If the query fails
+        """
+        with self.db_manager.session_scope() as session:
             conversations = session.query(ConversationLog)\
-                .order_by(ConversationLog.timestamp.desc())\
+                .filter(ConversationLog.timestamp < cutoff)\
+                .order_by(ConversationLog.timestamp)\
                 .limit(limit)\
                 .all()
+            return [conversation_row(conv) for conv in conversations]
+    
+    def delete_conversations(self, ids: List[int]) -> int:
+        """
+        Delete conversations by ID in one transaction
+        
+        Raises:
+            Exception: If the delete fails
+        """
+        with self.db_manager.session_scope() as session:
+            result = session.execute(delete(ConversationLog).where(ConversationLog.id.in_(ids)))
+            return result.rowcount
+    
+    def create_log_partitions(self) -> None:
+        """
+        Create upcoming monthly conversation_logs partitions, if the table is partitioned
+        
+        Raises:
+            Exception: If the query fails
+        """
+        with self.db_manager.session_scope() as session:
+            create_upcoming_partitions(session.connection())
+    
+    def touch_user_threads(self, user_ids: List[int], used_at: datetime) -> None:
+        """
+        Set last_used_at for many users' threads with one UPDATE
+        
+        Raises:
+            Exception: If the write fails
+        """
+        if not user_ids:
+            return
+        with self.db_manager.session_scope() as session:
+            session.execute(update(UserThread).where(UserThread.user_id.in_(user_ids)).values(last_used_at=used_at))
+    
+    def delete_idle_threads(self, before: datetime, limit: int) -> List[int]:
+        """
+        Delete threads not used since a time
+        
+        Args:
+            before: Threads last used before this time are deleted
+            limit: Maximum number of threads to delete
             
-            return [
-                {
-                    'user_id': conv.user_id,
-                    'user_name': conv.user_name,
-                    'question': conv.question[:100] + '...' if len(conv.question) > 100 else conv.question,
-                    'timestamp': conv.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-                    'thread_id': conv.thread_id
-                }
-                for conv in conversations
-            ]
+        Returns:
+            IDs of the users whose threads were deleted
             
-        except Exception as e:
-            self.logger.error(f"Failed to get recent conversations: {e}")
-            return []
-        finally:
-            self.db_manager.close_session(session)
\ No newline at end of file
+        Raises:
+            Exception: If the delete fails
+        """
+        with self.db_manager.session_scope() as session:
+            user_ids = [row[0] for row in session.query(UserThread.user_id)
+                        .filter(UserThread.last_used_at < before)
+                        .limit(limit)
+                        .all()]
+            if user_ids:
+                session.execute(delete(UserThread).where(
+                    UserThread.user_id.in_(user_ids), UserThread.last_used_at < before
+                ))
+            return user_ids
+    
+    def claim_update(self, update_id: int, instance_id: str) -> bool:
+        """
+        Record that an instance is handling a Telegram update
+        
+        Args:
+            update_id: Telegram update ID
+            instance_id: Instance handling the update
+            
+        Returns:
+            True if no instance claimed the update before
+            
+        Raises:
+            Exception: If the write fails
+        """
+        row = {'update_id': update_id, 'instance_id': instance_id, 'processed_at': datetime.utcnow()}
+        statement = insert_ignore_statement(self.db_manager.engine.dialect.name, ProcessedUpdate, [row])
+        if statement is None:
+            try:
+                with self.db_manager.session_scope() as session:
+                    session.execute(insert(ProcessedUpdate).values(row))
+                return True
+            except IntegrityError:
+                return False
+        
+        with self.db_manager.session_scope() as session:
+            return session.execute(statement).rowcount > 0
+    
+    def delete_processed_updates(self, before: datetime) -> int:
+        """
+        Forget updates claimed before a time
+        
+        Raises:
+            Exception: If the delete fails
+        """
+        with self.db_manager.session_scope() as session:
+            result = session.execute(delete(ProcessedUpdate).where(ProcessedUpdate.processed_at < before))
+            return result.rowcount
+    
+    def acquire_user_lock(self, user_id: int, owner: str, ttl: float) -> bool:
+        """
+        Take or extend ownership of a user's messages
+        
+        Args:
+            user_id: Telegram user ID
+            owner: Instance taking the lock
+            ttl: Seconds until the lock expires unless extended again
+            
+        Returns:
+            True if the owner now holds the lock, False if another owner holds it
+            
+        Raises:
+            Exception: If the write fails
+        """
+        now = datetime.utcnow()
+        row = {'user_id': user_id, 'owner': owner, 'expires_at': now + timedelta(seconds=ttl)}
+        statement = upsert_statement(self.db_manager.engine.dialect.name, UserLock, [row], ['user_id'],
+                                     ['owner', 'expires_at'],
+                                     where=or_(UserLock.expires_at < now, UserLock.owner == owner))
+        
+        with self.db_manager.session_scope() as session:
+            if statement is not None:
+                return session.execute(statement).rowcount > 0
+            
+            lock = session.query(UserLock).filter(UserLock.user_id == user_id).with_for_update().first()
+            if lock is None:
+                session.add(UserLock(**row))
+            elif lock.expires_at < now or lock.owner == owner:
+                lock.owner = owner
+                lock.expires_at = row['expires_at']
+            else:
+                return False
+            return True
+    
+    def release_user_lock(self, user_id: int, owner: str) -> None:
+        """
+        Release a user's lock if the owner still holds it
+        
+        Raises:
+            Exception: If the delete fails
+        """
+        with self.db_manager.session_scope() as session:
+            session.execute(delete(UserLock).where(UserLock.user_id == user_id, UserLock.owner == owner))
+    
+    def enqueue_updates(self, rows: List[Dict]) -> None:
+        """
+        Add Telegram updates to the update queue, skipping ones already queued
+        
+        Args:
+            rows: Dicts with update_id and payload (the update as JSON)
+            
+        Raises:
+            Exception: If the write fails
+        """
+        if not rows:
+            return
+        statement = insert_ignore_statement(self.db_manager.engine.dialect.name, QueuedUpdate, rows)
+        with self.db_manager.session_scope() as session:
+            if statement is not None:
+                session.execute(statement)
+                return
+            
+            queued = {row[0] for row in session.query(QueuedUpdate.update_id)
+                      .filter(QueuedUpdate.update_id.in_([row['update_id'] for row in rows]))
+                      .all()}
+            new_rows = [row for row in rows if row['update_id'] not in queued]
+            if new_rows:
+                session.execute(insert(QueuedUpdate), new_rows)
+    
+    def claim_queued_updates(self, owner: str, limit: int, visibility_timeout: float) -> List[Dict]:
+        """
+        Claim the oldest unclaimed updates, and ones whose claim has expired
+        
+        Args:
+            owner: Instance claiming the updates
+            limit: Maximum number of updates to claim
+            visibility_timeout: Seconds before other instances may claim them again
+            
+        Returns:
+            Dicts with update_id and payload, oldest first
+            
+        Raises:
+            Exception: If the claim fails
+        """
+        now = datetime.utcnow()
+        claimable = (select(QueuedUpdate.update_id)
+                     .where(or_(QueuedUpdate.claimed_until.is_(None), QueuedUpdate.claimed_until < now))
+                     .order_by(QueuedUpdate.update_id)
+                     .limit(limit)
+                     .with_for_update(skip_locked=True))
+        statement = (update(QueuedUpdate)
+                     .where(QueuedUpdate.update_id.in_(claimable))
+                     .values(claimed_by=owner, claimed_until=now + timedelta(seconds=visibility_timeout))
+                     .returning(QueuedUpdate.update_id, QueuedUpdate.payload)
+                     .execution_options(synchronize_session=False))
+        with self.db_manager.session_scope() as session:
+            rows = session.execute(statement).all()
+        return [{'update_id': row.update_id, 'payload': row.payload} for row in sorted(rows)]
+    
+    def count_queued_updates(self) -> int:
+        """
+        Count updates waiting in or being handled from the update queue
+        
+        Raises:
+            Exception: If the query fails
+        """
+        with self.db_manager.session_scope() as session:
+            return session.query(QueuedUpdate).count()
+    
+    def delete_queued_updates(self, update_ids: List[int]) -> int:
+        """
+        Remove handled updates from the update queue
+        
+        Raises:
+            Exception: If the delete fails
+        """
+        with self.db_manager.session_scope() as session:
+            result = session.execute(delete(QueuedUpdate).where(QueuedUpdate.update_id.in_(update_ids)))
+            return result.rowcount
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Database benchmark for conversation logging
+Compares one transaction per conversation with the batched bulk-insert path
+used by the background log writer, and measures recent/per-user history
+query latency on a generated multi-million-row table with and without the
+conversation_logs indexes. Uses DB_BENCHMARK_URL, or a temporary SQLite
+database when it is not set (it writes test rows, so never point it at production)
+
+Usage:
+    python db_benchmark.py [inserts|queries]
+"""
+
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+from sqlalchemy import text
+from database_service import DatabaseService
+from models import ConversationLog
+
+INSERT_ROWS = int(os.getenv("DB_BENCHMARK_ROWS", "2000"))
+BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "50"))
+QUERY_TABLE_ROWS = int(os.getenv("DB_BENCHMARK_QUERY_ROWS", "2000000"))
+QUERY_USERS = 5000
+
+# Set-based generation of the query benchmark table (no Python round-trip per row)
+GENERATE_ROWS_SQL = {
+    "sqlite": """
+        WITH RECURSIVE seq(n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM seq WHERE n < :count - 1)
+        INSERT INTO conversation_logs (user_id, user_name, question, answer, timestamp, thread_id, response_time)
+        SELECT 1000 + n % :users, 'User ' || (n % :users), 'Question ' || n || '?', 'Answer ' || n,
+               strftime('%Y-%m-%d %H:%M:%f', 'now', '-' || (n * 3) || ' seconds'), 'thread_' || (n % :users), 1500
+        FROM seq
+    """,
+    "postgresql": """
+        INSERT INTO conversation_logs (user_id, user_name, question, answer, timestamp, thread_id, response_time)
+        SELECT 1000 + n % :users, 'User ' || (n % :users), 'Question ' || n || '?', 'Answer ' || n,
+               now() at time zone 'utc' - n * interval '3 seconds', 'thread_' || (n % :users), 1500
+        FROM generate_series(0, :count - 1) AS n
+    """,
+}
+
+
+def make_rows(count: int) -> List[Dict]:
+    """Generate conversation rows"""
+    now = datetime.utcnow()
+    return [
+        {
+            "user_id": 1000 + i % 100,
+            "user_name": f"User {i % 100}",
+            "question": f"Question {i}?",
+            "answer": f"Answer {i}. " * 20,
+            "thread_id": f"thread_{i % 100}",
+            "response_time": 1500,
+            "timestamp": now
+        }
+        for i in range(count)
+    ]
+
+
+def bench_single_inserts(db: DatabaseService, rows: List[Dict]) -> float:
+    """Insert rows one transaction at a time, return rows per second"""
+    start = time.perf_counter()
+    for row in rows:
+        db.log_conversation(row["user_id"], row["user_name"], row["question"], row["answer"],
+                            row["thread_id"], row["response_time"])
+    return len(rows) / (time.perf_counter() - start)
+
+
+def bench_bulk_inserts(db: DatabaseService, rows: List[Dict]) -> float:
+    """Insert rows in batches of BATCH_SIZE, return rows per second"""
+    start = time.perf_counter()
+    for i in range(0, len(rows), BATCH_SIZE):
+        db.log_conversations(rows[i:i + BATCH_SIZE])
+    return len(rows) / (time.perf_counter() - start)
+
+
+def run_insert_benchmark(db: DatabaseService) -> None:
+    print("=== Conversation Log Insert Benchmark ===\n")
+    rows = make_rows(INSERT_ROWS)
+    single = bench_single_inserts(db, rows)
+    bulk = bench_bulk_inserts(db, rows)
+
+    speedup = bulk / single
+    for name, rate in (("one row per transaction", single), (f"batches of {BATCH_SIZE}", bulk)):
+        print(f"{name:>24}: {rate:10.0f} inserts/s")
+    print(f"\nSpeedup: {speedup:.1f}x")
+    print(json.dumps({"single_per_second": single, "bulk_per_second": bulk, "speedup": speedup}))
+
+    if speedup < 2:
+        print("❌ Bulk inserts are not meaningfully faster")
+        sys.exit(1)
+    print("✅ Bulk inserts are faster")
+
+
+def measure(query: Callable[[], object], runs: int) -> Dict[str, float]:
+    """Run a query repeatedly, return p50/p99 latency in milliseconds"""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        query()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "p50_ms": round(statistics.median(timings), 2),
+        "p99_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 2)
+    }
+
+
+def bench_queries(db: DatabaseService, runs: int) -> Dict[str, Dict[str, float]]:
+    """Measure the recent and per-user history queries"""
+    rng = random.Random(42)
+    return {
+        "recent": measure(lambda: db.get_recent_conversations(10), runs),
+        "per_user": measure(lambda: db.get_user_conversations(1000 + rng.randrange(QUERY_USERS), 20), runs)
+    }
+
+
+def run_query_benchmark(db: DatabaseService) -> None:
+    print("\n=== Conversation History Query Benchmark ===\n")
+    engine = db.db_manager.engine
+    indexes = list(ConversationLog.__table__.indexes)
+
+    with engine.begin() as connection:
+        # Load without indexes, then build them once, as a bulk import would
+        for index in indexes:
+            index.drop(connection, checkfirst=True)
+        connection.execute(text("DELETE FROM conversation_logs"))
+        start = time.perf_counter()
+        connection.execute(text(GENERATE_ROWS_SQL[engine.dialect.name]),
+                           {"count": QUERY_TABLE_ROWS, "users": QUERY_USERS})
+    print(f"Generated {QUERY_TABLE_ROWS:,} rows in {time.perf_counter() - start:.1f}s")
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as connection:
+            connection.execute(text("ANALYZE conversation_logs"))
+
+    without_indexes = bench_queries(db, runs=20)
+
+    with engine.begin() as connection:
+        for index in indexes:
+            index.create(connection)
+        if engine.dialect.name == "postgresql":
+            connection.execute(text("ANALYZE conversation_logs"))
+        else:
+            connection.execute(text("ANALYZE"))
+    with_indexes = bench_queries(db, runs=500)
+
+    for name in ("recent", "per_user"):
+        print(f"{name:>9}: p50 {without_indexes[name]['p50_ms']:9.2f} ms, p99 {without_indexes[name]['p99_ms']:9.2f} ms"
+              f" without indexes -> p50 {with_indexes[name]['p50_ms']:6.2f} ms, p99 {with_indexes[name]['p99_ms']:6.2f} ms")
+    print(json.dumps({"rows": QUERY_TABLE_ROWS, "without_indexes": without_indexes, "with_indexes": with_indexes}))
+
+    if any(with_indexes[name]["p99_ms"] >= without_indexes[name]["p50_ms"] for name in with_indexes):
+        print("❌ Indexes do not speed up history queries")
+        sys.exit(1)
+    print("✅ History queries use the conversation_logs indexes")
+
+
+def main():
+    benchmarks = sys.argv[1:] or ["inserts", "queries"]
+    db_url = os.getenv("DB_BENCHMARK_URL")
+    if not db_url:
+        db_dir = tempfile.mkdtemp(prefix="db_benchmark_")
+        db_url = f"sqlite:///{os.path.join(db_dir, 'benchmark.db')}"
+    os.environ["DATABASE_URL"] = db_url
+    print(f"Database: {db_url.split('@')[-1]}\n")
+
+    db = DatabaseService()
+    try:
+        if "inserts" in benchmarks:
+            run_insert_benchmark(db)
+        if "queries" in benchmarks:
+            run_query_benchmark(db)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Leader election for polling mode
+Lets exactly one instance call getUpdates at a time and, when several instances
+share a database, fans the fetched updates out to all of them through a queue
+"""
+
+import asyncio
+import fcntl
+import logging
+import os
+import signal
+from typing import List, Optional, Union
+from sqlalchemy import create_engine, make_url, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.pool import NullPool
+from telegram import Update
+from telegram.error import Conflict, NetworkError
+from telegram.ext import Application
+from async_database_service import AsyncDatabaseService
+from config import Config
+from database_service import DatabaseService
+from shared_state import InstanceCoordinator
+from update_queue import DatabaseUpdateQueue
+
+# Arbitrary key for the PostgreSQL advisory lock held by the polling leader
+LEADER_LOCK_KEY = 7263492
+
+# Seconds Telegram holds a getUpdates request open when there are no updates
+POLL_TIMEOUT = 10
+
+
+class FileLease:
+    """Exclusive lock on a local file; the OS releases it when the process exits"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    async def acquire(self) -> bool:
+        """Take the lock if no other process holds it"""
+        if self._file is not None:
+            return True
+        lock_file = open(self.path, "a+")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(f"{os.getpid()}\n")
+        lock_file.flush()
+        self._file = lock_file
+        return True
+
+    async def is_held(self) -> bool:
+        return self._file is not None
+
+    async def release(self) -> None:
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class DatabaseLease:
+    """
+    PostgreSQL session advisory lock held on a dedicated connection
+
+    The server releases the lock as soon as the connection closes, so a
+    crashed leader is replaced without waiting for a lease to expire.
+    """
+
+    def __init__(self, database_url: str, key: int = LEADER_LOCK_KEY):
+        self._engine = create_engine(database_url, poolclass=NullPool)
+        self.key = key
+        self._connection: Optional[Connection] = None
+
+    async def acquire(self) -> bool:
+        """Take the lock if no other session holds it"""
+        if self._connection is not None:
+            return True
+        return await asyncio.to_thread(self._try_lock)
+
+    def _try_lock(self) -> bool:
+        connection = self._engine.connect()
+        try:
+            locked = connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key}).scalar()
+            connection.commit()
+        except Exception:
+            connection.close()
+            raise
+        if not locked:
+            connection.close()
+            return False
+        self._connection = connection
+        return True
+
+    async def is_held(self) -> bool:
+        """Check that the session holding the lock is still alive"""
+        if self._connection is None:
+            return False
+        return await asyncio.to_thread(self._check)
+
+    def _check(self) -> bool:
+        try:
+            self._connection.execute(text("SELECT 1"))
+            self._connection.commit()
+            return True
+        except Exception:
+            self._close()
+            return False
+
+    async def release(self) -> None:
+        if self._connection is not None:
+            await asyncio.to_thread(self._unlock)
+
+    def _unlock(self) -> None:
+        try:
+            self._connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.key})
+            self._connection.commit()
+        finally:
+            self._close()
+
+    def _close(self) -> None:
+        try:
+            self._connection.close()
+        except Exception:
+            pass
+        self._connection = None
+
+
+def create_lease(config: Config, key: int = LEADER_LOCK_KEY,
+                 lock_file: Optional[str] = None) -> Union[FileLease, DatabaseLease]:
+    """
+    Create the lease configured by LEADER_LOCK ("auto" uses PostgreSQL when DATABASE_URL points to it)
+
+    Args:
+        config: Bot configuration
+        key: Advisory lock key of a database lease
+        lock_file: Lock file of a file lease (default: LEADER_LOCK_FILE)
+    """
+    database_url = os.getenv("DATABASE_URL", "")
+    lock = config.LEADER_LOCK
+    if lock == "auto":
+        is_postgresql = bool(database_url) and make_url(database_url).get_backend_name() == "postgresql"
+        lock = "database" if is_postgresql else "file"
+    if lock == "database":
+        return DatabaseLease(database_url, key)
+    return FileLease(lock_file or config.LEADER_LOCK_FILE)
+
+
+class PollingLeader:
+    """
+    Runs the application in polling mode under leader election
+
+    Only the instance holding the lease calls getUpdates; the others stand by
+    and take over once the lease is released. With MULTI_INSTANCE and a
+    database, the leader writes updates to the shared update queue before
+    confirming them to Telegram, and every instance (the leader included)
+    handles updates from the queue. A new leader re-fetches unconfirmed
+    updates, which the queue ignores if already queued.
+
+    Without the queue the leader handles each fetched batch itself and confirms
+    it only afterwards, so updates are delivered at least once: if the leader
+    dies mid-batch, the next leader handles the whole batch again.
+    """
+
+    def __init__(self, config: Config, application: Application, lease: Union[FileLease, DatabaseLease],
+                 db_service: Optional[Union[DatabaseService, AsyncDatabaseService]] = None,
+                 coordinator: Optional[InstanceCoordinator] = None):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.application = application
+        self.lease = lease
+        self.queue: Optional[DatabaseUpdateQueue] = None
+        if db_service is not None and coordinator is not None:
+            self.queue = DatabaseUpdateQueue(config, application, db_service, coordinator.instance_id,
+                                             workers=config.CONCURRENT_UPDATES)
+
+        self.is_leader = False
+
+    def run(self) -> None:
+        """Run until SIGINT/SIGTERM"""
+        asyncio.run(self._main())
+
+    async def _main(self) -> None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+
+        application = self.application
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+
+        if self.queue:
+            await self.queue.start()
+        election = asyncio.create_task(self._elect())
+        try:
+            await stop.wait()
+        finally:
+            self.logger.info("Stopping polling")
+            election.cancel()
+            await asyncio.gather(election, return_exceptions=True)
+            if self.queue:
+                await self.queue.close()
+
+            await application.stop()
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+    async def _elect(self) -> None:
+        """Try to become leader every LEADER_RETRY_INTERVAL seconds, and poll while leading"""
+        while True:
+            try:
+                elected = await self.lease.acquire()
+            except Exception as e:
+                self.logger.error(f"Leader election failed: {str(e)}")
+                elected = False
+
+            if elected:
+                self.is_leader = True
+                self.logger.info("Elected polling leader")
+                try:
+                    await self._poll()
+                except Exception as e:
+                    self.logger.error(f"Polling failed: {str(e)}", exc_info=True)
+                finally:
+                    self.is_leader = False
+                    try:
+                        await self.lease.release()
+                    except Exception as e:
+                        self.logger.error(f"Failed to release leadership: {str(e)}")
+                    self.logger.info("Stepped down as polling leader")
+
+            await asyncio.sleep(self.config.LEADER_RETRY_INTERVAL)
+
+    async def _poll(self) -> None:
+        """Fetch updates while the lease is held"""
+        loop = asyncio.get_running_loop()
+        bot = self.application.bot
+        await bot.delete_webhook(drop_pending_updates=False)
+
+        offset = None
+        next_check = loop.time() + self.config.LEADER_CHECK_INTERVAL
+        while True:
+            if loop.time() >= next_check:
+                if not await self.lease.is_held():
+                    self.logger.warning("Lost the polling lease")
+                    return
+                next_check = loop.time() + self.config.LEADER_CHECK_INTERVAL
+
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=["message"])
+            except Conflict as e:
+                self.logger.warning(f"Another process is polling this bot outside leader election: {str(e)}")
+                await asyncio.sleep(self.config.LEADER_RETRY_INTERVAL)
+                continue
+            except NetworkError as e:
+                self.logger.warning(f"getUpdates failed, retrying: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+
+            if not updates:
+                continue
+            try:
+                await self._dispatch(updates)
+            except Exception as e:
+                # The offset is not advanced, so the same updates are fetched again
+                self.logger.error(f"Failed to dispatch {len(updates)} updates: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+            # The next getUpdates call confirms everything before the new offset
+            offset = updates[-1].update_id + 1
+
+    async def _dispatch(self, updates: List[Update]) -> None:
+        """Queue the updates durably or, without a queue, handle them before they are confirmed"""
+        if self.queue:
+            await self.queue.put([update.to_dict() for update in updates])
+            return
+        # Handler errors go to the application's error handler, so every update counts as handled
+        processor = self.application.update_processor
+        await asyncio.gather(*(processor.process_update(update, self.application.process_update(update))
+                               for update in updates))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Load test for the OpenAI Assistant pipeline
+Simulates the Assistants API with a fixed per-request latency and checks
+that throughput scales with the number of concurrent users and that adaptive
+run polling needs fewer status checks than fixed one-second polling
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from typing import Callable, Optional
+import httpx
+from config import Config
+from openai_service import OpenAIService, create_async_client
+
+API_LATENCY = float(os.getenv("LOAD_TEST_LATENCY", "0.05"))
+POLLS_PER_RUN = int(os.getenv("LOAD_TEST_POLLS", "1"))
+
+
+class FakeAssistantsAPI:
+    """Minimal in-process stand-in for the Assistants endpoints used by the bot"""
+
+    def __init__(self, latency: float, run_seconds: Optional[Callable[[], float]] = None):
+        self.latency = latency
+        self.run_seconds = run_seconds
+        self.requests = 0
+        self.status_checks = 0
+        self.overshoots = []
+        self._ids = itertools.count()
+        self._polls = {}
+        self._deadlines = {}
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        path = request.url.path
+
+        if path.endswith("/threads") and request.method == "POST":
+            return httpx.Response(200, json={"id": f"thread_{next(self._ids)}", "object": "thread",
+                                             "created_at": 0, "metadata": {}})
+        if path.endswith("/messages") and request.method == "POST":
+            return httpx.Response(200, json=self._message("user", "hi"))
+        if path.endswith("/messages") and request.method == "GET":
+            return httpx.Response(200, json={"object": "list", "data": [self._message("assistant", "pong")],
+                                             "first_id": "msg", "last_id": "msg", "has_more": False})
+        if path.endswith("/runs") and request.method == "POST":
+            run_id = f"run_{next(self._ids)}"
+            self._polls[run_id] = 0
+            if self.run_seconds:
+                self._deadlines[run_id] = time.perf_counter() + self.run_seconds()
+            return httpx.Response(200, json=self._run(run_id, "queued"))
+        if "/runs/" in path:
+            run_id = path.rsplit("/", 1)[-1]
+            self.status_checks += 1
+            self._polls[run_id] += 1
+            if run_id in self._deadlines:
+                overshoot = time.perf_counter() - self._deadlines[run_id]
+                status = "completed" if overshoot >= 0 else "in_progress"
+                if overshoot >= 0:
+                    self.overshoots.append(overshoot)
+            else:
+                status = "completed" if self._polls[run_id] >= POLLS_PER_RUN else "in_progress"
+            return httpx.Response(200, json=self._run(run_id, status))
+        return httpx.Response(404, json={"error": {"message": f"Unhandled {request.method} {path}"}})
+
+    def _message(self, role: str, text: str) -> dict:
+        return {
+            "id": f"msg_{next(self._ids)}", "object": "thread.message", "created_at": 0,
+            "thread_id": "thread", "role": role, "status": "completed", "attachments": [], "metadata": {},
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}]
+        }
+
+    def _run(self, run_id: str, status: str) -> dict:
+        return {
+            "id": run_id, "object": "thread.run", "created_at": 0, "thread_id": "thread",
+            "assistant_id": "asst_load_test", "status": status, "instructions": "", "model": "gpt-4o",
+            "tools": [], "parallel_tool_calls": True, "metadata": {}
+        }
+
+
+async def run_load(concurrency: int, total: int) -> float:
+    """Send `total` messages with at most `concurrency` in flight, return messages per second"""
+    config = Config()
+    config.OPENAI_API_KEY = config.OPENAI_API_KEY or "sk-load-test"
+    config.ASSISTANT_ID = config.ASSISTANT_ID or "asst_load_test"
+
+    api = FakeAssistantsAPI(API_LATENCY)
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(api), base_url="https://api.openai.com/v1")
+    service = OpenAIService(config, client=create_async_client(config, http_client))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_user(i: int) -> str:
+        async with semaphore:
+            return await service.get_assistant_response(f"message {i}", f"thread_{i}")
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one_user(i) for i in range(total)))
+    elapsed = time.perf_counter() - start
+    await service.client.close()
+
+    assert all(result == "pong" for result in results), "Unexpected assistant response"
+    return total / elapsed
+
+
+async def run_polling(fixed: bool, runs: int) -> dict:
+    """Run a warm-up and a measured wave of assistant runs, return polling statistics"""
+    config = Config()
+    config.OPENAI_API_KEY = config.OPENAI_API_KEY or "sk-load-test"
+    config.ASSISTANT_ID = config.ASSISTANT_ID or "asst_load_test"
+    if fixed:
+        config.RUN_POLL_MIN_INTERVAL = config.RUN_POLL_MAX_INTERVAL = 1.0
+        config.RUN_POLL_BACKOFF = 1.0
+        config.RUN_POLL_JITTER = 0.0
+        config.RUN_POLL_EARLY_FRACTION = 0.0
+
+    rng = random.Random(42)
+    api = FakeAssistantsAPI(0.01, run_seconds=lambda: rng.uniform(1.0, 2.0))
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(api), base_url="https://api.openai.com/v1")
+    service = OpenAIService(config, client=create_async_client(config, http_client))
+
+    async def wave(size: int) -> None:
+        await asyncio.gather(*(service.get_assistant_response(f"message {i}", f"thread_{i}") for i in range(size)))
+
+    # Let the latency profile learn, then measure
+    await wave(runs // 2)
+    api.status_checks, api.overshoots = 0, []
+    await wave(runs)
+    await service.client.close()
+
+    return {
+        "status_checks_per_run": api.status_checks / runs,
+        "avg_overshoot_seconds": sum(api.overshoots) / len(api.overshoots)
+    }
+
+
+async def main():
+    """Compare throughput at increasing concurrency levels"""
+    print("=== OpenAI Pipeline Load Test ===\n")
+    total = int(os.getenv("LOAD_TEST_MESSAGES", "32"))
+
+    results = {}
+    for concurrency in (1, 8, 32):
+        results[concurrency] = await run_load(concurrency, total)
+        print(f"concurrency={concurrency:>3}: {results[concurrency]:8.2f} msg/s")
+
+    speedup = results[32] / results[1]
+    print(f"\nSpeedup 32 vs 1 concurrent users: {speedup:.1f}x")
+    print(json.dumps({"throughput": results, "speedup": speedup}))
+
+    if speedup < 4:
+        print("❌ Throughput does not scale with concurrency - event loop is being blocked")
+        sys.exit(1)
+    print("✅ Throughput scales with concurrent users")
+
+    print("\n=== Run Polling ===\n")
+    fixed = await run_polling(fixed=True, runs=20)
+    adaptive = await run_polling(fixed=False, runs=20)
+    for name, stats in (("fixed 1s", fixed), ("adaptive", adaptive)):
+        print(f"{name:>9}: {stats['status_checks_per_run']:.2f} checks/run, "
+              f"{stats['avg_overshoot_seconds'] * 1000:.0f} ms avg overshoot")
+    print(json.dumps({"fixed": fixed, "adaptive": adaptive}))
+
+    if adaptive["avg_overshoot_seconds"] >= fixed["avg_overshoot_seconds"]:
+        print("❌ Adaptive polling does not reduce completion overshoot")
+        sys.exit(1)
+    print("✅ Adaptive polling detects completion sooner")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -3,140 +3,575 @@ Logging service for conversation tracking
 Handles CSV and Google Sheets logging functionality
 """
 
-import csv
+import asyncio
+import contextvars
 import logging
 import os
 import json
 import base64
+import threading
+import time
 from datetime import datetime
-from typing import Optional, Any
+from typing import Any, Callable, Dict, List, Optional, Union
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from async_database_service import AsyncDatabaseService
 from config import Config
+from csv_log_writer import RotatingCsvWriter
+from database_service import DatabaseService
+from metrics import Counter, Gauge, Histogram
+from tracing import TRACER, traced
 
+# Rows per INSERT statement when writing conversations to the database
+DB_INSERT_CHUNK_ROWS = 1000
 
-class LoggingService:
-    """Service for logging conversations to CSV and Google Sheets"""
+# Sink label used in metrics for each sink name
+SINK_LABELS = {"CSV": "csv", "Google Sheets": "sheets"}
+
+LOG_SINK_WRITE_SECONDS = Histogram("bot_log_sink_write_seconds", "Time taken to write a batch of conversations",
+                                   ["sink"])
+LOG_SINK_ERRORS = Counter("bot_log_sink_errors_total", "Failed conversation batch writes", ["sink"])
+LOG_QUEUE_DEPTH = Gauge("bot_log_queue_depth", "Conversations waiting for the background writer")
+LOG_SINK_PENDING_ROWS = Gauge("bot_log_sink_pending_rows", "Rows kept by a sink to retry after failed writes",
+                              ["sink"])
+
+
+class SheetsSink:
+    """Spools rows to a local file and writes them to Google Sheets with bulk append_rows calls"""
     
     def __init__(self, config: Config):
         self.config = config
         self.logger = logging.getLogger(__name__)
-        self._worksheet = None
-        self._sheets_initialized = False
+        self.spool_file = config.SHEETS_SPOOL_FILE
+        self._lock = threading.Lock()
+        self._pending: List[list] = self._load_spool()
+        self._oldest_at = time.monotonic() if self._pending else None
         
-        # Initialize CSV file with headers if it doesn't exist
-        if self.config.ENABLE_CSV_LOGGING:
-            self._initialize_csv()
+        # Rows to accumulate before writing; grows when Sheets throttles us
+        self.batch_size = config.SHEETS_MIN_BATCH
+        self._resume_at = 0.0
+        self._failures = 0
+    
+    @property
+    def pending_rows(self) -> int:
+        """Number of spooled rows not yet written to Sheets"""
+        return len(self._pending)
+    
+    def _load_spool(self) -> List[list]:
+        """Load rows left over from a previous run"""
+        if not os.path.exists(self.spool_file):
+            return []
+        try:
+            with open(self.spool_file, 'r', encoding='utf-8') as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            if rows:
+                self.logger.info(f"Loaded {len(rows)} unsent Google Sheets rows from spool")
+            return rows
+        except Exception as e:
+            self.logger.error(f"Failed to load Google Sheets spool: {str(e)}")
+            return []
+    
+    def _rewrite_spool(self) -> None:
+        """Atomically replace the spool file with the rows still pending"""
+        tmp_file = f"{self.spool_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for row in self._pending:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        os.replace(tmp_file, self.spool_file)
+    
+    def add(self, rows: List[list]) -> None:
+        """
+        Durably spool rows for Google Sheets
+        
+        Args:
+            rows: Rows in sheet column order
+        """
+        with self._lock:
+            with open(self.spool_file, 'a', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            
+            if not self._pending:
+                self._oldest_at = time.monotonic()
+            self._pending.extend(rows)
+            
+            overflow = len(self._pending) - self.config.SHEETS_SPOOL_MAX_ROWS
+            if overflow > 0:
+                del self._pending[:overflow]
+                self._rewrite_spool()
+                self.logger.error(f"Google Sheets spool full, discarded {overflow} oldest rows")
+    
+    def is_due(self) -> bool:
+        """Check whether spooled rows should be written now"""
+        if not self._pending or time.monotonic() < self._resume_at:
+            return False
+        return (len(self._pending) >= self.batch_size
+                or time.monotonic() - self._oldest_at >= self.config.SHEETS_MAX_DELAY)
     
-    def _initialize_csv(self) -> None:
-        """Initialize CSV file with headers if it doesn't exist"""
-        csv_file = "conversation_log.csv"
-        if not os.path.exists(csv_file):
+    def drain(self, worksheet: Any, force: bool = False) -> None:
+        """
+        Write spooled rows to the worksheet in bulk
+        
+        Rows are removed from the spool only after Sheets accepted them. On quota
+        errors the batch size grows so that later writes need fewer requests.
+        
+        Args:
+            worksheet: Google Sheets worksheet
+            force: Write even if the batch is not full yet (e.g. on shutdown)
+        """
+        with self._lock:
+            if not force and not self.is_due():
+                return
+            
+            while self._pending:
+                chunk = self._pending[:self.config.SHEETS_MAX_BATCH]
+                try:
+                    worksheet.append_rows(chunk, value_input_option="RAW")
+                except Exception as e:
+                    self._on_write_error(e)
+                    return
+                
+                del self._pending[:len(chunk)]
+                self._rewrite_spool()
+                self._failures = 0
+                self.logger.debug(f"Logged {len(chunk)} conversations to Google Sheets")
+            
+            self._oldest_at = None
+            # Recover towards small, low-latency batches while Sheets accepts our writes
+            self.batch_size = max(self.config.SHEETS_MIN_BATCH, self.batch_size * 3 // 4)
+    
+    def _on_write_error(self, error: Exception) -> None:
+        """Back off after a failed write, growing the batch size on quota errors"""
+        self._failures += 1
+        retry_after = None
+        response = getattr(error, "response", None)
+        
+        if isinstance(error, gspread.exceptions.APIError) and error.code == 429:
+            self.batch_size = min(self.config.SHEETS_MAX_BATCH, self.batch_size * 2)
+            if response is not None and response.headers.get("Retry-After", "").isdigit():
+                retry_after = float(response.headers["Retry-After"])
+            self.logger.warning(f"Google Sheets quota exceeded, batching {self.batch_size} rows per write")
+        else:
+            self.logger.error(f"Failed to log to Google Sheets: {str(error)}")
+        
+        if retry_after is None:
+            retry_after = min(self.config.SHEETS_MAX_BACKOFF, 2 ** self._failures)
+        self._resume_at = time.monotonic() + retry_after
+
+
+def _is_transient(error: Exception) -> bool:
+    """Check whether a failed insert may succeed when retried (e.g. lost connection, lock timeout)"""
+    if not isinstance(error, DBAPIError):
+        return True
+    return error.connection_invalidated or isinstance(error, (OperationalError, InterfaceError))
+
+
+class DatabaseLogSink:
+    """Bulk-inserts conversation rows, keeping failed rows in memory to retry with the next batch"""
+    
+    def __init__(self, config: Config, db_service: Union[DatabaseService, AsyncDatabaseService]):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.db_service = db_service
+        self._pending: List[Dict] = []
+        self._resume_at = 0.0
+        self._failures = 0
+        self.inserted_rows = 0
+        self.dropped_rows = 0
+    
+    @property
+    def pending_rows(self) -> int:
+        """Number of rows waiting to be retried"""
+        return len(self._pending)
+    
+    def is_due(self) -> bool:
+        """Check whether failed rows should be retried now"""
+        return bool(self._pending) and time.monotonic() >= self._resume_at
+    
+    @traced("log_sink_write")
+    async def write(self, rows: List[Dict], force: bool = False) -> None:
+        """
+        Insert rows together with any rows left over from failed writes
+        
+        Rows stay pending until their insert commits, so each conversation is
+        written at least once; the pending list is bounded by LOG_QUEUE_MAX_SIZE.
+        A chunk failing LOG_MAX_RETRIES times in a row is dropped, and rows the
+        database rejects outright (e.g. constraint violations) are dropped alone.
+        
+        Args:
+            rows: ConversationLog column values
+            force: Retry pending rows even while backing off (e.g. on shutdown)
+        """
+        self._pending.extend(rows)
+        overflow = len(self._pending) - self.config.LOG_QUEUE_MAX_SIZE
+        if overflow > 0:
+            del self._pending[:overflow]
+            self.dropped_rows += overflow
+            self.logger.error(f"Database log buffer full, discarded {overflow} oldest rows")
+        
+        if not force and time.monotonic() < self._resume_at:
+            return
+        
+        TRACER.current_span().set_attribute("sink", "database")
+        while self._pending:
+            chunk = self._pending[:DB_INSERT_CHUNK_ROWS]
             try:
-                with open(csv_file, mode="w", encoding="utf-8", newline='') as file:
-                    writer = csv.writer(file)
-                    writer.writerow(["Timestamp", "User ID", "User Name", "Question", "Answer"])
-                self.logger.info("Created CSV log file with headers")
+                await self._insert(chunk)
             except Exception as e:
-                self.logger.error(f"Failed to create CSV file: {str(e)}")
+                LOG_SINK_ERRORS.inc(sink="database")
+                self._failures += 1
+                if self._failures >= self.config.LOG_MAX_RETRIES:
+                    del self._pending[:len(chunk)]
+                    self.dropped_rows += len(chunk)
+                    self._failures = 0
+                    self.logger.error(f"Failed to log {len(chunk)} conversations to database, giving up: {str(e)}")
+                    continue
+                self._resume_at = time.monotonic() + min(60, 2 ** self._failures)
+                self.logger.error(f"Failed to log {len(self._pending)} conversations to database: {str(e)}")
+                return
+            self._failures = 0
+    
+    async def _insert(self, chunk: List[Dict]) -> None:
+        """
+        Insert the chunk at the head of the pending rows, removing the rows it settles
+        
+        When the database rejects the chunk itself, it is split in halves until the
+        offending rows are isolated and dropped. Transient errors are raised with the
+        rows not yet inserted still pending.
+        """
+        try:
+            with LOG_SINK_WRITE_SECONDS.time(sink="database"):
+                await self.db_service.call("log_conversations", chunk)
+        except Exception as e:
+            if _is_transient(e):
+                raise
+            if len(chunk) == 1:
+                del self._pending[:1]
+                self.dropped_rows += 1
+                LOG_SINK_ERRORS.inc(sink="database")
+                self.logger.error(f"Database rejected conversation of user {chunk[0]['user_id']}, dropped: {str(e)}")
+                return
+            middle = len(chunk) // 2
+            await self._insert(chunk[:middle])
+            await self._insert(chunk[middle:])
+            return
+        
+        del self._pending[:len(chunk)]
+        self.inserted_rows += len(chunk)
+
+
+class LoggingService:
+    """Service for logging conversations to CSV, Google Sheets and the database"""
+    
+    def __init__(self, config: Config, db_service: Optional[Union[DatabaseService, AsyncDatabaseService]] = None):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self._worksheet = None
+        self._no_sheets_credentials = False
+        self._sheets_connect_failures = 0
+        self._sheets_retry_at = 0.0
+        self._sheets_sink = SheetsSink(config) if config.ENABLE_SHEETS_LOGGING else None
+        self._db_sink = DatabaseLogSink(config, db_service) if db_service is not None and config.ENABLE_DB_LOGGING else None
+        
+        # Background writer state
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self.dropped_rows = 0
+        
+        # Long-lived CSV writer, opened on first write
+        self._csv_writer = RotatingCsvWriter(config) if config.ENABLE_CSV_LOGGING else None
+        
+        LOG_QUEUE_DEPTH.set_function(lambda: self._queue.qsize() if self._queue else 0)
+        if self._sheets_sink:
+            LOG_SINK_PENDING_ROWS.set_function(lambda: self._sheets_sink.pending_rows, sink="sheets")
+        if self._db_sink:
+            LOG_SINK_PENDING_ROWS.set_function(lambda: self._db_sink.pending_rows, sink="database")
     
     def _get_worksheet(self) -> Optional[Any]:
-        """Get Google Sheets worksheet connection"""
+        """Get Google Sheets worksheet connection, reconnecting with backoff after failures"""
         if not self.config.ENABLE_SHEETS_LOGGING:
             return None
             
         if self._worksheet is not None:
             return self._worksheet
             
-        if not self._sheets_initialized:
-            try:
-                # Try to get credentials from environment variable first
-                if self.config.GOOGLE_SERVICE_ACCOUNT_JSON:
-                    try:
-                        # Decode base64 credentials from environment
-                        credentials_json = base64.b64decode(self.config.GOOGLE_SERVICE_ACCOUNT_JSON).decode("utf-8")
-                        creds_dict = json.loads(credentials_json)
-                        
-                        scope = [
-                            "https://spreadsheets.google.com/feeds",
-                            "https://www.googleapis.com/auth/drive"
-                        ]
-                        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-                        client = gspread.authorize(creds)  # type: ignore
-                        sheet = client.open(self.config.SHEET_NAME).sheet1
-                        self._worksheet = sheet
-                        self.logger.info(f"Connected to Google Sheets using environment credentials: {self.config.SHEET_NAME}")
-                        
-                    except Exception as e:
-                        self.logger.error(f"Failed to decode environment credentials: {str(e)}")
-                        self._worksheet = None
-                        
-                # Fallback to file-based credentials if environment not available
-                elif os.path.exists(self.config.CREDENTIALS_FILE):
-                    scope = [
-                        "https://spreadsheets.google.com/feeds",
-                        "https://www.googleapis.com/auth/drive"
-                    ]
-                    creds = ServiceAccountCredentials.from_json_keyfile_name(
-                        self.config.CREDENTIALS_FILE, scope  # type: ignore
-                    )
-                    client = gspread.authorize(creds)  # type: ignore
-                    sheet = client.open(self.config.SHEET_NAME).sheet1
-                    self._worksheet = sheet
-                    self.logger.info(f"Connected to Google Sheets using file credentials: {self.config.SHEET_NAME}")
-                    
-                else:
-                    self.logger.warning("No Google Sheets credentials found (neither environment nor file)")
-                    self._worksheet = None
+        if self._no_sheets_credentials or time.monotonic() < self._sheets_retry_at:
+            return None
+        
+        scope = [
+            "https://spreadsheets.google.com/feeds",
+            "https://www.googleapis.com/auth/drive"
+        ]
+        try:
+            # Try to get credentials from environment variable first
+            if self.config.GOOGLE_SERVICE_ACCOUNT_JSON:
+                # Decode base64 credentials from environment
+                credentials_json = base64.b64decode(self.config.GOOGLE_SERVICE_ACCOUNT_JSON).decode("utf-8")
+                creds = ServiceAccountCredentials.from_json_keyfile_dict(json.loads(credentials_json), scope)
+                source = "environment"
                 
-            except Exception as e:
-                self.logger.error(f"Failed to connect to Google Sheets: {str(e)}")
-                self._worksheet = None
+            # Fallback to file-based credentials if environment not available
+            elif os.path.exists(self.config.CREDENTIALS_FILE):
+                creds = ServiceAccountCredentials.from_json_keyfile_name(
+                    self.config.CREDENTIALS_FILE, scope  # type: ignore
+                )
+                source = "file"
+                
+            else:
+                # Rows stay spooled until credentials are configured and the bot restarts
+                self.logger.warning("No Google Sheets credentials found (neither environment nor file)")
+                self._no_sheets_credentials = True
+                return None
+            
+            client = gspread.authorize(creds)  # type: ignore
+            self._worksheet = client.open(self.config.SHEET_NAME).sheet1
+            self._sheets_connect_failures = 0
+            self.logger.info(f"Connected to Google Sheets using {source} credentials: {self.config.SHEET_NAME}")
             
-            self._sheets_initialized = True
+        except Exception as e:
+            # Throttling and network errors are transient; spooled rows are written once connected
+            self._sheets_connect_failures += 1
+            delay = min(self.config.SHEETS_MAX_BACKOFF, 2 ** self._sheets_connect_failures)
+            self._sheets_retry_at = time.monotonic() + delay
+            self.logger.error(f"Failed to connect to Google Sheets, retrying in {delay:.0f}s: {str(e)}")
         
         return self._worksheet
     
-    def log_conversation(self, user_id: int, user_name: str, question: str, answer: str) -> None:
+    def _is_enabled(self) -> bool:
+        """Check whether any log sink is enabled"""
+        return self.config.ENABLE_CSV_LOGGING or self.config.ENABLE_SHEETS_LOGGING or self._db_sink is not None
+    
+    @traced("log_conversation")
+    def log_conversation(self, user_id: int, user_name: str, question: str, answer: str,
+                         thread_id: Optional[str] = None, response_time: Optional[int] = None) -> None:
         """
-        Log conversation to both CSV and Google Sheets
+        Log conversation to CSV, Google Sheets and the database
+        
+        Inside the event loop the row is only queued; a background writer task
+        writes rows in batches so logging adds no latency to the reply.
         
         Args:
             user_id: Telegram user ID
             user_name: User's full name
             question: User's question
             answer: Bot's response
+            thread_id: Assistant thread the conversation belongs to
+            response_time: Time to answer in milliseconds
         """
+        if not self._is_enabled():
+            return
+        
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # CSV/Sheets columns first; the database also stores thread, latency and UTC time
+        row = [timestamp, user_id, user_name, question, answer, thread_id, response_time, datetime.utcnow()]
         
-        # Log to CSV
-        if self.config.ENABLE_CSV_LOGGING:
-            self._log_to_csv(timestamp, user_id, user_name, question, answer)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (e.g. standalone scripts), write synchronously
+            self._write_batch_sync([row])
+            return
+        
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self.dropped_rows += 1
+            self.logger.error(f"Log queue full, dropped conversation for user {user_id}")
+    
+    async def start(self) -> None:
+        """Start the background writer (it is otherwise started on first use)"""
+        if self._is_enabled():
+            self._ensure_writer()
+    
+    def _ensure_writer(self) -> None:
+        """Start the background writer task if it is not running"""
+        if self._writer_task is None or self._writer_task.done():
+            if self._queue is None:
+                self._queue = asyncio.Queue(maxsize=self.config.LOG_QUEUE_MAX_SIZE)
+            # Run in a fresh context, not inside the trace of the update that happened to start it
+            self._writer_task = asyncio.create_task(self._run_writer(), context=contextvars.Context())
+    
+    async def _run_writer(self) -> None:
+        """Collect queued rows and flush them when the batch is full or the flush interval passes"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                row = await asyncio.wait_for(self._queue.get(), self.config.LOG_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                # Idle: write Sheets rows that have been spooled for too long
+                if self._sheets_sink and self._sheets_sink.is_due():
+                    await self._write_with_retry("Google Sheets", self._drain_to_sheets, [], spooled=True)
+                if self._db_sink and self._db_sink.is_due():
+                    await self._db_sink.write([])
+                continue
+            if row is None:
+                break
+            batch = [row]
+            
+            deadline = loop.time() + self.config.LOG_FLUSH_INTERVAL
+            stopping = False
+            while len(batch) < self.config.LOG_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                batch.append(row)
+            
+            await self._flush(batch)
+            if stopping:
+                break
         
-        # Log to Google Sheets
+        # Final attempt to deliver rows that failed to reach the database
+        if self._db_sink and self._db_sink.pending_rows:
+            await self._db_sink.write([], force=True)
+        
+        # Final attempt to deliver spooled Sheets rows before shutdown
+        if self._sheets_sink and self._sheets_sink.pending_rows:
+            worksheet = await asyncio.to_thread(self._get_worksheet)
+            if worksheet is not None:
+                await asyncio.to_thread(self._sheets_sink.drain, worksheet, True)
+    
+    @traced("log_flush", root=True)
+    async def _flush(self, batch: List[list]) -> None:
+        """Write a batch of rows to all enabled sinks concurrently"""
+        TRACER.current_span().set_attribute("rows", len(batch))
+        sinks = []
+        if self.config.ENABLE_CSV_LOGGING:
+            sinks.append(self._write_with_retry("CSV", self._log_to_csv, batch))
         if self.config.ENABLE_SHEETS_LOGGING:
-            self._log_to_sheets(timestamp, user_id, user_name, question, answer)
+            sinks.append(self._write_to_sheets(batch))
+        if self._db_sink:
+            sinks.append(self._db_sink.write(self._to_db_rows(batch)))
+        await asyncio.gather(*sinks)
     
-    def _log_to_csv(self, timestamp: str, user_id: int, user_name: str, question: str, answer: str) -> None:
-        """Log conversation to CSV file"""
+    async def _write_to_sheets(self, batch: List[list]) -> None:
+        """Spool a batch for Google Sheets once, then write the spool with retries"""
         try:
-            with open("conversation_log.csv", mode="a", encoding="utf-8", newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow([timestamp, user_id, user_name, question, answer])
-            self.logger.debug(f"Logged conversation to CSV for user {user_id}")
+            await asyncio.to_thread(self._spool_for_sheets, batch)
         except Exception as e:
-            self.logger.error(f"Failed to log to CSV: {str(e)}")
+            LOG_SINK_ERRORS.inc(sink="sheets")
+            self.dropped_rows += len(batch)
+            self.logger.error(f"Failed to spool {len(batch)} conversations for Google Sheets: {str(e)}")
+        # Retries only repeat the write, so they never spool the batch twice
+        await self._write_with_retry("Google Sheets", self._drain_to_sheets, batch, spooled=True)
     
-    def _log_to_sheets(self, timestamp: str, user_id: int, user_name: str, question: str, answer: str) -> None:
-        """Log conversation to Google Sheets"""
-        try:
-            worksheet = self._get_worksheet()
-            if worksheet is None:
+    @traced("log_sink_write")
+    async def _write_with_retry(self, sink_name: str, write: Callable[[List[list]], None], batch: List[list],
+                                spooled: bool = False) -> None:
+        """
+        Write a batch to one sink off the event loop, retrying failures a bounded number of times
+        
+        Args:
+            sink_name: Sink name used in logs and metrics
+            write: Function writing the batch
+            batch: Rows to write
+            spooled: The rows stay spooled when writing gives up, so they aren't counted as dropped
+        """
+        TRACER.current_span().set_attribute("sink", SINK_LABELS[sink_name])
+        for attempt in range(1, self.config.LOG_MAX_RETRIES + 1):
+            try:
+                with LOG_SINK_WRITE_SECONDS.time(sink=SINK_LABELS[sink_name]):
+                    await asyncio.to_thread(write, batch)
+                self.logger.debug(f"Logged {len(batch)} conversations to {sink_name}")
                 return
-            
-            row = [timestamp, str(user_id), user_name, question, answer]
-            worksheet.append_row(row)
-            self.logger.debug(f"Logged conversation to Google Sheets for user {user_id}")
-            
-        except Exception as e:
-            self.logger.error(f"Failed to log to Google Sheets: {str(e)}")
\ No newline at end of file
+            except Exception as e:
+                LOG_SINK_ERRORS.inc(sink=SINK_LABELS[sink_name])
+                if attempt == self.config.LOG_MAX_RETRIES:
+                    if not spooled:
+                        self.dropped_rows += len(batch)
+                    self.logger.error(f"Failed to log {len(batch)} conversations to {sink_name}, giving up: {str(e)}")
+                    return
+                self.logger.warning(f"Failed to log to {sink_name} (attempt {attempt}), retrying: {str(e)}")
+                await asyncio.sleep(2 ** attempt)
+    
+    def _write_batch_sync(self, batch: List[list]) -> None:
+        """Write a batch directly, used when no event loop is running"""
+        for sink_name, write, enabled in (("CSV", self._log_to_csv, self.config.ENABLE_CSV_LOGGING),
+                                          ("Google Sheets", self._log_to_sheets, self.config.ENABLE_SHEETS_LOGGING)):
+            if not enabled:
+                continue
+            try:
+                write(batch)
+            except Exception as e:
+                self.logger.error(f"Failed to log to {sink_name}: {str(e)}")
+        
+        # The async database service needs the event loop; it is only used by the bot itself
+        if self._db_sink and isinstance(self._db_sink.db_service, DatabaseService):
+            try:
+                self._db_sink.db_service.log_conversations(self._to_db_rows(batch))
+            except Exception as e:
+                self.logger.error(f"Failed to log to database: {str(e)}")
+    
+    async def stop(self) -> None:
+        """Flush queued conversations and stop the background writer"""
+        if self._writer_task is None:
+            return
+        
+        if not self._writer_task.done():
+            await self._queue.put(None)
+            try:
+                await asyncio.wait_for(self._writer_task, timeout=self.config.LOG_SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.logger.error(f"Log writer did not finish within {self.config.LOG_SHUTDOWN_TIMEOUT}s, "
+                                  f"{self._queue.qsize()} conversations not written")
+        self._writer_task = None
+        
+        if self._csv_writer:
+            self._csv_writer.close()
+        self.logger.info("Conversation log writer stopped")
+    
+    def _to_db_rows(self, rows: List[list]) -> List[Dict]:
+        """Convert queued rows to ConversationLog column values"""
+        return [
+            {
+                "user_id": user_id,
+                "user_name": user_name,
+                "question": question,
+                "answer": answer,
+                "thread_id": thread_id,
+                "response_time": response_time,
+                "timestamp": logged_at
+            }
+            for _, user_id, user_name, question, answer, thread_id, response_time, logged_at in rows
+        ]
+    
+    def prune_csv_archives(self, before: str) -> int:
+        """Delete rotated CSV log segments older than a timestamp, returning how many were deleted"""
+        if not self._csv_writer:
+            return 0
+        return self._csv_writer.prune_archives(before)
+    
+    def _log_to_csv(self, rows: List[list]) -> None:
+        """Append rows to the rotating CSV log"""
+        self._csv_writer.write([row[:5] for row in rows])
+    
+    def _log_to_sheets(self, rows: List[list]) -> None:
+        """Spool rows for Google Sheets and write them in bulk when a batch is due"""
+        # Spool first, so rows survive while the worksheet can't be opened
+        self._spool_for_sheets(rows)
+        self._drain_to_sheets(rows)
+    
+    def _spool_for_sheets(self, rows: List[list]) -> None:
+        """Durably spool rows in sheet column order"""
+        if rows:
+            self._sheets_sink.add([
+                [timestamp, str(user_id), user_name, question, answer]
+                for timestamp, user_id, user_name, question, answer, *_ in rows
+            ])
+    
+    def _drain_to_sheets(self, rows: List[list]) -> None:
+        """Write spooled rows to Google Sheets when a batch is due (rows are already spooled)"""
+        worksheet = self._get_worksheet()
+        if worksheet is None:
+            return
+        self._sheets_sink.drain(worksheet)
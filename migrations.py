@@ -0,0 +1,206 @@
+"""
+Database schema migrations
+Applies versioned schema changes that create_all() cannot make to existing tables,
+and optionally partitions conversation_logs by month on PostgreSQL
+"""
+
+import logging
+import os
+from datetime import datetime
+from typing import Callable, List, Tuple
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+from models import Base, ConversationLog, UserThread
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for the PostgreSQL advisory lock serializing migrations across instances
+MIGRATION_LOCK_KEY = 7263491
+
+# Monthly partitions created ahead of time when partitioning is enabled
+PARTITION_MONTHS_AHEAD = 3
+
+
+def _create_conversation_log_indexes(connection: Connection) -> None:
+    """Add the conversation_logs indexes to tables created before they existed"""
+    for index in ConversationLog.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def _add_thread_last_used(connection: Connection) -> None:
+    """Track when each user's thread was last used, starting from its last update"""
+    columns = {column["name"] for column in inspect(connection).get_columns("user_threads")}
+    if "last_used_at" not in columns:
+        connection.execute(text("ALTER TABLE user_threads ADD COLUMN last_used_at TIMESTAMP"))
+    connection.execute(text(
+        "UPDATE user_threads SET last_used_at = COALESCE(updated_at, created_at) WHERE last_used_at IS NULL"
+    ))
+    for index in UserThread.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def _widen_telegram_ids(connection: Connection) -> None:
+    """Store update and user IDs as 64-bit integers; Telegram IDs don't fit in 32 bits"""
+    # SQLite integers are already 64-bit
+    if connection.dialect.name != "postgresql":
+        return
+    for table, column in (("processed_updates", "update_id"), ("user_locks", "user_id"),
+                          ("update_queue", "update_id")):
+        connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT"))
+
+
+def _widen_user_ids(connection: Connection) -> None:
+    """Store user IDs in users, conversation_logs and user_threads as 64-bit integers"""
+    if connection.dialect.name != "postgresql":
+        return
+    # On a partitioned conversation_logs the change is applied to every partition
+    for table, column in (("users", "telegram_id"), ("conversation_logs", "user_id"),
+                          ("user_threads", "user_id")):
+        connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT"))
+
+
+# (version, description, migration) in the order they must be applied; never renumber
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "Index conversation_logs by timestamp, user and thread", _create_conversation_log_indexes),
+    (2, "Add user_threads.last_used_at for idle thread expiry", _add_thread_last_used),
+    (3, "Widen processed_updates, user_locks and update_queue IDs to BIGINT", _widen_telegram_ids),
+    (4, "Widen users, conversation_logs and user_threads user IDs to BIGINT", _widen_user_ids),
+]
+
+
+def migrate(connection: Connection) -> List[int]:
+    """
+    Create missing tables and apply pending migrations in one transaction
+
+    Args:
+        connection: Connection inside a transaction (e.g. from engine.begin())
+
+    Returns:
+        Versions of the migrations that were applied
+    """
+    if connection.dialect.name == "postgresql":
+        # Another instance starting at the same time waits here instead of racing
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+    Base.metadata.create_all(connection)
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, description VARCHAR(200), applied_at TIMESTAMP)"
+    ))
+    applied_versions = set(connection.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        if version in applied_versions:
+            continue
+        logger.info(f"Applying database migration {version}: {description}")
+        migration(connection)
+        connection.execute(
+            text("INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)"),
+            {"v": version, "d": description, "t": datetime.utcnow()}
+        )
+        applied.append(version)
+
+    if connection.dialect.name == "postgresql" and partitioning_enabled():
+        partition_conversation_logs(connection)
+    return applied
+
+
+def partitioning_enabled() -> bool:
+    """Check whether conversation_logs should be partitioned by month (DB_PARTITION_LOGS)"""
+    return os.getenv("DB_PARTITION_LOGS", "false").lower() == "true"
+
+
+def _is_partitioned(connection: Connection, table: str) -> bool:
+    return connection.execute(
+        text("SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :t"),
+        {"t": table}
+    ).first() is not None
+
+
+def _add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def _create_month_partition(connection: Connection, month: datetime) -> None:
+    """Create the partition holding one calendar month of conversation_logs"""
+    name = f"conversation_logs_{month:%Y_%m}"
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF conversation_logs "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{_add_months(month, 1):%Y-%m-%d}')"
+    ))
+
+
+def partition_conversation_logs(connection: Connection) -> None:
+    """
+    Make conversation_logs a table partitioned by month (PostgreSQL only)
+
+    An unpartitioned table is converted once by copying its rows into a new
+    partitioned table. Afterwards each run only creates upcoming partitions, so
+    old months can later be detached or dropped instead of deleted row by row.
+    """
+    this_month = _current_month()
+
+    if not _is_partitioned(connection, "conversation_logs"):
+        logger.info("Converting conversation_logs to a partitioned table")
+        oldest = connection.execute(text("SELECT min(timestamp) FROM conversation_logs")).scalar()
+        connection.execute(text("ALTER TABLE conversation_logs RENAME TO conversation_logs_unpartitioned"))
+        # Free the primary key and index names for the new table
+        connection.execute(text(
+            "ALTER TABLE conversation_logs_unpartitioned "
+            "RENAME CONSTRAINT conversation_logs_pkey TO conversation_logs_unpartitioned_pkey"
+        ))
+        for index in ConversationLog.__table__.indexes:
+            connection.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+        connection.execute(text(
+            "CREATE TABLE conversation_logs (LIKE conversation_logs_unpartitioned INCLUDING DEFAULTS) "
+            "PARTITION BY RANGE (timestamp)"
+        ))
+        # The partition key must be part of the primary key
+        connection.execute(text("ALTER TABLE conversation_logs ADD PRIMARY KEY (id, timestamp)"))
+        connection.execute(text("ALTER SEQUENCE conversation_logs_id_seq OWNED BY conversation_logs.id"))
+        connection.execute(text("CREATE TABLE conversation_logs_default PARTITION OF conversation_logs DEFAULT"))
+
+        month = oldest.replace(day=1, hour=0, minute=0, second=0, microsecond=0) if oldest else this_month
+        while month <= this_month:
+            _create_month_partition(connection, month)
+            month = _add_months(month, 1)
+
+        connection.execute(text(
+            "INSERT INTO conversation_logs (id, user_id, user_name, question, answer, timestamp, thread_id, response_time) "
+            "SELECT id, user_id, user_name, question, answer, COALESCE(timestamp, now()), thread_id, response_time "
+            "FROM conversation_logs_unpartitioned"
+        ))
+        connection.execute(text("DROP TABLE conversation_logs_unpartitioned"))
+        # Indexes on the parent are created on every partition
+        for index in ConversationLog.__table__.indexes:
+            index.create(connection)
+
+    _create_upcoming_partitions(connection)
+
+
+def create_upcoming_partitions(connection: Connection) -> None:
+    """
+    Create the partitions for this month and the next PARTITION_MONTHS_AHEAD months
+
+    Run periodically by the retention job, so a long-running bot never reaches
+    a month without a partition. Does nothing unless conversation_logs is partitioned.
+    """
+    if connection.dialect.name == "postgresql" and _is_partitioned(connection, "conversation_logs"):
+        _create_upcoming_partitions(connection)
+
+
+def _current_month() -> datetime:
+    return datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _create_upcoming_partitions(connection: Connection) -> None:
+    this_month = _current_month()
+    for months in range(PARTITION_MONTHS_AHEAD + 1):
+        # Partitions can't be created for ranges that already have rows in the default partition
+        try:
+            with connection.begin_nested():
+                _create_month_partition(connection, _add_months(this_month, months))
+        except Exception as e:
+            logger.error(f"Failed to create conversation_logs partition: {e}")
@@ -3,11 +3,21 @@ Database models for the Telegram bot
 Handles conversation logging and user thread management
 """
 
+import asyncio
 import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean
+from typing import Dict, Iterator, List, Optional
+from sqlalchemy import create_engine, event, BigInteger, Column, Index, Integer, String, Text, DateTime, Boolean
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from metrics import Counter, Gauge, Histogram
 
 Base = declarative_base()
 
@@ -16,7 +26,7 @@ class User(Base):
     __tablename__ = 'users'
     
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, nullable=False)
+    telegram_id = Column(BigInteger, unique=True, nullable=False)
     username = Column(String(100))
     first_name = Column(String(100))
     last_name = Column(String(100))
@@ -27,9 +37,16 @@ class User(Base):
 class ConversationLog(Base):
     """Conversation logging model"""
     __tablename__ = 'conversation_logs'
+    __table_args__ = (
+        # Recent conversations across all users
+        Index('ix_conversation_logs_timestamp', 'timestamp'),
+        # A user's history, newest first
+        Index('ix_conversation_logs_user_id_timestamp', 'user_id', 'timestamp'),
+        Index('ix_conversation_logs_thread_id', 'thread_id'),
+    )
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False)
+    user_id = Column(BigInteger, nullable=False)
     user_name = Column(String(200))
     question = Column(Text, nullable=False)
     answer = Column(Text, nullable=False)
@@ -42,25 +59,273 @@ class UserThread(Base):
     __tablename__ = 'user_threads'
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, unique=True, nullable=False)
+    user_id = Column(BigInteger, unique=True, nullable=False)
     thread_id = Column(String(100), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)  # for idle thread expiry
+
+class ProcessedUpdate(Base):
+    """Telegram updates already claimed by an instance, so redelivered updates are skipped"""
+    __tablename__ = 'processed_updates'
+    
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    instance_id = Column(String(100))
+    processed_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class UserLock(Base):
+    """Instance currently handling a user's messages"""
+    __tablename__ = 'user_locks'
+    
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    owner = Column(String(100), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+class QueuedUpdate(Base):
+    """Telegram update fetched by the polling leader, waiting to be handled by any instance"""
+    __tablename__ = 'update_queue'
+    
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    payload = Column(Text, nullable=False)  # Update as JSON
+    claimed_by = Column(String(100))
+    claimed_until = Column(DateTime, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Session shared by nested session_scope() calls in the current context (e.g. one Telegram update)
+_current_session: ContextVar[Optional[Session]] = ContextVar("current_session", default=None)
+
+
+# An update's connection goes back to the pool once no service call has used it for this long,
+# so back-to-back calls share it but it isn't held while the update waits on something slow
+UPDATE_CONNECTION_IDLE_SECONDS = 0.05
+
+
+class UpdateConnection:
+    """
+    Pooled connection shared by the session scopes of one Telegram update
+
+    Checked out by the first scope that needs it and kept across the update's
+    transactions, so an update making several database calls in a row takes one
+    connection from the pool instead of one per call. Each scope still commits on
+    its own. Service calls report to begin_call()/end_call() on the event loop, and
+    the connection is released when none has run for UPDATE_CONNECTION_IDLE_SECONDS.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self._connection: Optional[Connection] = None
+        # Scopes of one update run one at a time, but in different worker threads
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._idle_timer: Optional[asyncio.TimerHandle] = None
+
+    def begin_call(self) -> None:
+        """Note a service call starting, keeping the connection checked out"""
+        self._calls += 1
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def end_call(self) -> None:
+        """Note a service call finishing; the connection is released unless another call follows soon"""
+        self._calls -= 1
+        if self._calls == 0:
+            loop = asyncio.get_running_loop()
+            self._idle_timer = loop.call_later(UPDATE_CONNECTION_IDLE_SECONDS, self._on_idle, loop)
+
+    def _on_idle(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._idle_timer = None
+        loop.run_in_executor(None, self._release_if_idle)
+
+    def _release_if_idle(self) -> None:
+        with self._lock:
+            # A call that started meanwhile keeps the connection
+            if self._calls == 0 and self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def acquire(self) -> Connection:
+        with self._lock:
+            if self._connection is None:
+                self._connection = self.engine.connect()
+            return self._connection
+
+    def release(self) -> None:
+        """Return the connection to the pool; the next scope checks out another"""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+# Connection of the update handled in the current context, see DatabaseService.update_scope()
+_current_update: ContextVar[Optional[UpdateConnection]] = ContextVar("current_update", default=None)
+
+# Connection checkouts slower than this are counted as pool waits
+POOL_WAIT_THRESHOLD_SECONDS = 0.005
+
+
+# Dialects with INSERT ... ON CONFLICT DO UPDATE
+UPSERT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+def upsert_statement(dialect_name: str, model, rows: List[Dict], conflict_columns: List[str],
+                     update_columns: List[str], where=None):
+    """
+    Build a single-statement upsert for the given rows
+    
+    Args:
+        dialect_name: Database dialect, e.g. "postgresql"
+        model: Mapped class to insert into
+        rows: Column values, at most one row per conflict key
+        conflict_columns: Unique columns identifying an existing row
+        update_columns: Columns overwritten with the new values when the row exists
+        where: Optional condition an existing row must meet to be updated
+    
+    Returns:
+        INSERT ... ON CONFLICT DO UPDATE statement, or None if the dialect has no upsert
+    """
+    insert = UPSERT_INSERTS.get(dialect_name)
+    if insert is None:
+        return None
+    statement = insert(model).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=conflict_columns,
+        set_={column: statement.excluded[column] for column in update_columns},
+        where=where
+    )
+
+
+def insert_ignore_statement(dialect_name: str, model, rows: List[Dict]):
+    """
+    Build an insert that skips rows whose unique key already exists
+    
+    Returns:
+        INSERT ... ON CONFLICT DO NOTHING statement, or None if the dialect has no upsert
+    """
+    insert = UPSERT_INSERTS.get(dialect_name)
+    if insert is None:
+        return None
+    return insert(model).values(rows).on_conflict_do_nothing()
+
+
+def pool_options(database_url: str) -> Dict:
+    """Connection pool settings from the environment"""
+    options = {
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    }
+    # SQLite uses its own pooling; size/overflow/timeout apply to server databases
+    if not database_url.startswith("sqlite"):
+        options.update({
+            "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+            "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "20")),
+            "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),
+        })
+    return options
+
+
+DB_QUERY_SECONDS = Histogram("bot_db_query_seconds", "Database statement execution time", ["statement"])
+DB_ERRORS = Counter("bot_db_errors_total", "Database statements that failed", ["statement"])
+DB_POOL_WAIT_SECONDS = Histogram("bot_db_pool_wait_seconds", "Time taken to check out a pooled connection")
+DB_POOL_CHECKOUTS = Counter("bot_db_pool_checkouts_total", "Connections checked out of the pool")
+DB_POOL_TIMEOUTS = Counter("bot_db_pool_timeouts_total", "Session scopes that gave up waiting for a pooled connection")
+DB_POOL_IN_USE = Gauge("bot_db_pool_connections_in_use", "Pooled connections currently checked out")
+
+# Statements are labelled by their leading keyword, anything else is "other"
+STATEMENT_KINDS = {"select", "insert", "update", "delete"}
+
+
+def _statement_kind(statement: Optional[str]) -> str:
+    words = (statement or "").split(None, 1)
+    kind = words[0].lower() if words else ""
+    return kind if kind in STATEMENT_KINDS else "other"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault("query_start_times", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    start_time = conn.info["query_start_times"].pop()
+    DB_QUERY_SECONDS.observe(time.perf_counter() - start_time, statement=_statement_kind(statement))
+
+
+def _on_query_error(context) -> None:
+    start_times = context.connection.info.get("query_start_times") if context.connection is not None else None
+    if start_times:
+        start_times.pop()
+    DB_ERRORS.inc(statement=_statement_kind(context.statement))
+
+
+def track_query_latency(engine: Engine) -> None:
+    """Record the execution time of every statement run on engine (the sync_engine of an async engine)"""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _on_query_error)
+
 
 # Database connection setup
 class DatabaseManager:
     """Database connection and session management"""
     
-    def __init__(self):
-        self.database_url = os.getenv('DATABASE_URL')
-        if not self.database_url:
-            raise ValueError("DATABASE_URL environment variable not set")
-        
-        self.engine = create_engine(self.database_url)
+    def __init__(self, engine: Optional[Engine] = None):
+        """
+        Args:
+            engine: Engine to manage sessions for, e.g. the sync_engine of an async engine;
+                by default one is created from DATABASE_URL along with missing tables
+        """
+        if engine is None:
+            self.database_url = os.getenv('DATABASE_URL')
+            if not self.database_url:
+                raise ValueError("DATABASE_URL environment variable not set")
+            self.engine = create_engine(self.database_url, **pool_options(self.database_url))
+        else:
+            self.database_url = engine.url.render_as_string(hide_password=False)
+            self.engine = engine
         self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
         
+        # Pool metrics
+        self._metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self._scopes = 0
+        self._total_wait = 0.0
+        event.listen(self.engine, "checkout", self._on_checkout)
+        event.listen(self.engine, "checkin", self._on_checkin)
+        track_query_latency(self.engine)
+        
         # Create tables
-        Base.metadata.create_all(bind=self.engine)
+        if engine is None:
+            Base.metadata.create_all(bind=self.engine)
+    
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy) -> None:
+        DB_POOL_CHECKOUTS.inc()
+        DB_POOL_IN_USE.inc()
+        with self._metrics_lock:
+            self.checkouts += 1
+    
+    def _on_checkin(self, dbapi_connection, connection_record) -> None:
+        DB_POOL_IN_USE.dec()
+    
+    def record_checkout_wait(self, wait_time: float) -> None:
+        """Record how long a session scope waited for its connection"""
+        DB_POOL_WAIT_SECONDS.observe(wait_time)
+        with self._metrics_lock:
+            self._scopes += 1
+            self._total_wait += wait_time
+            if wait_time > POOL_WAIT_THRESHOLD_SECONDS:
+                self.waits += 1
+    
+    def record_timeout(self) -> None:
+        """Count a session scope that gave up waiting for a connection"""
+        DB_POOL_TIMEOUTS.inc()
+        with self._metrics_lock:
+            self.timeouts += 1
     
     def get_session(self):
         """Get database session"""
@@ -68,4 +333,63 @@ class DatabaseManager:
     
     def close_session(self, session):
         """Close database session"""
-        session.close()
\ No newline at end of file
+        session.close()
+    
+    @contextmanager
+    def session_scope(self) -> Iterator[Session]:
+        """
+        Provide a transactional session, reusing the session of an enclosing scope
+        
+        The outermost scope acquires a pooled connection up front (recording how long
+        that took), commits on success, rolls back on error and closes the session.
+        Wrap all database work for one update in a single scope to share one session.
+        Inside DatabaseService.update_scope() outermost scopes use the update's connection.
+        """
+        session = _current_session.get()
+        if session is not None:
+            yield session
+            # Make this unit's changes visible to later queries in the enclosing scope
+            session.flush()
+            return
+        
+        update = _current_update.get()
+        session = self.SessionLocal()
+        token = _current_session.set(session)
+        try:
+            start_time = time.perf_counter()
+            try:
+                if update is not None:
+                    # Inside an update scope, sessions share the update's connection
+                    session.bind = update.acquire()
+                session.connection()
+            except PoolTimeoutError:
+                self.record_timeout()
+                raise
+            self.record_checkout_wait(time.perf_counter() - start_time)
+            
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            if update is not None:
+                # The connection may be broken; later scopes of the update check out another
+                update.release()
+            raise
+        finally:
+            _current_session.reset(token)
+            session.close()
+    
+    def get_pool_stats(self) -> Dict[str, float]:
+        """Get connection pool statistics"""
+        pool = self.engine.pool
+        stats = {
+            "checkouts": self.checkouts,
+            "waits": self.waits,
+            "timeouts": self.timeouts,
+            "avg_checkout_ms": round(self._total_wait / self._scopes * 1000, 2) if self._scopes else 0.0,
+        }
+        # Pool implementations without a fixed size (e.g. SQLite) lack these
+        for name in ("size", "checkedout", "overflow", "checkedin"):
+            if hasattr(pool, name):
+                stats[name] = getattr(pool, name)()
+        return stats
\ No newline at end of file
@@ -5,18 +5,107 @@ Handles communication with OpenAI Assistant API for intelligent responses
 
 import logging
 import asyncio
-from typing import Optional
-from openai import OpenAI
+import time
+from typing import AsyncIterator, Dict, Optional
+import httpx
+from openai import APIStatusError, AsyncOpenAI, DefaultAsyncHttpxClient
 from config import Config
+from metrics import Counter, Histogram
+from run_poller import LatencyProfile, RunPoller, parse_delay_header
+from tracing import TRACER, traced
+
+OPENAI_RUN_PHASE_SECONDS = Histogram("bot_openai_run_phase_seconds", "Time assistant runs spent queued and in progress",
+                                     ["phase"], buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300))
+OPENAI_RUN_POLLS = Histogram("bot_openai_run_polls", "Status checks needed per polled run",
+                             buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64))
+OPENAI_RUNS = Counter("bot_openai_runs_total", "Finished assistant runs by final status", ["mode", "status"])
+OPENAI_RETRIES = Counter("bot_openai_retries_total", "Retried run status checks")
+OPENAI_ERRORS = Counter("bot_openai_errors_total", "Assistant responses that failed", ["mode"])
+
+
+class RunTimer:
+    """Splits an assistant run's duration into time queued and time in progress, from the statuses seen"""
+    
+    def __init__(self, mode: str):
+        self.mode = mode
+        # Timings are also added to the span the run is started in
+        self.span = TRACER.current_span()
+        self.polls = 0
+        self._created_at = time.perf_counter()
+        self._started_at: Optional[float] = None
+        self._finished = False
+    
+    def observe(self, status: str) -> None:
+        """Note the run's current status"""
+        if status != "queued" and self._started_at is None:
+            self._started_at = time.perf_counter()
+    
+    def finish(self, status: str) -> None:
+        """Record the run's timings once, when it reaches its final status"""
+        if self._finished:
+            return
+        self._finished = True
+        now = time.perf_counter()
+        started_at = self._started_at if self._started_at is not None else now
+        OPENAI_RUN_PHASE_SECONDS.observe(started_at - self._created_at, phase="queued")
+        if self._started_at is not None:
+            OPENAI_RUN_PHASE_SECONDS.observe(now - self._started_at, phase="in_progress")
+        if self.mode == "poll":
+            OPENAI_RUN_POLLS.observe(self.polls)
+            self.span.set_attribute("polls", self.polls)
+        OPENAI_RUNS.inc(mode=self.mode, status=status)
+        
+        self.span.set_attribute("run_status", status)
+        self.span.set_attribute("queued_ms", round((started_at - self._created_at) * 1000))
+        self.span.set_attribute("in_progress_ms", round((now - started_at) * 1000))
+
+
+def create_async_client(config: Config, http_client: Optional[httpx.AsyncClient] = None) -> AsyncOpenAI:
+    """
+    Create an AsyncOpenAI client backed by a pooled HTTP transport
+    
+    Args:
+        config: Bot configuration with connection pool settings
+        http_client: Optional pre-built HTTP client (e.g. for load testing)
+        
+    Returns:
+        AsyncOpenAI client whose connections are reused across requests
+    """
+    if http_client is None:
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=config.OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=config.OPENAI_MAX_KEEPALIVE,
+                keepalive_expiry=config.OPENAI_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(
+                config.OPENAI_REQUEST_TIMEOUT,
+                connect=config.OPENAI_CONNECT_TIMEOUT
+            )
+        )
+    return AsyncOpenAI(
+        api_key=config.OPENAI_API_KEY,
+        http_client=http_client,
+        max_retries=config.MAX_RETRIES
+    )
+
 
 class OpenAIService:
     """Service for interacting with OpenAI Assistant API"""
     
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, client: Optional[AsyncOpenAI] = None):
         self.config = config
-        self.client = OpenAI(api_key=config.OPENAI_API_KEY)
+        self.client = client or create_async_client(config)
+        # Status checks are retried by _wait_for_completion, so the SDK must not retry them as well
+        self._poll_client = self.client.with_options(max_retries=0)
         self.logger = logging.getLogger(__name__)
+        self._latency_profiles: Dict[str, LatencyProfile] = {}
+    
+    def get_poll_stats(self) -> Dict[str, Dict[str, float]]:
+        """Get learned run latency and polling statistics per assistant"""
+        return {assistant_id: profile.to_dict() for assistant_id, profile in self._latency_profiles.items()}
     
+    @traced("get_assistant_response")
     async def get_assistant_response(self, user_message: str, thread_id: Optional[str] = None) -> str:
         """
         Get response from OpenAI Assistant
@@ -38,25 +127,28 @@ class OpenAIService:
                 actual_thread_id = thread_id
             else:
                 self.logger.debug(f"Creating new thread for message: {user_message[:50]}...")
-                thread = self.client.beta.threads.create()
+                with TRACER.span("openai.create_thread"):
+                    thread = await self.client.beta.threads.create()
                 actual_thread_id = thread.id
                 self.logger.debug(f"Created thread: {actual_thread_id}")
             
             # Add the user's message to the thread
-            self.client.beta.threads.messages.create(
-                thread_id=actual_thread_id,
-                role="user",
-                content=user_message
-            )
+            with TRACER.span("openai.create_message"):
+                await self.client.beta.threads.messages.create(
+                    thread_id=actual_thread_id,
+                    role="user",
+                    content=user_message
+                )
             
             # Create and start a run with the assistant
             if not self.config.ASSISTANT_ID:
                 raise Exception("Assistant ID not configured")
                 
-            run = self.client.beta.threads.runs.create(
-                assistant_id=self.config.ASSISTANT_ID,
-                thread_id=actual_thread_id
-            )
+            with TRACER.span("openai.create_run"):
+                run = await self.client.beta.threads.runs.create(
+                    assistant_id=self.config.ASSISTANT_ID,
+                    thread_id=actual_thread_id
+                )
             
             self.logger.debug(f"Started run: {run.id}")
             
@@ -67,9 +159,106 @@ class OpenAIService:
             return response_text
             
         except Exception as e:
+            OPENAI_ERRORS.inc(mode="poll")
             self.logger.error(f"Error getting assistant response: {str(e)}")
             raise Exception("Failed to get response from AI assistant. Please try again.")
     
+    async def stream_assistant_response(self, user_message: str, thread_id: str) -> AsyncIterator[str]:
+        """
+        Stream response from OpenAI Assistant as text fragments
+        
+        Args:
+            user_message: The user's message to process
+            thread_id: Thread ID for context persistence
+            
+        Yields:
+            Pieces of the assistant's response as soon as they are generated
+            
+        Raises:
+            Exception: If the API call fails, the run fails or times out
+        """
+        timer: Optional[RunTimer] = None
+        try:
+            if not self.config.ASSISTANT_ID:
+                raise Exception("Assistant ID not configured")
+            
+            with TRACER.span("openai.create_message"):
+                await self.client.beta.threads.messages.create(
+                    thread_id=thread_id,
+                    role="user",
+                    content=user_message
+                )
+            
+            stream = await self.client.beta.threads.runs.create(
+                assistant_id=self.config.ASSISTANT_ID,
+                thread_id=thread_id,
+                stream=True
+            )
+            
+            start_time = asyncio.get_running_loop().time()
+            async with stream:
+                async for event in stream:
+                    if asyncio.get_running_loop().time() - start_time > self.config.TIMEOUT_SECONDS:
+                        raise Exception(f"Assistant response timed out after {self.config.TIMEOUT_SECONDS} seconds")
+                    
+                    if event.event == "thread.run.created":
+                        timer = RunTimer("stream")
+                        self.logger.debug(f"Started streaming run: {event.data.id}")
+                        
+                    elif event.event == "thread.run.in_progress":
+                        if timer:
+                            timer.observe(event.data.status)
+                            
+                    elif event.event == "thread.run.completed":
+                        if timer:
+                            timer.finish(event.data.status)
+                    
+                    elif event.event == "thread.message.delta":
+                        for block in event.data.delta.content or []:
+                            if block.type == "text" and block.text and block.text.value:
+                                yield block.text.value
+                    
+                    elif event.event in ["thread.run.failed", "thread.run.cancelled", "thread.run.expired"]:
+                        if timer:
+                            timer.finish(event.data.status)
+                        error_msg = f"Assistant run {event.data.status}"
+                        if event.data.last_error:
+                            error_msg += f": {event.data.last_error}"
+                        raise Exception(error_msg)
+                    
+                    elif event.event == "error":
+                        raise Exception(f"Assistant stream error: {event.data}")
+            
+            self.logger.info("Successfully streamed response from OpenAI Assistant")
+            
+        except Exception as e:
+            if timer:
+                timer.finish("error")
+            OPENAI_ERRORS.inc(mode="stream")
+            self.logger.error(f"Error streaming assistant response: {str(e)}")
+            raise Exception("Failed to get response from AI assistant. Please try again.")
+    
+    def _extract_text(self, messages: list) -> str:
+        """
+        Join the text content blocks of assistant messages
+        
+        Args:
+            messages: Thread messages in chronological order
+            
+        Returns:
+            Combined response text, empty if no text content was found
+        """
+        parts = []
+        for message in messages:
+            if message.role != "assistant":
+                continue
+            for content in message.content or []:
+                # Skip non-text blocks such as images
+                if content.type == "text" and content.text.value:
+                    parts.append(content.text.value)
+        return "\n\n".join(parts)
+    
+    @traced("wait_for_completion")
     async def _wait_for_completion(self, thread_id: str, run_id: str) -> str:
         """
         Wait for the assistant run to complete and return the response
@@ -84,68 +273,92 @@ class OpenAIService:
         Raises:
             Exception: If the run fails, is cancelled, or times out
         """
-        start_time = asyncio.get_event_loop().time()
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
         retry_count = 0
         
+        profile = self._latency_profiles.setdefault(self.config.ASSISTANT_ID, LatencyProfile())
+        poller = RunPoller(self.config, profile)
+        timer = RunTimer("poll")
+        
+        # A run is never finished right after creation, so wait before the first check
+        await asyncio.sleep(poller.next_delay(0.0))
+        
         while retry_count < self.config.MAX_RETRIES:
             try:
                 # Check if we've exceeded the timeout
-                elapsed_time = asyncio.get_event_loop().time() - start_time
+                elapsed_time = loop.time() - start_time
                 if elapsed_time > self.config.TIMEOUT_SECONDS:
                     raise Exception(f"Assistant response timed out after {self.config.TIMEOUT_SECONDS} seconds")
                 
-                # Check the run status
-                run_status = self.client.beta.threads.runs.retrieve(
-                    thread_id=thread_id, 
-                    run_id=run_id
-                )
+                # Check the run status; counted up front so that checks which fail and are retried count too
+                timer.polls += 1
+                with TRACER.span("openai.retrieve_run"):
+                    raw_response = await self._poll_client.beta.threads.runs.with_raw_response.retrieve(
+                        thread_id=thread_id, 
+                        run_id=run_id
+                    )
+                run_status = raw_response.parse()
+                timer.observe(run_status.status)
+                poll_hint = parse_delay_header(raw_response.headers, "openai-poll-after-ms", scale=0.001)
                 
                 self.logger.debug(f"Run status: {run_status.status}")
                 
                 if run_status.status == "completed":
-                    # Get the assistant's response
-                    messages = self.client.beta.threads.messages.list(thread_id=thread_id)
+                    poller.complete(loop.time() - start_time)
+                    timer.finish(run_status.status)
+                    
+                    # Get only the messages produced by this run, oldest first
+                    with TRACER.span("openai.list_messages"):
+                        messages = await self._poll_client.beta.threads.messages.list(
+                            thread_id=thread_id,
+                            run_id=run_id,
+                            order="asc",
+                            limit=self.config.RUN_MESSAGES_LIMIT
+                        )
                     
                     if not messages.data:
                         raise Exception("No response received from assistant")
                     
-                    # Get the latest assistant message
-                    for message in messages.data:
-                        if message.role == "assistant":
-                            if message.content and len(message.content) > 0:
-                                content = message.content[0]
-                                # Handle different content types safely
-                                try:
-                                    if hasattr(content, 'text') and content.text and hasattr(content.text, 'value'):
-                                        return content.text.value
-                                except AttributeError:
-                                    continue
+                    response_text = self._extract_text(messages.data)
+                    if response_text:
+                        return response_text
                     
                     raise Exception("No valid response content found")
                 
                 elif run_status.status in ["failed", "cancelled", "expired"]:
+                    timer.finish(run_status.status)
                     error_msg = f"Assistant run {run_status.status}"
                     if hasattr(run_status, 'last_error') and run_status.last_error:
                         error_msg += f": {run_status.last_error}"
                     raise Exception(error_msg)
                 
                 elif run_status.status in ["queued", "in_progress", "cancelling"]:
-                    # Still processing, wait a bit
-                    await asyncio.sleep(1)
+                    # Still processing, wait until the next scheduled check
+                    await asyncio.sleep(poller.next_delay(loop.time() - start_time, poll_hint))
                     continue
                 
                 else:
                     # Unknown status, wait and retry
                     self.logger.warning(f"Unknown run status: {run_status.status}")
-                    await asyncio.sleep(1)
+                    await asyncio.sleep(poller.next_delay(loop.time() - start_time, poll_hint))
                     continue
                     
             except Exception as e:
                 retry_count += 1
                 if retry_count >= self.config.MAX_RETRIES:
+                    timer.finish("error")
                     raise e
+                OPENAI_RETRIES.inc()
+                
+                # Exponential backoff, unless the server told us how long to wait
+                retry_after = None
+                if isinstance(e, APIStatusError):
+                    retry_after = parse_delay_header(e.response.headers, "retry-after")
+                delay = retry_after if retry_after is not None else 2 ** retry_count
                 
-                self.logger.warning(f"Retry {retry_count}/{self.config.MAX_RETRIES} after error: {str(e)}")
-                await asyncio.sleep(2 ** retry_count)  # Exponential backoff
+                self.logger.warning(f"Retry {retry_count}/{self.config.MAX_RETRIES} in {delay:.1f}s after error: {str(e)}")
+                await asyncio.sleep(delay)
         
+        timer.finish("error")
         raise Exception(f"Failed to get assistant response after {self.config.MAX_RETRIES} retries")
@@ -0,0 +1,193 @@
+"""
+Retention for conversation history
+Moves old conversations from the database into compressed daily archive files
+and deletes expired archives and rotated CSV log segments
+"""
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+import shutil
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Union
+from async_database_service import AsyncDatabaseService
+from config import Config
+from database_service import DatabaseService
+from leader_election import create_lease
+from logging_service import LoggingService
+from migrations import partitioning_enabled
+
+# Arbitrary key for the PostgreSQL advisory lock held by the instance archiving conversations
+RETENTION_LOCK_KEY = 7263493
+
+
+class ConversationArchive:
+    """Gzipped JSONL files of archived conversations, one directory per day"""
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+
+    def day_path(self, day: str) -> str:
+        return os.path.join(self.archive_dir, f"date={day}", "conversations.jsonl.gz")
+
+    def append(self, rows: List[Dict]) -> None:
+        """
+        Durably append rows to the files of the days they were logged on
+
+        Each call adds a gzip member to the day's file; readers see the
+        members as one continuous stream.
+        """
+        by_day: Dict[str, List[Dict]] = defaultdict(list)
+        for row in rows:
+            by_day[row["timestamp"].strftime("%Y-%m-%d")].append(row)
+
+        for day, day_rows in by_day.items():
+            path = self.day_path(day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "ab") as f:
+                with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                    for row in day_rows:
+                        gz.write((json.dumps(row, default=str, ensure_ascii=False) + "\n").encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read_day(self, day: str) -> List[Dict]:
+        """Read the conversations archived for one day ("%Y-%m-%d")"""
+        path = self.day_path(day)
+        if not os.path.exists(path):
+            return []
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def prune(self, before: str) -> int:
+        """Delete day directories older than a date ("%Y-%m-%d"), returning how many were deleted"""
+        if not os.path.isdir(self.archive_dir):
+            return 0
+        deleted = 0
+        for name in os.listdir(self.archive_dir):
+            if name.startswith("date=") and name[len("date="):] < before:
+                shutil.rmtree(os.path.join(self.archive_dir, name))
+                deleted += 1
+        return deleted
+
+
+class RetentionJob:
+    """
+    Periodically enforces the retention policy
+
+    Conversations older than RETENTION_DAYS are copied to the archive and then
+    deleted from the database in batches of RETENTION_BATCH_SIZE rows, each in
+    its own short transaction, so the job never holds long locks on the table.
+    Rows are archived before they are deleted: a crash in between can at worst
+    archive a batch twice, never lose it. Only the instance holding the retention
+    lease (a PostgreSQL advisory lock, or a lock file next to the archive) works
+    on the database in a run, so instances never archive the same rows; it also
+    creates upcoming conversation_logs partitions when they are enabled.
+    """
+
+    def __init__(self, config: Config, db_service: Optional[Union[DatabaseService, AsyncDatabaseService]] = None,
+                 logging_service: Optional[LoggingService] = None):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.db_service = db_service
+        self.logging_service = logging_service
+        self.archive = ConversationArchive(config.RETENTION_ARCHIVE_DIR)
+        self._lease = create_lease(config, key=RETENTION_LOCK_KEY, lock_file=f"{config.RETENTION_ARCHIVE_DIR}.lock")
+        self._task: Optional[asyncio.Task] = None
+
+        self.archived_rows = 0
+        self.last_run: Optional[datetime] = None
+
+    async def start(self) -> None:
+        """Run the job every RETENTION_INTERVAL seconds if a retention period or log partitioning is configured"""
+        if (self.config.RETENTION_DAYS <= 0 and self.config.ARCHIVE_RETENTION_DAYS <= 0
+                and not (self.db_service is not None and partitioning_enabled())):
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.logger.error(f"Retention job failed: {str(e)}")
+            await asyncio.sleep(self.config.RETENTION_INTERVAL)
+
+    async def run_once(self) -> Dict[str, int]:
+        """
+        Apply the retention policy once
+
+        Returns:
+            Number of archived rows and deleted archive files/segments
+        """
+        now = datetime.utcnow()
+        result = {"archived_rows": 0, "pruned_archive_days": 0, "pruned_csv_segments": 0}
+
+        if self.db_service is not None:
+            result["archived_rows"] = await self._run_database(now)
+
+        if self.config.ARCHIVE_RETENTION_DAYS > 0:
+            before = (now - timedelta(days=self.config.ARCHIVE_RETENTION_DAYS)).strftime("%Y-%m-%d")
+            result["pruned_archive_days"] = await asyncio.to_thread(self.archive.prune, before)
+            if self.logging_service is not None:
+                result["pruned_csv_segments"] = await asyncio.to_thread(self.logging_service.prune_csv_archives, before)
+
+        self.last_run = now
+        self.logger.info(f"Retention run finished: {result}")
+        return result
+
+    async def _run_database(self, now: datetime) -> int:
+        """
+        Create upcoming log partitions and archive old conversations, if this instance holds the lease
+
+        Returns:
+            Number of archived rows
+        """
+        if not partitioning_enabled() and self.config.RETENTION_DAYS <= 0:
+            return 0
+        if not await self._lease.acquire():
+            self.logger.debug("Another instance is running retention on the database, skipping")
+            return 0
+        try:
+            if partitioning_enabled():
+                await self.db_service.call("create_log_partitions")
+            if self.config.RETENTION_DAYS <= 0:
+                return 0
+            return await self._archive_conversations(now - timedelta(days=self.config.RETENTION_DAYS))
+        finally:
+            await self._lease.release()
+
+    async def _archive_conversations(self, cutoff: datetime) -> int:
+        """Archive and delete conversations logged before the cutoff, one batch at a time"""
+        archived = 0
+        while True:
+            rows = await self.db_service.call("get_conversations_before", cutoff, self.config.RETENTION_BATCH_SIZE)
+            if not rows:
+                break
+
+            await asyncio.to_thread(self.archive.append, rows)
+            await self.db_service.call("delete_conversations", [row["id"] for row in rows])
+            archived += len(rows)
+            self.archived_rows += len(rows)
+
+            if len(rows) < self.config.RETENTION_BATCH_SIZE:
+                break
+            # Leave room for the bot's own queries between batches
+            await asyncio.sleep(self.config.RETENTION_BATCH_PAUSE)
+
+        if archived:
+            self.logger.info(f"Archived {archived} conversations older than {cutoff:%Y-%m-%d %H:%M}")
+        return archived
+
+    async def close(self) -> None:
+        """Stop the periodic job"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,109 @@
+"""
+Adaptive polling for OpenAI Assistant runs
+Schedules run status checks using learned per-assistant latency profiles
+"""
+
+import random
+from typing import Dict, Optional
+from config import Config
+
+
+class LatencyProfile:
+    """Learned run latency for a single assistant"""
+
+    def __init__(self, smoothing: float = 0.3):
+        self.smoothing = smoothing
+        self.expected_seconds: Optional[float] = None
+        self.runs = 0
+        self.total_polls = 0
+
+    def record(self, duration: float, polls: int) -> None:
+        """
+        Update the profile with a finished run
+
+        Args:
+            duration: Seconds from run creation until completion was observed
+            polls: Number of status checks the run needed
+        """
+        if self.expected_seconds is None:
+            self.expected_seconds = duration
+        else:
+            self.expected_seconds += self.smoothing * (duration - self.expected_seconds)
+        self.runs += 1
+        self.total_polls += polls
+
+    def to_dict(self) -> Dict[str, float]:
+        """Get profile statistics"""
+        return {
+            "runs": self.runs,
+            "expected_seconds": round(self.expected_seconds or 0.0, 3),
+            "avg_polls_per_run": round(self.total_polls / self.runs, 2) if self.runs else 0.0
+        }
+
+
+class RunPoller:
+    """Computes the delay before each status check of one run"""
+
+    def __init__(self, config: Config, profile: LatencyProfile):
+        self.config = config
+        self.profile = profile
+        # next_delay() runs before every status check, including the first
+        self.polls = 0
+        self._interval = config.RUN_POLL_MIN_INTERVAL
+
+    def next_delay(self, elapsed: float, hint: Optional[float] = None) -> float:
+        """
+        Get the number of seconds to wait before the next status check
+
+        Args:
+            elapsed: Seconds since the run was created
+            hint: Minimum delay requested by the server (poll-after or Retry-After)
+
+        Returns:
+            Delay in seconds
+        """
+        self.polls += 1
+        expected = self.profile.expected_seconds
+        early_target = expected * self.config.RUN_POLL_EARLY_FRACTION if expected else 0.0
+
+        if elapsed < early_target:
+            # Skip straight to just before the run is expected to finish
+            delay = early_target - elapsed
+        else:
+            # Fast probes around the expected completion, backing off afterwards
+            delay = self._interval
+            self._interval = min(self._interval * self.config.RUN_POLL_BACKOFF, self.config.RUN_POLL_MAX_INTERVAL)
+
+        jitter = self.config.RUN_POLL_JITTER
+        delay *= random.uniform(1 - jitter, 1 + jitter)
+
+        if hint is not None:
+            delay = max(delay, hint)
+        return delay
+
+    def complete(self, elapsed: float) -> None:
+        """Record a completed run in the assistant's latency profile"""
+        self.profile.record(elapsed, self.polls)
+
+
+def parse_delay_header(headers, name: str, scale: float = 1.0) -> Optional[float]:
+    """
+    Read a numeric delay from response headers
+
+    Args:
+        headers: HTTP response headers
+        name: Header name, e.g. "retry-after" or "openai-poll-after-ms"
+        scale: Multiplier converting the header value to seconds
+
+    Returns:
+        Delay in seconds, or None if the header is missing or not numeric
+    """
+    if headers is None:
+        return None
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return max(float(value) * scale, 0.0)
+    except ValueError:
+        return None
@@ -0,0 +1,207 @@
+"""
+Shared state for running several bot instances behind a load balancer
+Skips Telegram updates that were already delivered to an instance and lets one
+instance at a time handle each user's messages
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, Optional, Tuple, Union
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+from async_database_service import AsyncDatabaseService
+from config import Config
+from database_service import DatabaseService
+
+# Poll interval while waiting for another instance to release a user
+LOCK_RETRY_INTERVAL = 0.5
+
+
+class UserLockTimeout(Exception):
+    """Raised when another instance keeps handling a user for longer than USER_LOCK_WAIT"""
+
+
+class StateStore:
+    """Key-value operations instances coordinate through"""
+
+    async def claim_update(self, update_id: int, instance_id: str) -> bool:
+        """Return True if no instance claimed the update before"""
+        raise NotImplementedError
+
+    async def forget_updates(self, before: datetime) -> int:
+        """Forget updates claimed before a time, returning how many were forgotten"""
+        raise NotImplementedError
+
+    async def acquire_user_lock(self, user_id: int, owner: str, ttl: float) -> bool:
+        """Take or extend a user's lock, returning False if another owner holds it"""
+        raise NotImplementedError
+
+    async def release_user_lock(self, user_id: int, owner: str) -> None:
+        """Release a user's lock if the owner still holds it"""
+        raise NotImplementedError
+
+
+class MemoryStateStore(StateStore):
+    """Process-local stand-in for a shared store; only coordinates tasks of one instance"""
+
+    def __init__(self):
+        self._updates: Dict[int, datetime] = {}
+        self._locks: Dict[int, Tuple[str, float]] = {}
+
+    async def claim_update(self, update_id: int, instance_id: str) -> bool:
+        if update_id in self._updates:
+            return False
+        self._updates[update_id] = datetime.utcnow()
+        return True
+
+    async def forget_updates(self, before: datetime) -> int:
+        expired = [update_id for update_id, claimed_at in self._updates.items() if claimed_at < before]
+        for update_id in expired:
+            del self._updates[update_id]
+        return len(expired)
+
+    async def acquire_user_lock(self, user_id: int, owner: str, ttl: float) -> bool:
+        now = time.time()
+        holder = self._locks.get(user_id)
+        if holder is not None and holder[0] != owner and holder[1] > now:
+            return False
+        self._locks[user_id] = (owner, now + ttl)
+        return True
+
+    async def release_user_lock(self, user_id: int, owner: str) -> None:
+        if self._locks.get(user_id, (None, 0))[0] == owner:
+            del self._locks[user_id]
+
+
+class DatabaseStateStore(StateStore):
+    """Shared store backed by the processed_updates and user_locks tables"""
+
+    def __init__(self, db_service: Union[DatabaseService, AsyncDatabaseService]):
+        self.db_service = db_service
+
+    async def claim_update(self, update_id: int, instance_id: str) -> bool:
+        return await self.db_service.call("claim_update", update_id, instance_id)
+
+    async def forget_updates(self, before: datetime) -> int:
+        return await self.db_service.call("delete_processed_updates", before)
+
+    async def acquire_user_lock(self, user_id: int, owner: str, ttl: float) -> bool:
+        return await self.db_service.call("acquire_user_lock", user_id, owner, ttl)
+
+    async def release_user_lock(self, user_id: int, owner: str) -> None:
+        await self.db_service.call("release_user_lock", user_id, owner)
+
+
+class InstanceCoordinator:
+    """
+    Coordinates this instance with the others sharing the store
+
+    Every update is claimed by its update_id before any handler runs, so an
+    update Telegram redelivers (e.g. after a webhook timeout) is answered once.
+    A user's messages are handled under a lock held by one instance, renewed
+    while its turns run, so two replicas never run the same user's thread.
+    Store failures are logged and let the update through: answering twice is
+    better than not answering.
+    """
+
+    def __init__(self, config: Config, store: StateStore):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.store = store
+        self.instance_id = config.INSTANCE_ID or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._cleanup_task: Optional[asyncio.Task] = None
+
+        self.duplicate_updates = 0
+        self.lock_waits = 0
+
+    async def filter_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Stop handling of updates another delivery already claimed (registered before all other handlers)
+
+        Raises:
+            ApplicationHandlerStop: If the update was claimed before
+        """
+        try:
+            claimed = await self.store.claim_update(update.update_id, self.instance_id)
+        except Exception as e:
+            self.logger.error(f"Failed to claim update {update.update_id}: {str(e)}")
+            return
+
+        if not claimed:
+            self.duplicate_updates += 1
+            self.logger.info(f"Skipping update {update.update_id}, already handled")
+            raise ApplicationHandlerStop
+
+    @asynccontextmanager
+    async def user_lock(self, user_id: int) -> AsyncIterator[None]:
+        """
+        Hold the user's lock, waiting up to USER_LOCK_WAIT seconds for another instance to release it
+
+        Raises:
+            UserLockTimeout: If the lock is still held by another instance after the wait
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.config.USER_LOCK_WAIT
+        waited = False
+        while not await self._acquire(user_id):
+            if loop.time() >= deadline:
+                raise UserLockTimeout(f"User {user_id} is handled by another instance")
+            if not waited:
+                waited = True
+                self.lock_waits += 1
+                self.logger.debug(f"Waiting for another instance to finish with user {user_id}")
+            await asyncio.sleep(LOCK_RETRY_INTERVAL)
+
+        renew_task = asyncio.create_task(self._renew(user_id))
+        try:
+            yield
+        finally:
+            renew_task.cancel()
+            try:
+                await self.store.release_user_lock(user_id, self.instance_id)
+            except Exception as e:
+                self.logger.error(f"Failed to release lock of user {user_id}: {str(e)}")
+
+    async def _acquire(self, user_id: int) -> bool:
+        try:
+            return await self.store.acquire_user_lock(user_id, self.instance_id, self.config.USER_LOCK_TTL)
+        except Exception as e:
+            self.logger.error(f"Failed to lock user {user_id}, handling without the lock: {str(e)}")
+            return True
+
+    async def _renew(self, user_id: int) -> None:
+        """Extend the lock while turns take longer than its TTL"""
+        while True:
+            await asyncio.sleep(self.config.USER_LOCK_TTL / 3)
+            if not await self._acquire(user_id):
+                self.logger.warning(f"Lock of user {user_id} expired and was taken by another instance")
+
+    async def start(self) -> None:
+        """Periodically forget updates older than UPDATE_DEDUP_TTL"""
+        if self._cleanup_task is None or self._cleanup_task.done():
+            self._cleanup_task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(min(3600, self.config.UPDATE_DEDUP_TTL))
+            try:
+                before = datetime.utcnow() - timedelta(seconds=self.config.UPDATE_DEDUP_TTL)
+                forgotten = await self.store.forget_updates(before)
+                self.logger.debug(f"Forgot {forgotten} processed updates")
+            except Exception as e:
+                self.logger.error(f"Failed to forget processed updates: {str(e)}")
+
+    async def close(self) -> None:
+        """Stop the cleanup task"""
+        if self._cleanup_task is not None and not self._cleanup_task.done():
+            self._cleanup_task.cancel()
+            try:
+                await self._cleanup_task
+            except asyncio.CancelledError:
+                pass
@@ -7,11 +7,9 @@ Pure polling mode implementation
 import os
 import sys
 import logging
-from telegram.ext import Application, MessageHandler, CommandHandler, filters
+from app_container import AppContainer
 from config import Config
-from bot_handler import BotHandler
-from command_handler import CommandHandler as BotCommandHandler
-from thread_manager import ThreadManager
+from leader_election import PollingLeader, create_lease
 from utils import setup_logging
 
 def start_bot_with_polling():
@@ -27,30 +25,10 @@ def start_bot_with_polling():
         logger.info("Starting Telegram bot in polling mode...")
         logger.info(f"Bot will use Assistant ID: {config.ASSISTANT_ID}")
         
-        # Initialize components
-        bot_handler = BotHandler(config)
-        thread_manager = ThreadManager(config)
-        command_handler = BotCommandHandler(config, thread_manager)
-        
-        # Create application with proper token validation
-        if not config.TELEGRAM_TOKEN:
-            raise ValueError("TELEGRAM_TOKEN is required")
-            
-        application = Application.builder().token(config.TELEGRAM_TOKEN).build()
-        
-        # Add command handlers
-        application.add_handler(CommandHandler("reset", command_handler.handle_reset))
-        application.add_handler(CommandHandler("stats", command_handler.handle_stats))
-        
-        # Add message handler for text messages (excluding commands)
-        message_handler = MessageHandler(
-            filters.TEXT & ~filters.COMMAND, 
-            bot_handler.handle_message
-        )
-        application.add_handler(message_handler)
-        
-        # Add error handler
-        application.add_error_handler(bot_handler.handle_error)
+        # Initialize components once and share them between all handlers; there is no
+        # webhook server in polling mode, so metrics get a port of their own
+        container = AppContainer(config, metrics_port=config.METRICS_PORT if config.ENABLE_METRICS else None)
+        application = container.build_application()
         
         # Log configuration
         logger.info(f"Configuration: {config}")
@@ -62,11 +40,17 @@ def start_bot_with_polling():
         logger.info("Starting bot in polling mode...")
         logger.info("Bot started successfully. Listening for messages...")
         
-        # Run the bot with simple polling - will clear webhooks automatically
-        application.run_polling(
-            allowed_updates=["message"],
-            drop_pending_updates=True
-        )
+        if config.LEADER_ELECTION:
+            # Only the elected instance polls; the others stand by (or handle queued updates)
+            leader = PollingLeader(config, application, create_lease(config),
+                                   db_service=container.db_service, coordinator=container.coordinator)
+            leader.run()
+        else:
+            # Run the bot with simple polling - will clear webhooks automatically
+            application.run_polling(
+                allowed_updates=["message"],
+                drop_pending_updates=True
+            )
         
     except Exception as e:
         logging.error(f"Failed to start bot: {str(e)}")
@@ -6,12 +6,10 @@ Production webhook mode for Telegram bot
 import os
 import logging
 import sys
-from telegram.ext import Application, MessageHandler, CommandHandler, filters
+from app_container import AppContainer
 from config import Config
-from bot_handler import BotHandler
-from command_handler import CommandHandler as BotCommandHandler
-from thread_manager import ThreadManager
 from utils import setup_logging
+from webhook_server import WebhookServer
 
 def start_bot_with_webhook():
     """Start bot in webhook mode for production"""
@@ -28,30 +26,9 @@ def start_bot_with_webhook():
         logger.info("Starting Telegram bot in webhook mode...")
         logger.info(f"Bot will use Assistant ID: {config.ASSISTANT_ID}")
         
-        # Initialize components
-        bot_handler = BotHandler(config)
-        thread_manager = ThreadManager(config)
-        command_handler = BotCommandHandler(config, thread_manager)
-        
-        # Create application
-        if not config.TELEGRAM_TOKEN:
-            raise ValueError("TELEGRAM_TOKEN is required")
-            
-        application = Application.builder().token(config.TELEGRAM_TOKEN).build()
-        
-        # Add command handlers
-        application.add_handler(CommandHandler("reset", command_handler.handle_reset))
-        application.add_handler(CommandHandler("stats", command_handler.handle_stats))
-        
-        # Add message handler
-        message_handler = MessageHandler(
-            filters.TEXT & ~filters.COMMAND, 
-            bot_handler.handle_message
-        )
-        application.add_handler(message_handler)
-        
-        # Add error handler
-        application.add_error_handler(bot_handler.handle_error)
+        # Initialize components once and share them between all handlers
+        container = AppContainer(config)
+        application = container.build_application()
         
         # Log configuration
         logger.info(f"Configuration: {config}")
@@ -74,18 +51,15 @@ def start_bot_with_webhook():
         logger.info(f"Starting webhook server on port {config.PORT}")
         logger.info(f"Webhook URL: {webhook_url}")
         
-        logger.info("✅ All init done. Running application.run_webhook...")
+        logger.info("✅ All init done. Starting webhook server...")
         
-        # Start webhook mode
+        # Start webhook mode: updates are acknowledged once queued and handled by a worker pool
         try:
-            application.run_webhook(
-                listen="0.0.0.0",
-                port=config.PORT,
-                webhook_url=webhook_url,
-                drop_pending_updates=True
-            )
+            server = WebhookServer(config, application, db_service=container.db_service,
+                                   coordinator=container.coordinator)
+            server.run(webhook_url)
         except Exception as e:
-            logger.exception(f"❌ run_webhook crashed with error: {e}")
+            logger.exception(f"❌ Webhook server crashed with error: {e}")
             sys.exit(1)
         
     except Exception as e:
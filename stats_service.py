@@ -0,0 +1,162 @@
+"""
+Statistics service for the /stats command
+Maintains conversation counters, message rates and latency percentiles in memory,
+reconciling totals with the database periodically instead of on every request
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple, Union
+from async_database_service import AsyncDatabaseService
+from config import Config
+from database_service import DatabaseService
+from thread_manager import ThreadManager
+from user_activity import UserActivityTracker
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class StatsService:
+    """
+    O(1) bot statistics
+
+    Totals are counted from the database every STATS_RECONCILE_INTERVAL seconds
+    and incremented in between as conversations are logged and users and threads
+    are added. Snapshots are cached for STATS_CACHE_TTL seconds so repeated
+    /stats calls do no work at all.
+    """
+
+    def __init__(self, config: Config, db_service: Optional[Union[DatabaseService, AsyncDatabaseService]] = None,
+                 thread_manager: Optional[ThreadManager] = None, user_activity: Optional[UserActivityTracker] = None):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.db_service = db_service
+        self.thread_manager = thread_manager
+        self.user_activity = user_activity
+        self.started_at = time.time()
+
+        # Totals as of the last reconciliation plus conversations logged since
+        self._totals = {"total_conversations": 0, "total_users": 0, "active_threads": 0}
+        self._conversations_since_reconcile = 0
+        # User and thread counters of this instance's services at the last reconciliation
+        self._reconciled_counts = self._counts()
+        self._reconciled_at: Optional[float] = None
+        self._reconcile_task: Optional[asyncio.Task] = None
+
+        # Messages per second over the last hour and a window of recent response times
+        self._message_buckets: Deque[Tuple[int, int]] = deque()
+        self._latencies: Deque[int] = deque(maxlen=config.STATS_LATENCY_SAMPLES)
+
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._snapshot_at = 0.0
+
+    def record_conversation(self, response_time: Optional[int] = None) -> None:
+        """
+        Count a logged conversation
+
+        Args:
+            response_time: Time to answer in milliseconds
+        """
+        self._conversations_since_reconcile += 1
+
+        second = int(time.time())
+        if self._message_buckets and self._message_buckets[-1][0] == second:
+            self._message_buckets[-1] = (second, self._message_buckets[-1][1] + 1)
+        else:
+            self._message_buckets.append((second, 1))
+            self._prune_buckets(second)
+
+        if response_time is not None:
+            self._latencies.append(response_time)
+
+    def _prune_buckets(self, now: int) -> None:
+        while self._message_buckets and self._message_buckets[0][0] <= now - 3600:
+            self._message_buckets.popleft()
+
+    async def start(self) -> None:
+        """Load totals and keep reconciling them in the background"""
+        await self.reconcile()
+        if self._reconcile_task is None or self._reconcile_task.done():
+            self._reconcile_task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.STATS_RECONCILE_INTERVAL)
+            await self.reconcile()
+
+    def _counts(self) -> Tuple[int, int]:
+        """Users and threads (net of removed ones) added by this instance since startup"""
+        users = self.user_activity.users_created if self.user_activity else 0
+        threads = self.thread_manager.threads_added - self.thread_manager.threads_removed if self.thread_manager else 0
+        return users, threads
+
+    async def reconcile(self) -> None:
+        """Replace the incremental totals with counts from storage"""
+        pending = self._conversations_since_reconcile
+        counts = self._counts()
+        try:
+            if self.db_service is not None:
+                totals = await self.db_service.call("get_conversation_stats")
+            elif self.thread_manager is not None:
+                thread_stats = await self.thread_manager.get_thread_stats()
+                totals = {
+                    # Without a database, conversations are only counted since startup
+                    "total_conversations": self._totals["total_conversations"] + pending,
+                    "total_users": thread_stats["total_threads"],
+                    "active_threads": thread_stats["total_threads"]
+                }
+            else:
+                return
+        except Exception as e:
+            self.logger.error(f"Failed to reconcile statistics: {str(e)}")
+            return
+
+        self._totals = totals
+        # Keep conversations counted while the query ran
+        self._conversations_since_reconcile -= pending
+        self._reconciled_counts = counts
+        self._reconciled_at = time.time()
+        self._snapshot = None
+
+    def get_snapshot(self) -> Dict[str, Any]:
+        """Get current statistics, cached for STATS_CACHE_TTL seconds"""
+        now = time.time()
+        if self._snapshot is not None and now - self._snapshot_at < self.config.STATS_CACHE_TTL:
+            return self._snapshot
+
+        self._prune_buckets(int(now))
+        minute_ago = int(now) - 60
+        latencies = sorted(self._latencies)
+        users, threads = self._counts()
+        self._snapshot = {
+            "total_conversations": self._totals["total_conversations"] + self._conversations_since_reconcile,
+            "total_users": self._totals["total_users"] + users - self._reconciled_counts[0],
+            "active_threads": max(0, self._totals["active_threads"] + threads - self._reconciled_counts[1]),
+            # Threads used within THREAD_ACTIVE_WINDOW, counted once per cached snapshot
+            "active_users": self.thread_manager.count_active_users() if self.thread_manager else 0,
+            "messages_last_minute": sum(count for second, count in self._message_buckets if second > minute_ago),
+            "messages_last_hour": sum(count for _, count in self._message_buckets),
+            "latency_p50_ms": percentile(latencies, 0.50),
+            "latency_p95_ms": percentile(latencies, 0.95),
+            "latency_p99_ms": percentile(latencies, 0.99),
+            "uptime_seconds": int(now - self.started_at),
+            "reconciled_seconds_ago": int(now - self._reconciled_at) if self._reconciled_at else None
+        }
+        self._snapshot_at = now
+        return self._snapshot
+
+    async def close(self) -> None:
+        """Stop background reconciliation"""
+        if self._reconcile_task is not None and not self._reconcile_task.done():
+            self._reconcile_task.cancel()
+            try:
+                await self._reconcile_task
+            except asyncio.CancelledError:
+                pass
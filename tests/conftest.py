@@ -0,0 +1,46 @@
+"""
+Shared fixtures for the test suite
+Runs the bot's services against a throwaway SQLite database
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+# The bot's modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_database_service import AsyncDatabaseService
+from database_service import DatabaseService
+
+
+@pytest.fixture(params=["sync", "async"])
+def run_with_db(request, tmp_path, monkeypatch):
+    """
+    Run a coroutine function with a database service on a fresh SQLite file
+
+    Parametrized over DatabaseService and AsyncDatabaseService, so queries are
+    checked through both. The service is created, migrated and disposed of
+    inside one event loop, as the async driver's connections belong to it.
+    """
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'bot.db'}")
+
+    def run(scenario):
+        async def main():
+            if request.param == "sync":
+                db = DatabaseService()
+            else:
+                db = AsyncDatabaseService()
+                await db.initialize()
+            try:
+                return await scenario(db)
+            finally:
+                if request.param == "sync":
+                    db.close()
+                else:
+                    await db.close()
+        return asyncio.run(main())
+
+    return run
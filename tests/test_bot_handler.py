@@ -0,0 +1,72 @@
+"""
+Tests for per-user turn serialization in BotHandler
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from admission_control import AdmissionController
+from bot_handler import BotHandler
+from config import Config
+from shared_state import InstanceCoordinator, MemoryStateStore
+
+
+class SlowReleaseStore(MemoryStateStore):
+    """Store whose lock release takes a while, leaving a window for new messages"""
+
+    async def release_user_lock(self, user_id: int, owner: str) -> None:
+        await asyncio.sleep(0.1)
+        await super().release_user_lock(user_id, owner)
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        self.sent.append(text)
+
+    async def send_chat_action(self, **kwargs):
+        pass
+
+
+class EchoAssistant:
+    async def get_assistant_response(self, user_message, thread_id):
+        return f"re:{user_message}"
+
+
+class FixedThreads:
+    db_service = None
+
+    async def get_or_create_thread(self, user_id):
+        return "thread"
+
+
+class NoLogging:
+    def log_conversation(self, *args, **kwargs):
+        pass
+
+
+def make_update(update_id: int, text: str):
+    user = SimpleNamespace(id=5, full_name="User", username="user", first_name="User", last_name=None)
+    return SimpleNamespace(update_id=update_id, message=SimpleNamespace(chat_id=9, text=text, from_user=user))
+
+
+def test_message_queued_while_lock_is_released_is_answered(monkeypatch):
+    monkeypatch.setenv("ENABLE_STREAMING", "false")
+    config = Config()
+    bot = FakeBot()
+    context = SimpleNamespace(bot=bot)
+    handler = BotHandler(config, EchoAssistant(), NoLogging(), FixedThreads(), AdmissionController(config),
+                         coordinator=InstanceCoordinator(config, SlowReleaseStore()))
+
+    async def scenario():
+        first = asyncio.create_task(handler.handle_message(make_update(1, "one"), context))
+        # The first reply is sent and the lock is being released
+        await asyncio.sleep(0.05)
+        await handler.handle_message(make_update(2, "two"), context)
+        await first
+
+    asyncio.run(scenario())
+    assert bot.sent == ["re:one", "re:two"]
+    assert handler._pending_messages == {}
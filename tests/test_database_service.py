@@ -0,0 +1,94 @@
+"""
+Tests for the database queries shared by DatabaseService and AsyncDatabaseService
+"""
+
+import os
+from datetime import datetime
+
+from sqlalchemy import create_engine, select
+
+from models import User
+
+# Telegram IDs past the 32-bit range, stored as BIGINT
+LARGE_ID = 7_000_000_000
+
+
+def test_claim_update_succeeds_once(run_with_db):
+    async def scenario(db):
+        first = await db.call("claim_update", LARGE_ID, "instance-a")
+        again = await db.call("claim_update", LARGE_ID, "instance-b")
+        other = await db.call("claim_update", LARGE_ID + 1, "instance-b")
+        return first, again, other
+
+    assert run_with_db(scenario) == (True, False, True)
+
+
+def test_user_lock_excludes_other_owners(run_with_db):
+    async def scenario(db):
+        taken = await db.call("acquire_user_lock", LARGE_ID, "instance-a", 60)
+        renewed = await db.call("acquire_user_lock", LARGE_ID, "instance-a", 60)
+        contended = await db.call("acquire_user_lock", LARGE_ID, "instance-b", 60)
+        # Only the owner's release frees the lock
+        await db.call("release_user_lock", LARGE_ID, "instance-b")
+        still_held = await db.call("acquire_user_lock", LARGE_ID, "instance-b", 60)
+        await db.call("release_user_lock", LARGE_ID, "instance-a")
+        released = await db.call("acquire_user_lock", LARGE_ID, "instance-b", 60)
+        return taken, renewed, contended, still_held, released
+
+    assert run_with_db(scenario) == (True, True, False, False, True)
+
+
+def test_expired_user_lock_can_be_taken_over(run_with_db):
+    async def scenario(db):
+        await db.call("acquire_user_lock", LARGE_ID, "instance-a", -1)
+        taken_over = await db.call("acquire_user_lock", LARGE_ID, "instance-b", 60)
+        original_owner = await db.call("acquire_user_lock", LARGE_ID, "instance-a", 60)
+        return taken_over, original_owner
+
+    assert run_with_db(scenario) == (True, False)
+
+
+def test_upsert_users_creates_new_and_updates_known_users(run_with_db):
+    seen_at = datetime(2024, 1, 1)
+
+    async def scenario(db):
+        created = await db.call("upsert_users", [
+            {"telegram_id": LARGE_ID, "username": "old", "first_name": "A", "last_name": None, "last_seen": seen_at},
+        ])
+        upserted = await db.call("upsert_users", [
+            {"telegram_id": LARGE_ID, "username": "new", "first_name": "A", "last_name": None, "last_seen": seen_at},
+            {"telegram_id": 42, "username": "b", "first_name": "B", "last_name": None, "last_seen": seen_at},
+        ])
+        return created, upserted
+
+    assert run_with_db(scenario) == (1, 1)
+    engine = create_engine(os.environ["DATABASE_URL"])
+    with engine.connect() as connection:
+        users = dict(connection.execute(select(User.telegram_id, User.username)).all())
+    engine.dispose()
+    assert users == {LARGE_ID: "new", 42: "b"}
+
+
+def test_queued_updates_are_claimed_by_one_owner_until_visibility_expires(run_with_db):
+    async def scenario(db):
+        await db.call("enqueue_updates", [{"update_id": LARGE_ID + i, "payload": "{}"} for i in range(3)])
+        # Re-fetched updates are not queued twice
+        await db.call("enqueue_updates", [{"update_id": LARGE_ID, "payload": "{}"}])
+        first = await db.call("claim_queued_updates", "instance-a", 2, 60)
+        second = await db.call("claim_queued_updates", "instance-b", 10, 60)
+        nothing_left = await db.call("claim_queued_updates", "instance-b", 10, 60)
+        await db.call("delete_queued_updates", [row["update_id"] for row in first])
+        remaining = await db.call("count_queued_updates")
+        return ([row["update_id"] for row in first], [row["update_id"] for row in second],
+                nothing_left, remaining)
+
+    assert run_with_db(scenario) == ([LARGE_ID, LARGE_ID + 1], [LARGE_ID + 2], [], 1)
+
+
+def test_expired_claims_are_claimed_again(run_with_db):
+    async def scenario(db):
+        await db.call("enqueue_updates", [{"update_id": 1, "payload": "{}"}])
+        await db.call("claim_queued_updates", "instance-a", 10, -1)
+        return await db.call("claim_queued_updates", "instance-b", 10, 60)
+
+    assert run_with_db(scenario) == [{"update_id": 1, "payload": "{}"}]
@@ -0,0 +1,50 @@
+"""
+Tests for polling leader election
+"""
+
+import asyncio
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, MessageHandler, filters
+
+from config import Config
+from leader_election import FileLease, PollingLeader
+
+
+def test_file_lease_is_held_by_one_holder_at_a_time(tmp_path):
+    path = str(tmp_path / "bot_polling.lock")
+    first, second = FileLease(path), FileLease(path)
+
+    async def scenario():
+        results = [await first.acquire(), await second.acquire()]
+        await first.release()
+        results.append(await second.acquire())
+        await second.release()
+        return results
+
+    assert asyncio.run(scenario()) == [True, False, True]
+
+
+def test_leader_handles_updates_before_confirming_them(tmp_path):
+    handled = []
+
+    async def handle(update, context):
+        await asyncio.sleep(0.01)
+        handled.append(update.update_id)
+
+    async def scenario():
+        application = ApplicationBuilder().token("123:TEST").concurrent_updates(4).build()
+        application.add_handler(MessageHandler(filters.ALL, handle))
+        # Skip initialize(), which would call getMe
+        application._initialized = True
+        leader = PollingLeader(Config(), application, FileLease(str(tmp_path / "bot_polling.lock")))
+        updates = [
+            Update.de_json({"update_id": i, "message": {"message_id": i, "date": 0, "text": "hi",
+                                                        "chat": {"id": 1, "type": "private"}}}, application.bot)
+            for i in range(6)
+        ]
+        await leader._dispatch(updates)
+        # Without the update queue, every update is handled once _dispatch returns
+        return sorted(handled)
+
+    assert asyncio.run(scenario()) == list(range(6))
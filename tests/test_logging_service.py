@@ -0,0 +1,128 @@
+"""
+Tests for the conversation log sinks
+"""
+
+import asyncio
+import json
+import os
+from datetime import datetime
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.exc import OperationalError
+
+import logging_service
+from config import Config
+from logging_service import DatabaseLogSink, LoggingService
+from models import ConversationLog
+
+
+class FakeWorksheet:
+    def __init__(self):
+        self.rows = []
+
+    def append_rows(self, rows, value_input_option):
+        self.rows.extend(rows)
+
+
+def make_rows(count: int):
+    return [["2024-01-01 00:00:00", i, "user", f"q{i}", f"a{i}", "thread", 1.0, None] for i in range(count)]
+
+
+def make_sheets_service(tmp_path, monkeypatch, worksheet_failures: int):
+    """LoggingService writing only to Sheets, whose worksheet fails to open a number of times"""
+    config = Config()
+    config.ENABLE_CSV_LOGGING = False
+    config.ENABLE_SHEETS_LOGGING = True
+    config.SHEETS_SPOOL_FILE = str(tmp_path / "sheets_spool.jsonl")
+    config.SHEETS_MIN_BATCH = 1
+    config.LOG_MAX_RETRIES = 3
+    service = LoggingService(config)
+    worksheet = FakeWorksheet()
+    failures = iter(range(worksheet_failures))
+
+    def get_worksheet():
+        if next(failures, None) is not None:
+            raise ConnectionError("Sheets unavailable")
+        return worksheet
+
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(service, "_get_worksheet", get_worksheet)
+    monkeypatch.setattr(logging_service.asyncio, "sleep", no_sleep)
+    return service, worksheet
+
+
+def read_spool(service: LoggingService):
+    with open(service.config.SHEETS_SPOOL_FILE, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_sheets_rows_are_spooled_once_across_write_retries(tmp_path, monkeypatch):
+    service, worksheet = make_sheets_service(tmp_path, monkeypatch, worksheet_failures=2)
+
+    asyncio.run(service._flush(make_rows(3)))
+
+    assert [row[3] for row in worksheet.rows] == ["q0", "q1", "q2"]
+    assert read_spool(service) == []
+    assert service.dropped_rows == 0
+
+
+def test_sheets_rows_stay_spooled_when_writes_give_up(tmp_path, monkeypatch):
+    service, worksheet = make_sheets_service(tmp_path, monkeypatch, worksheet_failures=3)
+
+    asyncio.run(service._flush(make_rows(3)))
+
+    assert worksheet.rows == []
+    assert [row[3] for row in read_spool(service)] == ["q0", "q1", "q2"]
+    # Spooled rows are written later, so they don't count as dropped
+    assert service.dropped_rows == 0
+
+
+def make_db_rows(count: int):
+    return [{"user_id": i, "user_name": "user", "question": f"q{i}", "answer": f"a{i}", "thread_id": "thread",
+             "response_time": 1.0, "timestamp": datetime(2024, 1, 1)} for i in range(count)]
+
+
+def test_rows_rejected_by_the_database_are_dropped_alone(run_with_db):
+    rows = make_db_rows(10)
+    rows[3]["question"] = None
+    rows[7]["question"] = None
+
+    async def scenario(db):
+        sink = DatabaseLogSink(Config(), db)
+        await sink.write(rows)
+        return sink.inserted_rows, sink.dropped_rows, sink.pending_rows
+
+    assert run_with_db(scenario) == (8, 2, 0)
+    engine = create_engine(os.environ["DATABASE_URL"])
+    with engine.connect() as connection:
+        logged = connection.execute(select(func.count()).select_from(ConversationLog)).scalar()
+    engine.dispose()
+    assert logged == 8
+
+
+class UnavailableDatabase:
+    def __init__(self):
+        self.calls = 0
+
+    async def call(self, method, *args):
+        self.calls += 1
+        raise OperationalError("INSERT INTO conversation_logs", {}, Exception("connection refused"))
+
+
+def test_chunk_is_dropped_after_repeated_transient_failures():
+    config = Config()
+    config.LOG_MAX_RETRIES = 3
+    db = UnavailableDatabase()
+    sink = DatabaseLogSink(config, db)
+
+    async def scenario():
+        await sink.write(make_db_rows(5))
+        for _ in range(config.LOG_MAX_RETRIES - 1):
+            await sink.write([], force=True)
+
+    asyncio.run(scenario())
+    # Transient errors retry the whole chunk instead of splitting it
+    assert db.calls == config.LOG_MAX_RETRIES
+    assert (sink.pending_rows, sink.dropped_rows) == (0, 5)
@@ -0,0 +1,110 @@
+"""
+Tests for JsonThreadStore crash recovery and last-use persistence
+"""
+
+import asyncio
+import json
+import time
+
+from config import Config
+from thread_manager import ThreadManager
+from thread_store import JsonThreadStore
+
+
+def make_store(tmp_path) -> JsonThreadStore:
+    config = Config()
+    config.THREADS_SAVE_DELAY = 60
+    config.THREADS_JOURNAL = True
+    return JsonThreadStore(config, str(tmp_path / "user_threads.json"))
+
+
+def record_without_snapshot(store: JsonThreadStore, changes) -> None:
+    """Record changes in the event loop and stop before the delayed snapshot, as a crash would"""
+    async def scenario():
+        for user_id, thread_id in changes:
+            store.record(user_id, thread_id)
+        store._flush_task.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_changes_since_the_snapshot_are_replayed_from_the_journal(tmp_path):
+    store = make_store(tmp_path)
+    store.load()
+    store.record(1, "thread_a")  # Outside the event loop, written to the snapshot at once
+    record_without_snapshot(store, [(2, "thread_b"), (1, None), (3, "thread_c")])
+
+    recovered = make_store(tmp_path).load()
+    assert recovered == {2: "thread_b", 3: "thread_c"}
+
+
+def test_torn_last_journal_line_is_skipped(tmp_path):
+    store = make_store(tmp_path)
+    store.load()
+    record_without_snapshot(store, [(1, "thread_a")])
+    with open(store.journal_file, "a", encoding="utf-8") as f:
+        f.write('{"u":2,"t":"thr')
+
+    assert make_store(tmp_path).load() == {1: "thread_a"}
+
+
+def test_journal_set_aside_by_an_unfinished_snapshot_is_replayed(tmp_path):
+    store = make_store(tmp_path)
+    store.load()
+    record_without_snapshot(store, [(1, "thread_a")])
+    # The snapshot began (journal moved aside) but the process died before it was written
+    store._begin_snapshot()
+    store._journal = None
+    record_without_snapshot(store, [(2, "thread_b")])
+
+    assert make_store(tmp_path).load() == {1: "thread_a", 2: "thread_b"}
+
+
+def test_flush_writes_the_snapshot_and_removes_the_journals(tmp_path):
+    store = make_store(tmp_path)
+    store.load()
+    record_without_snapshot(store, [(1, "thread_a")])
+    store.flush()
+
+    with open(store.threads_file, encoding="utf-8") as f:
+        assert set(json.load(f)) == {"1"}
+    assert not (tmp_path / "user_threads.json.journal").exists()
+    assert not (tmp_path / "user_threads.json.journal.1").exists()
+    assert make_store(tmp_path).load() == {1: "thread_a"}
+
+
+def test_last_use_is_kept_in_the_snapshot_and_the_journal(tmp_path):
+    store = make_store(tmp_path)
+    store.load()
+    store.record(1, "thread_a")
+    store.record_uses({1: 100.0, 2: 200.0})  # Users without a thread are ignored
+    store.flush()
+    record_without_snapshot(store, [(2, "thread_b")])
+
+    recovered = make_store(tmp_path)
+    assert recovered.load() == {1: "thread_a", 2: "thread_b"}
+    assert recovered.last_used[1] == 100.0
+    assert recovered.last_used[2] == store.last_used[2]
+
+
+def test_snapshot_without_last_use_still_loads(tmp_path):
+    with open(tmp_path / "user_threads.json", "w", encoding="utf-8") as f:
+        json.dump({"1": "thread_a"}, f)
+
+    store = make_store(tmp_path)
+    assert store.load() == {1: "thread_a"}
+    assert store.last_used == {}
+
+
+def test_idle_threads_expire_after_a_restart_in_file_mode(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    now = time.time()
+    with open(tmp_path / "user_threads.json", "w", encoding="utf-8") as f:
+        json.dump({"1": {"t": "thread_a", "l": now - 7200}, "2": {"t": "thread_b", "l": now - 60}}, f)
+    config = Config()
+    config.THREAD_IDLE_TTL = 3600
+    config.MULTI_INSTANCE = False
+
+    manager = ThreadManager(config, client=object())
+    assert manager._is_expired(1, now)
+    assert not manager._is_expired(2, now)
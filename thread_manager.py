@@ -3,61 +3,58 @@ Thread management service for maintaining conversation context per user
 Handles persistent thread storage and retrieval
 """
 
+import asyncio
 import logging
-import json
-import os
-from typing import Dict, Optional
-from openai import OpenAI
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set, Union
+from openai import AsyncOpenAI
+from async_database_service import AsyncDatabaseService
+from cache import LRUCache
 from config import Config
 from database_service import DatabaseService
+from openai_service import create_async_client
+from thread_store import JsonThreadStore
+from tracing import TRACER, traced
+
+# Users per statement when saving thread uses and deleting idle threads
+THREAD_SWEEP_BATCH = 1000
 
 
 class ThreadManager:
     """Manages conversation threads for each user to maintain context"""
     
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, client: Optional[AsyncOpenAI] = None,
+                 db_service: Optional[Union[DatabaseService, AsyncDatabaseService]] = None):
         self.config = config
-        self.client = OpenAI(api_key=config.OPENAI_API_KEY)
+        self.client = client or create_async_client(config)
         self.logger = logging.getLogger(__name__)
+        self.db_service = db_service
         
-        # Initialize database service with fallback to file storage
-        try:
-            self.db_service = DatabaseService()
+        # When each user's thread was last used (uses before startup count from startup)
+        self._started_at = time.time()
+        self._last_used: Dict[int, float] = {}
+        self._unsaved_uses: Set[int] = set()
+        self._sweeper_task: Optional[asyncio.Task] = None
+        
+        # Threads added and removed by this instance, for counting threads between reconciliations
+        self.threads_added = 0
+        self.threads_removed = 0
+        
+        # Use the database when available, with fallback to file storage
+        if self.db_service is not None:
+            # Hot user -> thread_id lookups are served from memory, the database sees only misses
+            self._thread_cache = LRUCache(config.THREAD_CACHE_SIZE, config.THREAD_CACHE_TTL)
             self.logger.info("ThreadManager using database backend")
-        except Exception as e:
-            self.logger.warning(f"Database not available, using file backend: {e}")
-            self.db_service = None
+        else:
+            self.logger.info("ThreadManager using file backend")
             self.threads_file = "user_threads.json"
-            self._user_threads: Dict[int, str] = {}
-            self._load_threads()
+            self._store = JsonThreadStore(config, self.threads_file)
+            self._user_threads: Dict[int, str] = self._store.load()
+            self.logger.info(f"Loaded {len(self._user_threads)} existing threads")
     
-    def _load_threads(self) -> None:
-        """Load existing threads from file"""
-        try:
-            if os.path.exists(self.threads_file):
-                with open(self.threads_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # Convert string keys back to int
-                    self._user_threads = {int(k): v for k, v in data.items()}
-                self.logger.info(f"Loaded {len(self._user_threads)} existing threads")
-            else:
-                self.logger.info("No existing threads file found, starting fresh")
-        except Exception as e:
-            self.logger.error(f"Failed to load threads: {str(e)}")
-            self._user_threads = {}
-    
-    def _save_threads(self) -> None:
-        """Save threads to file"""
-        try:
-            # Convert int keys to string for JSON serialization
-            data = {str(k): v for k, v in self._user_threads.items()}
-            with open(self.threads_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2)
-            self.logger.debug("Saved threads to file")
-        except Exception as e:
-            self.logger.error(f"Failed to save threads: {str(e)}")
-    
-    def get_or_create_thread(self, user_id: int) -> str:
+    @traced("get_or_create_thread")
+    async def get_or_create_thread(self, user_id: int) -> str:
         """
         Get existing thread for user or create a new one
         
@@ -67,19 +64,30 @@ class ThreadManager:
         Returns:
             Thread ID for the user
         """
-        if user_id in self._user_threads:
-            thread_id = self._user_threads[user_id]
+        thread_id = await self._lookup_thread(user_id)
+        had_thread = bool(thread_id)
+        if thread_id and self._is_expired(user_id, time.time()):
+            # Long-idle threads are replaced so their context doesn't grow every returning user's runs
+            self.logger.info(f"Thread {thread_id} for user {user_id} expired after inactivity, starting a new one")
+            TRACER.current_span().set_attribute("expired", True)
+            thread_id = None
+        
+        if thread_id:
+            self._mark_used(user_id)
             self.logger.debug(f"Using existing thread {thread_id} for user {user_id}")
             return thread_id
         
         try:
             # Create new thread
-            thread = self.client.beta.threads.create()
+            thread = await self.client.beta.threads.create()
             thread_id = thread.id
             
             # Store and save
-            self._user_threads[user_id] = thread_id
-            self._save_threads()
+            await self._store_thread(user_id, thread_id)
+            self._last_used[user_id] = time.time()
+            if not had_thread:
+                self.threads_added += 1
+            TRACER.current_span().set_attribute("created", True)
             
             self.logger.info(f"Created new thread {thread_id} for user {user_id}")
             return thread_id
@@ -88,7 +96,45 @@ class ThreadManager:
             self.logger.error(f"Failed to create thread for user {user_id}: {str(e)}")
             raise Exception("Failed to create conversation thread")
     
-    def clear_user_thread(self, user_id: int) -> bool:
+    def _is_expired(self, user_id: int, now: float) -> bool:
+        """Check whether the user's thread has been idle longer than THREAD_IDLE_TTL"""
+        if self.config.THREAD_IDLE_TTL <= 0 or self.config.MULTI_INSTANCE:
+            # Other instances' uses are only known from last_used_at, so their sweepers expire threads
+            return False
+        used = self._last_used.get(user_id)
+        if used is None and self.db_service is None:
+            # Not used since startup, or pruned: fall back to the use saved with the thread
+            used = self._store.last_used.get(user_id)
+        return now - (used if used is not None else self._started_at) > self.config.THREAD_IDLE_TTL
+    
+    def _mark_used(self, user_id: int) -> None:
+        self._last_used[user_id] = time.time()
+        # Saved in bulk by the sweeper
+        self._unsaved_uses.add(user_id)
+    
+    async def _lookup_thread(self, user_id: int) -> Optional[str]:
+        """Find the user's thread in memory, falling back to the database on a cache miss"""
+        if self.db_service is None:
+            return self._user_threads.get(user_id)
+        
+        # Other instances may replace or clear the thread, so they always read the database
+        thread_id = None if self.config.MULTI_INSTANCE else self._thread_cache.get(user_id)
+        if thread_id is None:
+            thread_id = await self.db_service.call("get_user_thread", user_id)
+            if thread_id:
+                self._thread_cache.set(user_id, thread_id)
+        return thread_id
+    
+    async def _store_thread(self, user_id: int, thread_id: str) -> None:
+        """Persist a new thread for the user (write-through to the database)"""
+        if self.db_service is None:
+            self._store.record(user_id, thread_id)
+            return
+        
+        await self.db_service.call("create_user_thread", user_id, thread_id)
+        self._thread_cache.set(user_id, thread_id)
+    
+    async def clear_user_thread(self, user_id: int) -> bool:
         """
         Clear thread for a specific user (for reset functionality)
         
@@ -98,16 +144,130 @@ class ThreadManager:
         Returns:
             True if thread was cleared, False if no thread existed
         """
+        self._last_used.pop(user_id, None)
+        self._unsaved_uses.discard(user_id)
+        if self.db_service is not None:
+            self._thread_cache.pop(user_id)
+            cleared = await self.db_service.call("clear_user_thread", user_id)
+            if cleared:
+                self.threads_removed += 1
+                self.logger.info(f"Cleared thread for user {user_id}")
+            return cleared
+        
         if user_id in self._user_threads:
-            del self._user_threads[user_id]
-            self._save_threads()
+            self._store.record(user_id, None)
+            self.threads_removed += 1
             self.logger.info(f"Cleared thread for user {user_id}")
             return True
         return False
     
-    def get_thread_stats(self) -> Dict[str, int]:
+    async def start(self) -> None:
+        """Start the background sweeper that saves thread uses and expires idle threads"""
+        if self._sweeper_task is None or self._sweeper_task.done():
+            self._sweeper_task = asyncio.create_task(self._run_sweeper())
+    
+    async def _run_sweeper(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.THREAD_SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception as e:
+                self.logger.error(f"Thread sweep failed: {str(e)}")
+    
+    async def sweep(self) -> int:
+        """
+        Save recent thread uses and delete threads idle longer than THREAD_IDLE_TTL
+        
+        Returns:
+            Number of expired threads
+        """
+        now = time.time()
+        expired = 0
+        
+        await self._save_uses()
+        self._prune_last_used(now)
+        if self.db_service is not None:
+            if self.config.THREAD_IDLE_TTL > 0:
+                before = datetime.utcnow() - timedelta(seconds=self.config.THREAD_IDLE_TTL)
+                while True:
+                    user_ids = await self.db_service.call("delete_idle_threads", before, THREAD_SWEEP_BATCH)
+                    for user_id in user_ids:
+                        self._thread_cache.pop(user_id)
+                        self._last_used.pop(user_id, None)
+                    expired += len(user_ids)
+                    if len(user_ids) < THREAD_SWEEP_BATCH:
+                        break
+        elif self.config.THREAD_IDLE_TTL > 0:
+            for user_id in [user_id for user_id in self._user_threads if self._is_expired(user_id, now)]:
+                self._store.record(user_id, None)
+                self._last_used.pop(user_id, None)
+                expired += 1
+        
+        self.threads_removed += expired
+        if expired:
+            self.logger.info(f"Expired {expired} idle threads")
+        return expired
+    
+    async def _save_uses(self) -> None:
+        """Write last-use times collected since the previous sweep, one UPDATE per batch"""
+        user_ids, self._unsaved_uses = list(self._unsaved_uses), set()
+        if self.db_service is None:
+            self._store.record_uses({user_id: self._last_used[user_id] for user_id in user_ids
+                                     if user_id in self._last_used})
+            return
+        used_at = datetime.utcnow()
+        try:
+            for i in range(0, len(user_ids), THREAD_SWEEP_BATCH):
+                await self.db_service.call("touch_user_threads", user_ids[i:i + THREAD_SWEEP_BATCH], used_at)
+        except Exception:
+            self._unsaved_uses.update(user_ids)
+            raise
+    
+    def _prune_last_used(self, now: float) -> None:
+        """Forget saved uses older than needed for active user counts and local expiry checks"""
+        keep = self.config.THREAD_ACTIVE_WINDOW
+        if self.config.THREAD_IDLE_TTL > 0 and not self.config.MULTI_INSTANCE:
+            keep = max(keep, self.config.THREAD_IDLE_TTL)
+        stale = [user_id for user_id, used in self._last_used.items()
+                 if now - used > keep and user_id not in self._unsaved_uses]
+        for user_id in stale:
+            del self._last_used[user_id]
+    
+    async def close(self) -> None:
+        """Stop the sweeper and write pending thread changes"""
+        if self._sweeper_task is not None and not self._sweeper_task.done():
+            self._sweeper_task.cancel()
+            try:
+                await self._sweeper_task
+            except asyncio.CancelledError:
+                pass
+        
+        try:
+            await self._save_uses()
+        except Exception as e:
+            self.logger.error(f"Failed to save thread uses: {str(e)}")
+        if self.db_service is None:
+            await self._store.close()
+    
+    def count_active_users(self) -> int:
+        """Count users whose thread was used within THREAD_ACTIVE_WINDOW"""
+        now = time.time()
+        return sum(1 for used in self._last_used.values() if now - used <= self.config.THREAD_ACTIVE_WINDOW)
+    
+    async def get_thread_stats(self) -> Dict[str, int]:
         """Get statistics about managed threads"""
+        active_users = self.count_active_users()
+        if self.db_service is not None:
+            total_threads = (await self.db_service.call("get_conversation_stats"))['active_threads']
+            return {
+                "total_threads": total_threads,
+                "active_users": active_users,
+                "idle_threads": max(0, total_threads - active_users),
+                "cached_threads": len(self._thread_cache)
+            }
+        
         return {
             "total_threads": len(self._user_threads),
-            "active_users": len(self._user_threads)
+            "active_users": active_users,
+            "idle_threads": max(0, len(self._user_threads) - active_users)
         }
\ No newline at end of file
@@ -0,0 +1,235 @@
+"""
+File persistence for user threads
+Journals every change and writes debounced, atomic snapshots of user_threads.json
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Dict, Optional, Union
+from config import Config
+
+
+def _fsync_directory(path: str) -> None:
+    """Make a rename within the file's directory durable"""
+    if os.name != "posix":
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class JsonThreadStore:
+    """
+    Write-behind store for the user -> thread_id map and when each thread was last used
+
+    Each change is appended to a small journal (constant cost per change) and the
+    full map is written to the snapshot file at most once per save delay, using a
+    temp file, fsync and rename so a crash never leaves a truncated snapshot.
+    Last-use times are not journaled; they are saved with the next snapshot.
+    """
+
+    def __init__(self, config: Config, threads_file: str):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.threads_file = threads_file
+        self.journal_file = f"{threads_file}.journal"
+        self.compacting_file = f"{self.journal_file}.1"
+        self.threads: Dict[int, str] = {}
+        self.last_used: Dict[int, float] = {}
+
+        self._journal = None
+        self._dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
+        # Snapshot write running in a worker thread; cancelling the flush task doesn't stop it
+        self._write_future: Optional[asyncio.Future] = None
+
+    def load(self) -> Dict[int, str]:
+        """Load the snapshot and replay journal entries written after it"""
+        try:
+            if os.path.exists(self.threads_file):
+                with open(self.threads_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                for key, record in data.items():
+                    # Convert string keys back to int
+                    self._load_record(int(key), record)
+        except Exception as e:
+            self.logger.error(f"Failed to load threads snapshot: {str(e)}")
+            self.threads = {}
+            self.last_used = {}
+
+        replayed = self._replay(self.compacting_file) + self._replay(self.journal_file)
+        if replayed:
+            self.logger.info(f"Replayed {replayed} thread changes from journal")
+            self._dirty = True
+        return self.threads
+
+    def _load_record(self, user_id: int, record: Union[str, Dict]) -> None:
+        # Snapshots written before last-use times were stored hold just the thread ID
+        if isinstance(record, str):
+            self.threads[user_id] = record
+            return
+        self.threads[user_id] = record["t"]
+        if record.get("l") is not None:
+            self.last_used[user_id] = record["l"]
+
+    def _replay(self, path: str) -> int:
+        """Apply journal entries from a file, skipping a torn last line"""
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry["t"] is None:
+                    self.threads.pop(entry["u"], None)
+                    self.last_used.pop(entry["u"], None)
+                else:
+                    self.threads[entry["u"]] = entry["t"]
+                    if entry.get("l") is not None:
+                        self.last_used[entry["u"]] = entry["l"]
+                count += 1
+        return count
+
+    def record(self, user_id: int, thread_id: Optional[str]) -> None:
+        """
+        Record a thread change for the user
+
+        Args:
+            user_id: Telegram user ID
+            thread_id: New thread ID, or None if the user's thread was cleared
+        """
+        if thread_id is None:
+            self.threads.pop(user_id, None)
+            self.last_used.pop(user_id, None)
+        else:
+            self.threads[user_id] = thread_id
+            # A new thread is in use from the moment it is created
+            self.last_used[user_id] = time.time()
+
+        if self.config.THREADS_JOURNAL:
+            try:
+                self._append_journal(user_id, thread_id, self.last_used.get(user_id))
+            except Exception as e:
+                self.logger.error(f"Failed to append thread journal: {str(e)}")
+
+        self._dirty = True
+        self._schedule_flush()
+
+    def record_uses(self, last_used: Dict[int, float]) -> None:
+        """
+        Record when users' threads were last used, saved with the next snapshot
+
+        Args:
+            last_used: Last-use time (epoch seconds) per user
+        """
+        last_used = {user_id: used for user_id, used in last_used.items() if user_id in self.threads}
+        if not last_used:
+            return
+        self.last_used.update(last_used)
+        self._dirty = True
+        self._schedule_flush()
+
+    def _append_journal(self, user_id: int, thread_id: Optional[str], used_at: Optional[float]) -> None:
+        if self._journal is None:
+            self._journal = open(self.journal_file, 'a', encoding='utf-8')
+        entry = {"u": user_id, "t": thread_id}
+        if used_at is not None:
+            entry["l"] = used_at
+        self._journal.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self._journal.flush()
+        if self.config.THREADS_JOURNAL_FSYNC:
+            os.fsync(self._journal.fileno())
+
+    def _schedule_flush(self) -> None:
+        """Write a snapshot after the save delay, or immediately outside the event loop"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        # Keep going while changes (or a failed write) arrive during the snapshot
+        while self._dirty:
+            await asyncio.sleep(self.config.THREADS_SAVE_DELAY)
+            data = self._begin_snapshot()
+            if data is not None:
+                self._write_future = asyncio.ensure_future(asyncio.to_thread(self._write_snapshot, data))
+                await asyncio.shield(self._write_future)
+
+    def flush(self) -> None:
+        """Write a snapshot now if there are unsaved changes"""
+        data = self._begin_snapshot()
+        if data is not None:
+            self._write_snapshot(data)
+
+    def _begin_snapshot(self) -> Optional[Dict[str, Dict]]:
+        """
+        Copy the current map and set the journal aside for compaction
+
+        Entries journaled after this point go to a fresh journal, so they are
+        kept even though the snapshot being written doesn't include them.
+        """
+        if not self._dirty:
+            return None
+        self._dirty = False
+
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self.journal_file):
+            if os.path.exists(self.compacting_file):
+                # A previous snapshot failed; keep its entries and add the new ones
+                with open(self.journal_file, 'r', encoding='utf-8') as src, \
+                        open(self.compacting_file, 'a', encoding='utf-8') as dst:
+                    dst.write(src.read())
+                os.remove(self.journal_file)
+            else:
+                os.replace(self.journal_file, self.compacting_file)
+
+        # Convert int keys to string for JSON serialization
+        return {str(k): {"t": v, "l": self.last_used.get(k)} for k, v in self.threads.items()}
+
+    def _write_snapshot(self, data: Dict[str, Dict]) -> None:
+        """Atomically replace the snapshot file, then drop the compacted journal"""
+        tmp_file = f"{self.threads_file}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.threads_file)
+            _fsync_directory(self.threads_file)
+            if os.path.exists(self.compacting_file):
+                os.remove(self.compacting_file)
+            self.logger.debug(f"Saved {len(data)} threads to file")
+        except Exception as e:
+            self._dirty = True
+            self.logger.error(f"Failed to save threads: {str(e)}")
+
+    async def close(self) -> None:
+        """Cancel the pending delayed save and write a final snapshot"""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        if self._write_future is not None and not self._write_future.done():
+            # Let a snapshot already being written finish, so two writers never share the temp file
+            await self._write_future
+        self.flush()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
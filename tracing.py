@@ -0,0 +1,322 @@
+"""
+Request tracing for the bot
+Records a tree of timed spans per Telegram update for a sample of updates, and exports
+finished traces in the background to a JSON lines file or an OTLP/HTTP collector
+"""
+
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import random
+import secrets
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+import httpx
+from config import Config
+from metrics import Counter
+
+# Finished spans buffered for export; spans beyond this are dropped until the next export
+MAX_PENDING_SPANS = 10000
+
+TRACES_EXPORTED = Counter("bot_traces_exported_total", "Traces handed to the span exporter")
+SPANS_DROPPED = Counter("bot_trace_spans_dropped_total", "Spans dropped because the export buffer was full "
+                                                          "or the export failed")
+
+
+class _Trace:
+    """Spans of one trace, collected until its root span ends"""
+
+    def __init__(self, sampled: bool):
+        self.trace_id = secrets.token_hex(16)
+        self.sampled = sampled
+        self.spans: List["Span"] = []
+        self.finished = False
+
+
+class Span:
+    """One timed operation within a trace"""
+
+    def __init__(self, trace: _Trace, name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        self.start_time = time.time()
+        self.duration = 0.0
+        self._start = time.perf_counter()
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def end(self) -> None:
+        self.duration = time.perf_counter() - self._start
+
+    def to_dict(self) -> Dict[str, Any]:
+        start_ns = int(self.start_time * 1e9)
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "start_time_unix_nano": start_ns,
+            "end_time_unix_nano": start_ns + int(self.duration * 1e9),
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """Stands in for a span outside sampled traces, so instrumented code needs no checks"""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+# Span of the operation running in the current context, None outside recorded traces
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class FileSpanExporter:
+    """Appends spans to a JSON lines file, one object per span"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: List[Dict]) -> None:
+        with open(self.path, "a", encoding="utf-8") as file:
+            for span in spans:
+                file.write(json.dumps(span, ensure_ascii=False, default=str) + "\n")
+
+
+class OtlpSpanExporter:
+    """Posts spans to an OpenTelemetry collector as OTLP/HTTP JSON"""
+
+    def __init__(self, endpoint: str, service_name: str = "telegram-bot", timeout: float = 10.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def export(self, spans: List[Dict]) -> None:
+        """
+        Send spans in one request
+
+        Raises:
+            httpx.HTTPError: If the collector can't be reached or rejects the spans
+        """
+        body = {"resourceSpans": [{
+            "resource": {"attributes": self._attributes({"service.name": self.service_name})},
+            "scopeSpans": [{"scope": {"name": "bot"}, "spans": [self._span(span) for span in spans]}],
+        }]}
+        httpx.post(self.endpoint, json=body, timeout=self.timeout).raise_for_status()
+
+    def _span(self, span: Dict) -> Dict:
+        otlp_span = {
+            "traceId": span["trace_id"],
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": 1,  # internal
+            "startTimeUnixNano": str(span["start_time_unix_nano"]),
+            "endTimeUnixNano": str(span["end_time_unix_nano"]),
+            "attributes": self._attributes(span["attributes"]),
+            "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 1},
+        }
+        if span["parent_span_id"]:
+            otlp_span["parentSpanId"] = span["parent_span_id"]
+        return otlp_span
+
+    def _attributes(self, attributes: Dict[str, Any]) -> List[Dict]:
+        result = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                typed = {"boolValue": value}
+            elif isinstance(value, int):
+                typed = {"intValue": str(value)}
+            elif isinstance(value, float):
+                typed = {"doubleValue": value}
+            else:
+                typed = {"stringValue": str(value)}
+            result.append({"key": key, "value": typed})
+        return result
+
+
+def create_exporter(config: Config) -> Optional[Union[FileSpanExporter, OtlpSpanExporter]]:
+    """Create the exporter configured by TRACE_EXPORTER ("file", "otlp" or "none")"""
+    if config.TRACE_EXPORTER == "file":
+        return FileSpanExporter(config.TRACE_FILE)
+    if config.TRACE_EXPORTER == "otlp":
+        return OtlpSpanExporter(config.TRACE_OTLP_ENDPOINT)
+    return None
+
+
+class Tracer:
+    """
+    Creates spans and exports finished traces
+
+    A trace is started per update with start_trace() and is recorded for
+    TRACE_SAMPLE_RATE of updates; span() adds a child to the trace running
+    in the current context. Outside a recorded trace both only return
+    NOOP_SPAN, so tracing costs a random() call per update when sampled out.
+    With TRACE_SLOW_THRESHOLD set every trace is recorded and the ones whose
+    root took at least that long are exported along with the sample.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.sample_rate = 0.0
+        self.slow_threshold = 0.0
+        self.export_interval = 5.0
+        self.exporter: Optional[Union[FileSpanExporter, OtlpSpanExporter]] = None
+        self._pending: List[Dict] = []
+        self._export_task: Optional[asyncio.Task] = None
+
+    def configure(self, config: Config, exporter: Optional[Union[FileSpanExporter, OtlpSpanExporter]]) -> None:
+        """Apply sampling settings and set where traces are exported"""
+        self.sample_rate = config.TRACE_SAMPLE_RATE
+        self.slow_threshold = config.TRACE_SLOW_THRESHOLD
+        self.export_interval = config.TRACE_EXPORT_INTERVAL
+        self.exporter = exporter
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None and (self.sample_rate > 0 or self.slow_threshold > 0)
+
+    @contextmanager
+    def start_trace(self, name: str, **attributes) -> Iterator[Union[Span, _NoopSpan]]:
+        """Start a new trace rooted at a span covering the block, if it is sampled"""
+        sampled = self.enabled and random.random() < self.sample_rate
+        if not sampled and (not self.enabled or self.slow_threshold <= 0):
+            if _current_span.get() is None:
+                yield NOOP_SPAN
+                return
+            # Don't add this unsampled work to a trace inherited from the task's creator
+            token = _current_span.set(None)
+            try:
+                yield NOOP_SPAN
+            finally:
+                _current_span.reset(token)
+            return
+
+        trace = _Trace(sampled)
+        span = Span(trace, name, None, attributes)
+        try:
+            with self._activate(span, True):
+                yield span
+        finally:
+            trace.finished = True
+            if trace.sampled or (self.slow_threshold > 0 and span.duration >= self.slow_threshold):
+                self._queue(trace.spans)
+
+    @contextmanager
+    def span(self, name: str, activate: bool = True, **attributes) -> Iterator[Union[Span, _NoopSpan]]:
+        """
+        Record the block as a child of the current span
+
+        Args:
+            name: Operation name
+            activate: Make the span the parent of spans started in the block; pass False
+                in async generators, whose blocks span the consumer's code
+            **attributes: Span attributes
+        """
+        parent = _current_span.get()
+        if parent is None or parent.trace.finished:
+            yield NOOP_SPAN
+            return
+        with self._activate(Span(parent.trace, name, parent.span_id, attributes), activate) as span:
+            yield span
+
+    def current_span(self) -> Union[Span, _NoopSpan]:
+        """Span of the operation running in the current context, for adding attributes"""
+        return _current_span.get() or NOOP_SPAN
+
+    @contextmanager
+    def _activate(self, span: Span, activate: bool) -> Iterator[Span]:
+        token = _current_span.set(span) if activate else None
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {str(e)}"
+            raise
+        finally:
+            span.end()
+            if token is not None:
+                _current_span.reset(token)
+            # Spans ending after their root (e.g. in tasks the update spawned) are left out
+            if not span.trace.finished:
+                span.trace.spans.append(span)
+
+    def _queue(self, spans: List[Span]) -> None:
+        room = MAX_PENDING_SPANS - len(self._pending)
+        if room < len(spans):
+            SPANS_DROPPED.inc(len(spans))
+            return
+        self._pending.extend(span.to_dict() for span in spans)
+        TRACES_EXPORTED.inc()
+
+    async def start(self) -> None:
+        """Start exporting finished traces every TRACE_EXPORT_INTERVAL seconds"""
+        if self.enabled and (self._export_task is None or self._export_task.done()):
+            self._export_task = asyncio.create_task(self._run_exporter())
+
+    async def _run_exporter(self) -> None:
+        while True:
+            await asyncio.sleep(self.export_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Export buffered spans off the event loop"""
+        if not self._pending or self.exporter is None:
+            return
+        spans, self._pending = self._pending, []
+        try:
+            await asyncio.to_thread(self.exporter.export, spans)
+        except Exception as e:
+            SPANS_DROPPED.inc(len(spans))
+            self.logger.error(f"Failed to export {len(spans)} spans: {str(e)}")
+
+    async def close(self) -> None:
+        """Stop the exporter task and export what is left"""
+        if self._export_task is not None and not self._export_task.done():
+            self._export_task.cancel()
+            await asyncio.gather(self._export_task, return_exceptions=True)
+        await self.flush()
+
+
+# Tracer shared by all instrumented services, configured by the application container
+TRACER = Tracer()
+
+
+def traced(name: str, root: bool = False) -> Callable:
+    """
+    Decorate a function or coroutine function to run in a span
+
+    Args:
+        name: Span name
+        root: Start a new trace instead of a child of the current span
+    """
+    def decorator(function: Callable) -> Callable:
+        def scope():
+            return TRACER.start_trace(name) if root else TRACER.span(name)
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with scope():
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with scope():
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
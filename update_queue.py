@@ -0,0 +1,195 @@
+"""
+Queues of Telegram updates waiting to be handled
+A bounded in-process queue, and the database-backed queue shared by all instances,
+each drained by a pool of workers passing updates to the application
+"""
+
+import asyncio
+import json
+import logging
+from typing import Dict, List, Optional, Set, Union
+from telegram import Update
+from telegram.ext import Application
+from async_database_service import AsyncDatabaseService
+from config import Config
+from database_service import DatabaseService
+from metrics import Counter, Gauge, Histogram
+
+UPDATE_HANDLE_SECONDS = Histogram("bot_update_handle_seconds", "Time taken to handle one queued update",
+                                  buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300))
+UPDATES_IN_FLIGHT = Gauge("bot_updates_in_flight", "Queued updates being handled by this process")
+UPDATE_QUEUE_DEPTH = Gauge("bot_update_queue_depth", "Updates waiting in the in-process queue")
+UPDATES_REJECTED = Counter("bot_update_queue_rejected_total", "Updates refused because the in-process queue was full")
+
+
+class QueueFull(Exception):
+    """Raised when updates don't fit into the in-process queue"""
+
+
+async def handle_payload(application: Application, payload: Dict) -> None:
+    """Pass one update (as received from Telegram) to the application's handlers"""
+    logger = logging.getLogger(__name__)
+    try:
+        update = Update.de_json(payload, application.bot)
+        # Handler errors are passed to the error handler by process_update
+        with UPDATE_HANDLE_SECONDS.time():
+            await application.process_update(update)
+    except Exception as e:
+        logger.error(f"Failed to handle update {payload.get('update_id')}: {str(e)}")
+
+
+class MemoryUpdateQueue:
+    """Bounded in-process queue; updates still queued when the process dies are lost"""
+
+    def __init__(self, config: Config, application: Application, maxsize: int, workers: int):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.application = application
+        self.capacity = maxsize
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self._worker_count = workers
+        self._workers: List[asyncio.Task] = []
+
+        self.in_flight = 0
+        self.handled = 0
+        self.rejected = 0
+        UPDATES_IN_FLIGHT.set_function(lambda: self.in_flight)
+        UPDATE_QUEUE_DEPTH.set_function(self._queue.qsize)
+
+    async def put(self, payloads: List[Dict]) -> None:
+        """
+        Queue updates without waiting
+
+        Raises:
+            QueueFull: If the updates don't fit into the queue
+        """
+        if self._queue.qsize() + len(payloads) > self.capacity:
+            self.rejected += len(payloads)
+            UPDATES_REJECTED.inc(len(payloads))
+            raise QueueFull(f"Update queue is full ({self._queue.qsize()} queued)")
+        for payload in payloads:
+            self._queue.put_nowait(payload)
+
+    async def depth(self) -> int:
+        return self._queue.qsize()
+
+    async def start(self) -> None:
+        """Start the worker pool"""
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self._worker_count)]
+
+    async def _work(self) -> None:
+        while True:
+            payload = await self._queue.get()
+            self.in_flight += 1
+            try:
+                await handle_payload(self.application, payload)
+            finally:
+                self.in_flight -= 1
+                self.handled += 1
+                self._queue.task_done()
+
+    async def close(self) -> None:
+        """Handle queued updates for up to UPDATE_SHUTDOWN_TIMEOUT seconds, then stop the workers"""
+        try:
+            await asyncio.wait_for(self._queue.join(), self.config.UPDATE_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"{self._queue.qsize() + self.in_flight} updates were not handled before shutdown")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+
+class DatabaseUpdateQueue:
+    """
+    Update queue in the update_queue table, shared by all instances
+
+    Updates are claimed in batches with a visibility timeout and deleted
+    once handled. Updates claimed by an instance that died are claimed again
+    after UPDATE_QUEUE_VISIBILITY_TIMEOUT, so an update may be handled more
+    than once; the coordinator's update dedup skips such repeats.
+    """
+
+    def __init__(self, config: Config, application: Application,
+                 db_service: Union[DatabaseService, AsyncDatabaseService], instance_id: str, workers: int):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.application = application
+        self.db_service = db_service
+        self.instance_id = instance_id
+        self._worker_count = workers
+        self._consumer: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._handled_ids: List[int] = []
+
+        self.handled = 0
+        UPDATES_IN_FLIGHT.set_function(lambda: self.in_flight)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def put(self, payloads: List[Dict]) -> None:
+        """
+        Durably queue updates, ignoring ones already queued
+
+        Raises:
+            Exception: If the write fails
+        """
+        await self.db_service.call("enqueue_updates", [
+            {"update_id": payload["update_id"], "payload": json.dumps(payload)} for payload in payloads
+        ])
+
+    async def depth(self) -> int:
+        return await self.db_service.call("count_queued_updates")
+
+    async def start(self) -> None:
+        """Start claiming and handling queued updates"""
+        if self._consumer is None or self._consumer.done():
+            self._consumer = asyncio.create_task(self._consume())
+
+    async def _consume(self) -> None:
+        """Claim queued updates and handle up to the configured number of them at a time"""
+        while True:
+            await self._ack_handled()
+
+            rows = []
+            limit = min(self.config.UPDATE_QUEUE_BATCH, self._worker_count - len(self._tasks))
+            if limit > 0:
+                try:
+                    rows = await self.db_service.call("claim_queued_updates", self.instance_id, limit,
+                                                      self.config.UPDATE_QUEUE_VISIBILITY_TIMEOUT)
+                except Exception as e:
+                    self.logger.error(f"Failed to claim queued updates: {str(e)}")
+
+            for row in rows:
+                task = asyncio.create_task(self._handle(row))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            if not rows:
+                await asyncio.sleep(self.config.UPDATE_QUEUE_POLL_INTERVAL)
+
+    async def _handle(self, row: Dict) -> None:
+        await handle_payload(self.application, json.loads(row["payload"]))
+        self._handled_ids.append(row["update_id"])
+        self.handled += 1
+
+    async def _ack_handled(self) -> None:
+        """Delete handled updates from the queue in one statement"""
+        if not self._handled_ids:
+            return
+        handled_ids, self._handled_ids = self._handled_ids, []
+        try:
+            await self.db_service.call("delete_queued_updates", handled_ids)
+        except Exception as e:
+            # They are claimed again after the visibility timeout and skipped as duplicates
+            self.logger.error(f"Failed to delete {len(handled_ids)} handled updates: {str(e)}")
+
+    async def close(self) -> None:
+        """Stop claiming, let updates being handled finish for up to UPDATE_SHUTDOWN_TIMEOUT seconds"""
+        if self._consumer is not None and not self._consumer.done():
+            self._consumer.cancel()
+            await asyncio.gather(self._consumer, return_exceptions=True)
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=self.config.UPDATE_SHUTDOWN_TIMEOUT)
+        await self._ack_handled()
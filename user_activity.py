@@ -0,0 +1,107 @@
+"""
+User activity tracking
+Coalesces user sightings into periodic bulk upserts and last_seen updates
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Optional, Union
+from async_database_service import AsyncDatabaseService
+from cache import LRUCache
+from config import Config
+from database_service import DatabaseService
+
+# Users per statement, keeping bound parameters well below database limits
+USER_WRITE_CHUNK_ROWS = 500
+
+
+class UserActivityTracker:
+    """
+    Records which users were active and writes them to the users table in bulk
+
+    Instead of a read-modify-write per message, all users seen during one
+    interval are written with at most two statements: an upsert for new users
+    or changed profiles and a single UPDATE of last_seen for everyone else.
+    """
+
+    def __init__(self, config: Config, db_service: Union[DatabaseService, AsyncDatabaseService]):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.db_service = db_service
+
+        # Users seen since the last flush, and profiles already stored in the database
+        self._seen: Dict[int, Dict] = {}
+        self._stored_profiles = LRUCache(config.THREAD_CACHE_SIZE)
+        self._flush_task: Optional[asyncio.Task] = None
+
+        # Users this instance added to the table, for counting users between reconciliations
+        self.users_created = 0
+
+    def record(self, telegram_id: int, username: Optional[str] = None,
+               first_name: Optional[str] = None, last_name: Optional[str] = None) -> None:
+        """
+        Note that a user sent a message; written to the database on the next flush
+
+        Args:
+            telegram_id: Telegram user ID
+            username: Telegram username
+            first_name: User's first name
+            last_name: User's last name
+        """
+        self._seen[telegram_id] = {
+            "telegram_id": telegram_id,
+            "username": username,
+            "first_name": first_name,
+            "last_name": last_name
+        }
+
+    async def start(self) -> None:
+        """Start flushing recorded activity every USER_TOUCH_INTERVAL seconds"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.USER_TOUCH_INTERVAL)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Write users seen since the last flush"""
+        if not self._seen:
+            return
+        seen, self._seen = self._seen, {}
+        seen_at = datetime.utcnow()
+
+        changed, unchanged = [], []
+        for telegram_id, profile in seen.items():
+            if self._stored_profiles.get(telegram_id) == profile:
+                unchanged.append(telegram_id)
+            else:
+                changed.append(dict(profile, last_seen=seen_at))
+
+        try:
+            for i in range(0, len(changed), USER_WRITE_CHUNK_ROWS):
+                self.users_created += await self.db_service.call("upsert_users", changed[i:i + USER_WRITE_CHUNK_ROWS])
+            for i in range(0, len(unchanged), USER_WRITE_CHUNK_ROWS):
+                await self.db_service.call("touch_users", unchanged[i:i + USER_WRITE_CHUNK_ROWS], seen_at)
+        except Exception as e:
+            self.logger.error(f"Failed to record activity of {len(seen)} users: {str(e)}")
+            # Retry with the next flush unless the user was seen again in the meantime
+            for telegram_id, profile in seen.items():
+                self._seen.setdefault(telegram_id, profile)
+            return
+
+        for telegram_id, profile in seen.items():
+            self._stored_profiles.set(telegram_id, profile)
+        self.logger.debug(f"Recorded activity of {len(seen)} users ({len(changed)} upserted)")
+
+    async def close(self) -> None:
+        """Stop the periodic flush and write any remaining activity"""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
@@ -0,0 +1,164 @@
+"""
+Webhook ingress for the Telegram bot
+Acknowledges updates as soon as they are queued and handles them out of band with a
+worker pool, and serves /health and /ready for load balancers and orchestrators and
+/metrics for Prometheus
+"""
+
+import asyncio
+import hmac
+import logging
+import signal
+from typing import Optional, Union
+from urllib.parse import urlsplit
+from aiohttp import web
+from telegram.ext import Application
+from async_database_service import AsyncDatabaseService
+from config import Config
+from database_service import DatabaseService
+from metrics import handle_metrics
+from shared_state import InstanceCoordinator
+from update_queue import DatabaseUpdateQueue, MemoryUpdateQueue, QueueFull
+
+# Header Telegram sends the secret_token given to setWebhook in
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Receives webhook requests and runs the application on a worker pool
+
+    A request is answered with 200 once its update is in the queue, so slow
+    assistant runs never delay the acknowledgement and Telegram does not
+    retry or back off. When the queue is full the request is answered with
+    503 and Telegram delivers the update again later.
+    """
+
+    def __init__(self, config: Config, application: Application,
+                 db_service: Optional[Union[DatabaseService, AsyncDatabaseService]] = None,
+                 coordinator: Optional[InstanceCoordinator] = None):
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.application = application
+
+        if config.WEBHOOK_QUEUE == "database" and db_service is not None and coordinator is not None:
+            self.queue = DatabaseUpdateQueue(config, application, db_service, coordinator.instance_id,
+                                             workers=config.WEBHOOK_WORKERS)
+        else:
+            if config.WEBHOOK_QUEUE == "database":
+                self.logger.warning("WEBHOOK_QUEUE=database needs DATABASE_URL and MULTI_INSTANCE; using memory queue")
+            self.queue = MemoryUpdateQueue(config, application, config.WEBHOOK_QUEUE_SIZE,
+                                           workers=config.WEBHOOK_WORKERS)
+        self.ready = False
+
+    def create_app(self, webhook_path: str) -> web.Application:
+        """Create the HTTP application with the webhook, health and readiness routes"""
+        app = web.Application()
+        app.router.add_post(webhook_path, self.handle_update)
+        app.router.add_get("/health", self.handle_health)
+        app.router.add_get("/ready", self.handle_ready)
+        app.router.add_get("/", self.handle_health)
+        if self.config.ENABLE_METRICS:
+            app.router.add_get("/metrics", handle_metrics)
+        return app
+
+    def run(self, webhook_url: str) -> None:
+        """Serve on 0.0.0.0:PORT until SIGINT/SIGTERM"""
+        asyncio.run(self._main(webhook_url))
+
+    async def _main(self, webhook_url: str) -> None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+
+        application = self.application
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await self.queue.start()
+
+        runner = web.AppRunner(self.create_app(urlsplit(webhook_url).path or "/webhook"), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", self.config.PORT).start()
+        self.logger.info(f"Webhook server listening on port {self.config.PORT}")
+
+        try:
+            await application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=self.config.WEBHOOK_SECRET or None,
+                allowed_updates=["message"],
+                # A restarting replica must not drop updates queued for the others
+                drop_pending_updates=not self.config.MULTI_INSTANCE
+            )
+            if not self.config.WEBHOOK_SECRET:
+                self.logger.warning("WEBHOOK_SECRET is not set; webhook requests are not authenticated")
+            self.ready = True
+            await stop.wait()
+        finally:
+            self.ready = False
+            self.logger.info("Stopping webhook server")
+            # Stop accepting requests, then finish the queued updates
+            await runner.cleanup()
+            await self.queue.close()
+
+            await application.stop()
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """Queue one update from Telegram and acknowledge it"""
+        secret = self.config.WEBHOOK_SECRET
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ""), secret):
+            self.logger.warning(f"Rejected webhook request with invalid secret token from {request.remote}")
+            return web.Response(status=403)
+
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="Invalid JSON")
+        if not isinstance(payload, dict) or not isinstance(payload.get("update_id"), int):
+            return web.Response(status=400, text="Not a Telegram update")
+
+        try:
+            await self.queue.put([payload])
+        except QueueFull as e:
+            self.logger.warning(f"Deferring update {payload['update_id']}: {str(e)}")
+            return web.Response(status=503, text="Queue full")
+        except Exception as e:
+            self.logger.error(f"Failed to queue update {payload['update_id']}: {str(e)}")
+            return web.Response(status=503, text="Queue unavailable")
+        return web.Response(text="OK")
+
+    async def _queue_status(self) -> dict:
+        status = {"queue_depth": None, "in_flight": self.queue.in_flight}
+        try:
+            status["queue_depth"] = await self.queue.depth()
+        except Exception as e:
+            self.logger.error(f"Failed to get queue depth: {str(e)}")
+        if isinstance(self.queue, MemoryUpdateQueue):
+            status["queue_capacity"] = self.queue.capacity
+        return status
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """Liveness: the process is up and serving requests"""
+        return web.json_response({"status": "ok", **await self._queue_status()})
+
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        """Readiness: the webhook is registered and the queue can take more updates"""
+        status = await self._queue_status()
+        depth = status["queue_depth"]
+        if not self.ready:
+            reason = "starting or stopping"
+        elif depth is None:
+            reason = "queue unavailable"
+        elif isinstance(self.queue, MemoryUpdateQueue) and depth >= self.queue.capacity:
+            reason = "queue full"
+        else:
+            return web.json_response({"status": "ready", **status})
+        return web.json_response({"status": "not ready", "reason": reason, **status}, status=503)